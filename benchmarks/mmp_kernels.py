@@ -0,0 +1,56 @@
+'''
+Mean max power of synthetic 1 second rides: sweat's WorkoutDataFrame.compute_mean_max_power (what activities were
+ingested with before lib/mmp.py) against mean_max_power() for every duration and for the power curve grid only.
+Run from the repo root: python -m benchmarks.mmp_kernels
+'''
+import time
+import numpy as np
+import pandas as pd
+from sweat.io.models.dataframes import WorkoutDataFrame
+from lib.mmp import mean_max_power, power_curve_intervals
+
+rng = np.random.default_rng(0)
+
+
+def synthetic_ride(hours, gaps=False, integers=False):
+    # Power around 200w with slow swings and noise, optionally with dropped samples or as an integer stream
+    n = hours * 3600
+    power = np.clip(200 + 40 * np.sin(np.arange(n) / 300) + rng.normal(0, 60, n), 0, None)
+    if integers:
+        power = power.round().astype('int')
+    power = pd.Series(power)
+    if gaps:
+        power[rng.choice(n, n // 50, replace=False)] = np.nan
+    return power
+
+
+def sweat_mmp(power):
+    return np.asarray(WorkoutDataFrame(pd.DataFrame({'power': power})).compute_mean_max_power(), dtype='float')
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    print('{:>5} {:>10} {:>10} {:>10} {:>10} {:>10}'.format('ride', 'sweat', 'kernel', 'grid', 'identical',
+                                                             'grid same'))
+    for hours in [1, 4, 8]:
+        power = synthetic_ride(hours)
+        grid = power_curve_intervals(len(power) - 1)
+        old, old_seconds = timed(sweat_mmp, power)
+        new, new_seconds = timed(mean_max_power, power)
+        coarse, coarse_seconds = timed(mean_max_power, power, grid)
+        print('{:>4}h {:>9.2f}s {:>9.2f}s {:>9.3f}s {:>10} {:>10}'.format(
+            hours, old_seconds, new_seconds, coarse_seconds, str(np.array_equal(old, new)),
+            str(np.array_equal(old[np.asarray(grid) - 1], coarse))))
+
+    # Bit for bit on the streams that take other code paths (nan samples, integer power)
+    for name, power in [('gaps', synthetic_ride(1, gaps=True)), ('integers', synthetic_ride(1, integers=True))]:
+        print('{}: identical {}'.format(name, np.array_equal(sweat_mmp(power), mean_max_power(power), equal_nan=True)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+'''
+Power and heart rate zones of one synthetic 1 second activity: the per sample .loc/.at loops FitlyActivity used before
+lib/zones.py against classify_zones(). Then a history of activities at a handful of ftps: classify_zones() per activity
+against classify_zones_batch().
+Run from the repo root: python -m benchmarks.zone_classification
+'''
+import time
+import numpy as np
+import pandas as pd
+from lib.zones import classify_zones, classify_zones_batch, power_zone_thresholds, heartrate_zone_thresholds
+
+rng = np.random.default_rng(0)
+
+ftp, rhr, hrr = 250, 50, 135
+power_zones = {1: .55, 2: .75, 3: .9, 4: 1.05, 5: 1.2, 6: 1.5}
+heartrate_zones = {1: .6, 2: .7, 3: .8, 4: .9}
+
+
+def synthetic_activity(hours):
+    n = hours * 3600
+    return pd.DataFrame({'watts': rng.integers(0, 600, n).astype('float'),
+                         'heartrate': rng.integers(90, 190, n).astype('float'), 'time': np.arange(n)},
+                        index=pd.date_range('2020-01-01', periods=n, freq='s'))
+
+
+def loop_zones(df, column, thresholds):
+    # The old calculate_power_zones / calculate_heartate_zones walk, thresholds as inclusive upper bounds
+    df[column + '_zone'] = np.nan
+    for i in df.index:
+        value = df.loc[i][column]
+        zone = len(thresholds) + 1
+        for z, threshold in enumerate(thresholds, start=1):
+            if value <= threshold:
+                zone = z
+                break
+        df.at[i, column + '_zone'] = zone
+    return df[column + '_zone'].to_numpy()
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    power_thresholds = power_zone_thresholds(ftp, power_zones, 'Ride')
+    heartrate_thresholds = heartrate_zone_thresholds(rhr, hrr, heartrate_zones)
+    print('{:>9} {:>10} {:>10} {:>10}'.format('activity', 'loop', 'vectorized', 'identical'))
+    for hours in [1, 5]:
+        df = synthetic_activity(hours)
+        start = time.perf_counter()
+        old = [loop_zones(df.copy(), 'watts', power_thresholds), loop_zones(df.copy(), 'heartrate',
+                                                                            heartrate_thresholds)]
+        old_seconds = time.perf_counter() - start
+        new, new_seconds = timed(lambda: [classify_zones(df['watts'], power_thresholds),
+                                          classify_zones(df['heartrate'], heartrate_thresholds)])
+        print('{:>8}h {:>9.2f}s {:>9.4f}s {:>10}'.format(hours, old_seconds, new_seconds,
+                                                         str(all(np.array_equal(x, y) for x, y in zip(old, new)))))
+
+    print()
+    print('{:>10} {:>12} {:>10} {:>10}'.format('activities', 'per activity', 'batch', 'identical'))
+    for count in [100, 1000]:
+        # 1 hour activities, ftp retested every 50 of them
+        samples = [rng.integers(0, 600, 3600).astype('float') for _ in range(count)]
+        thresholds = [power_zone_thresholds(ftp + 5 * (i // 50), power_zones, 'Ride') for i in range(count)]
+        old, old_seconds = timed(lambda: [classify_zones(x, y) for x, y in zip(samples, thresholds)])
+        new, new_seconds = timed(classify_zones_batch, samples, thresholds)
+        print('{:>10} {:>11.4f}s {:>9.4f}s {:>10}'.format(count, old_seconds, new_seconds,
+                                                         str(all(np.array_equal(x, y) for x, y in zip(old, new)))))
+
+
+if __name__ == '__main__':
+    main()
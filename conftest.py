@@ -0,0 +1 @@
+# Lets the tests under tests/ import lib.* from the repo root
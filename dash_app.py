@@ -15,6 +15,11 @@ dash_app = dash.Dash(__name__, server=app, url_base_pathname='/',
 
 dash_app.title = 'Fit.ly'
 
+# Wrap dash_app.callback before any page registers its callbacks
+from lib.callback_profiler import profiler
+
+profiler.install(dash_app)
+
 dash_app.config.suppress_callback_exceptions = True
 # Dash CSS
 # app.css.append_css({"external_url": "https://codepen.io/chriddyp/pen/bWLwgP.css"})
@@ -0,0 +1,132 @@
+import threading
+import configparser
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete
+from lib.sqlalchemy_declarative import db_session, db_insert, stravaSummary, stravaZoneSeconds
+from lib.sample_store import sample_store
+from lib.mmp import read_mmp_summary, unpack_mmp
+from lib.zones import zone_seconds
+from lib.callback_cache import MemoryCache, data_versions, _missing
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+# Tables an activity's data is read from, a write to any of them starts a fresh ActivityData
+tables = ['strava_summary', 'strava_samples', 'strava_mmp', 'strava_zone_seconds']
+
+zone_metrics = ['power_zone', 'hr_zone']
+
+
+def write_zone_seconds(activity_id, start_date_local, df_samples):
+    '''
+    Count the seconds spent in every power and hr zone of an activity into strava_zone_seconds
+    :param activity_id: activity the samples belong to
+    :param start_date_local: start of the activity
+    :param df_samples: samples with power_zone and/or hr_zone columns, a missing column counts as no time in any zone
+    '''
+    frames = []
+    for metric in zone_metrics:
+        seconds = zone_seconds(df_samples[metric] if metric in df_samples.columns else [])
+        frames.append(pd.DataFrame({'activity_id': int(activity_id), 'metric': metric,
+                                    'zone': np.arange(1, len(seconds) + 1), 'seconds': seconds,
+                                    'start_date_local': pd.to_datetime(start_date_local)}))
+    with db_session() as session:
+        session.execute(delete(stravaZoneSeconds).where(stravaZoneSeconds.activity_id == int(activity_id)))
+    db_insert(pd.concat(frames).set_index(['activity_id', 'metric', 'zone']), 'strava_zone_seconds')
+
+
+def backfill_zone_seconds(activity_ids):
+    # Activities loaded before zone seconds were counted at ingest are counted from their samples once
+    with db_session() as session:
+        counted = [x for (x,) in session.query(stravaZoneSeconds.activity_id).filter(
+            stravaZoneSeconds.activity_id.in_(activity_ids)).distinct().all()]
+        missing = session.query(stravaSummary.activity_id, stravaSummary.start_date_local).filter(
+            stravaSummary.activity_id.in_([x for x in activity_ids if x not in counted])).all()
+    for (activity_id, start_date_local) in missing:
+        write_zone_seconds(activity_id, start_date_local, sample_store.read(activity_id, columns=zone_metrics))
+
+
+def read_zone_seconds(metric, activity_ids=None, since=None):
+    '''
+    Seconds per zone summed over a set of activities
+    :param metric: power_zone or hr_zone
+    :param activity_ids: optional list of activity ids
+    :param since: optional datetime, only activities started since
+    :return: df of zone and seconds, zones ascending
+    '''
+    with db_session() as session:
+        query = session.query(stravaSummary.activity_id)
+        if activity_ids is not None:
+            query = query.filter(stravaSummary.activity_id.in_([int(x) for x in activity_ids]))
+        if since is not None:
+            query = query.filter(stravaSummary.start_date_local >= since)
+        activity_ids = [x for (x,) in query.all()]
+    backfill_zone_seconds(activity_ids)
+    with db_session() as session:
+        df = pd.read_sql(sql=session.query(stravaZoneSeconds.zone, stravaZoneSeconds.seconds).filter(
+            stravaZoneSeconds.metric == metric, stravaZoneSeconds.activity_id.in_(activity_ids)).statement,
+                         con=session.bind)
+    return df.groupby('zone')['seconds'].sum().reset_index()
+
+
+class ActivityData(object):
+    '''
+    One activity's samples, mean max power curve and zone seconds, shared by every chart drawn from it. Each part is
+    read the first time it is asked for, and callbacks asking for a part that is still being read wait for that read
+    instead of repeating it
+    :param activity_id: activity to load
+    '''
+
+    def __init__(self, activity_id):
+        self.activity_id = int(activity_id)
+        self.parts = {}
+        self.locks = {x: threading.Lock() for x in ['samples', 'mmp'] + zone_metrics}
+
+    def _part(self, name, load):
+        with self.locks[name]:
+            if name not in self.parts:
+                self.parts[name] = load()
+            return self.parts[name]
+
+    @property
+    def samples(self):
+        # df indexed by timestamp_local, see sample_store.read()
+        return self._part('samples', lambda: sample_store.read(self.activity_id))
+
+    def _load_mmp(self):
+        df = read_mmp_summary(activity_ids=[self.activity_id])
+        return df, (unpack_mmp(df.pop('mmp').iloc[0]) if len(df) > 0 else np.full(0, np.nan))
+
+    @property
+    def mmp(self):
+        # Float array of the 1 second to full length bests, empty without power
+        return self._part('mmp', self._load_mmp)[1]
+
+    @property
+    def mmp_summary(self):
+        # The activity's strava_mmp row (weight, type...) without the curve, see read_mmp_summary()
+        return self._part('mmp', self._load_mmp)[0]
+
+    def zone_seconds(self, metric):
+        # df of zone and seconds for power_zone or hr_zone
+        return self._part(metric, lambda: read_zone_seconds(metric, activity_ids=[self.activity_id]))
+
+
+# Latest activities opened, keyed on the data versions so a refresh never serves stale data
+activities = MemoryCache(max_entries=config.getint('cache', 'max_activities', fallback=4))
+_activities_lock = threading.Lock()
+
+
+def activity_data(activity_id):
+    '''
+    :param activity_id: activity to load
+    :return: the ActivityData every callback of this activity shares
+    '''
+    key = (int(activity_id), tuple(data_versions(tables)))
+    with _activities_lock:
+        data = activities.get(key)
+        if data is _missing:
+            data = ActivityData(activity_id)
+            activities.set(key, data)
+    return data
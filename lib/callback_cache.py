@@ -0,0 +1,166 @@
+import os
+import glob
+import json
+import pickle
+import hashlib
+import threading
+import configparser
+from collections import OrderedDict
+from datetime import datetime, date
+from functools import wraps
+from lib.sqlalchemy_declarative import db_session, dataVersions
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+# Returned by cache backends on a miss (None is a valid callback output)
+_missing = object()
+
+
+class MemoryCache(object):
+    '''
+    Least recently used cache local to this server process
+    :param max_entries: entries kept before the least recently used is evicted
+    '''
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return _missing
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DiskCache(object):
+    '''
+    Pickle file per entry so every server worker shares the cache. Least recently read files are removed once the
+    directory grows past max_mb
+    :param path: directory holding the cache files
+    :param max_mb: size of the directory before evicting
+    '''
+
+    def __init__(self, path, max_mb=256):
+        self.path = path
+        self.max_bytes = max_mb * 1024 * 1024
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + '.pkl')
+
+    def get(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                value = pickle.load(f)
+            # Mark as recently used for eviction
+            os.utime(self._file(key))
+            return value
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return _missing
+
+    def set(self, key, value):
+        tmp = self._file(key) + '.{}.tmp'.format(threading.get_ident())
+        with open(tmp, 'wb') as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self._file(key))
+        self._evict()
+
+    def clear(self):
+        for file in glob.glob(os.path.join(self.path, '*.pkl')):
+            os.remove(file)
+
+    def _evict(self):
+        files = []
+        for file in glob.glob(os.path.join(self.path, '*.pkl')):
+            try:
+                stat = os.stat(file)
+                files.append((stat.st_mtime, stat.st_size, file))
+            except OSError:
+                continue
+        size = sum([x[1] for x in files])
+        for (mtime, file_size, file) in sorted(files):
+            if size <= self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+            size -= file_size
+
+
+def get_cache():
+    backend = config.get('cache', 'backend', fallback='memory')
+    if backend == 'disk':
+        return DiskCache(config.get('cache', 'path', fallback='./callback_cache'),
+                         max_mb=config.getint('cache', 'max_mb', fallback=256))
+    elif backend == 'memory':
+        return MemoryCache(max_entries=config.getint('cache', 'max_entries', fallback=256))
+    # Any other value (i.e. none) disables caching
+    return None
+
+
+cache = get_cache()
+
+
+def bump_data_version(*tables):
+    '''
+    Invalidate cached results that read from any of tables
+    :param tables: table names that were written to
+    '''
+    with db_session() as session:
+        current = {x.table_name: x for x in
+                   session.query(dataVersions).filter(dataVersions.table_name.in_(tables)).all()}
+        for table in tables:
+            if table in current:
+                current[table].version += 1
+                current[table].updated_utc = datetime.utcnow()
+            else:
+                session.add(dataVersions(table_name=table, version=1, updated_utc=datetime.utcnow()))
+
+
+def data_versions(tables):
+    with db_session() as session:
+        versions = dict(session.query(dataVersions.table_name, dataVersions.version).filter(
+            dataVersions.table_name.in_(tables)).all())
+    return [versions.get(x, 0) for x in tables]
+
+
+def cached(*tables):
+    '''
+    Memoize a page function on its arguments, the current data version of each table it reads and today's date
+    (pages chart relative to today). Arguments must be json serializable, as callback inputs are
+    :param tables: table names the function reads from
+    '''
+
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if cache is None:
+                return func(*args, **kwargs)
+            key = hashlib.sha1(json.dumps(
+                [func.__module__, func.__qualname__, args, kwargs, data_versions(tables), date.today()],
+                sort_keys=True, default=str).encode()).hexdigest()
+            value = cache.get(key)
+            if value is _missing:
+                value = func(*args, **kwargs)
+                cache.set(key, value)
+            return value
+
+        return wrapper
+
+    return decorator
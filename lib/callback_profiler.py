@@ -0,0 +1,245 @@
+import os
+import sys
+import json
+import time
+import heapq
+import threading
+import configparser
+from collections import Counter, deque
+from datetime import datetime
+from functools import wraps
+import pandas as pd
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    from plotly.utils import PlotlyJSONEncoder
+except ImportError:
+    PlotlyJSONEncoder = None
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+# Upper bound (ms) of each latency histogram bucket, the last bucket is everything slower
+histogram_buckets = [10, 25, 50, 100, 250, 500, 1000, 2500, 5000]
+
+
+class CallbackProfiler(object):
+    '''
+    Times every dash callback while enabled, splitting each call into db (sql and pd.read_sql), serialization (json
+    encoding of the output, as dash does before responding) and compute (everything else, mostly pandas). Stacks are
+    sampled from every call so the slowest can be kept and exported in flamegraph folded stack format
+    :param enabled: time callbacks from the start
+    :param sample_slowest: number of the slowest calls to keep sampled stacks of, 0 to not sample
+    :param sample_interval_ms: time between stack samples
+    :param max_durations: latest durations kept per callback for percentiles
+    '''
+
+    def __init__(self, enabled=False, sample_slowest=10, sample_interval_ms=5, max_durations=1000):
+        self.enabled = enabled
+        self.sample_slowest = sample_slowest
+        self.sample_interval = sample_interval_ms / 1000
+        self.max_durations = max_durations
+        self.stats = {}
+        self.slowest = []
+        self.sampling = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.sampler = None
+
+    def install(self, dash_app):
+        '''
+        Profile every callback registered through dash_app.callback from here on, so must be called before the pages
+        are imported. Also serves the slowest calls' stacks at /profiler/stacks
+        :param dash_app: dash.Dash app
+        '''
+        register = dash_app.callback
+
+        @wraps(register)
+        def callback(*args, **kwargs):
+            decorator = register(*args, **kwargs)
+            return lambda func: decorator(self.wrap(func))
+
+        dash_app.callback = callback
+        dash_app.server.add_url_rule('/profiler/stacks', 'profiler_stacks', self.stacks_response)
+
+        # Db time of the thread's current call, pd.read_sql is timed as a whole (fetching rows and building the df)
+        event.listen(Engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(Engine, 'after_cursor_execute', self._after_cursor_execute)
+        read_sql = pd.read_sql
+
+        @wraps(read_sql)
+        def timed_read_sql(*args, **kwargs):
+            call = getattr(self.local, 'call', None)
+            if call is None or call['in_read_sql']:
+                return read_sql(*args, **kwargs)
+            call['in_read_sql'] = True
+            start = time.perf_counter()
+            try:
+                return read_sql(*args, **kwargs)
+            finally:
+                call['db'] += time.perf_counter() - start
+                call['in_read_sql'] = False
+
+        pd.read_sql = timed_read_sql
+
+    def wrap(self, func):
+        name = '{}.{}:{}'.format(func.__module__, func.__qualname__, func.__code__.co_firstlineno)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not self.enabled:
+                return func(*args, **kwargs)
+            return self.profile(name, func, *args, **kwargs)
+
+        return wrapper
+
+    def profile(self, name, func, *args, **kwargs):
+        call = {'db': 0.0, 'in_read_sql': False}
+        self.local.call = call
+        stacks = self._start_sampling()
+        start = time.perf_counter()
+        try:
+            output = func(*args, **kwargs)
+        except BaseException:
+            # PreventUpdate is raised as a normal outcome, only time calls that return something
+            self.local.call = None
+            self._stop_sampling()
+            with self.lock:
+                self._callback_stats(name)['exceptions'] += 1
+            raise
+        self.local.call = None
+        self._stop_sampling()
+        compute = time.perf_counter() - start
+
+        serialize_start = time.perf_counter()
+        try:
+            payload = len(json.dumps(output, cls=PlotlyJSONEncoder))
+        except (TypeError, ValueError):
+            payload = 0
+        serialize = time.perf_counter() - serialize_start
+        self.record(name, compute + serialize, call['db'], serialize, payload, stacks)
+        return output
+
+    def record(self, name, duration, db, serialize, payload, stacks=None):
+        with self.lock:
+            stats = self._callback_stats(name)
+            stats['calls'] += 1
+            stats['total'] += duration
+            stats['db'] += db
+            stats['serialize'] += serialize
+            stats['payload'] += payload
+            stats['durations'].append(duration)
+            stats['histogram'][sum([duration * 1000 > x for x in histogram_buckets])] += 1
+            if stacks is not None and self.sample_slowest > 0:
+                # Min heap, so the quickest of the kept calls is the one replaced
+                entry = (duration, datetime.utcnow(), name, stacks)
+                if len(self.slowest) < self.sample_slowest:
+                    heapq.heappush(self.slowest, entry)
+                elif duration > self.slowest[0][0]:
+                    heapq.heapreplace(self.slowest, entry)
+
+    def _callback_stats(self, name):
+        if name not in self.stats:
+            self.stats[name] = {'calls': 0, 'exceptions': 0, 'total': 0.0, 'db': 0.0, 'serialize': 0.0,
+                                'payload': 0, 'durations': deque(maxlen=self.max_durations),
+                                'histogram': [0] * (len(histogram_buckets) + 1)}
+        return self.stats[name]
+
+    def summary(self):
+        '''
+        :return: df with a row per callback of calls, latency percentiles (ms), mean db/serialize/compute time (ms),
+                 mean payload (KB) and the latency histogram counts (one column per bucket)
+        '''
+        rows = []
+        with self.lock:
+            for name, stats in self.stats.items():
+                calls = max(stats['calls'], 1)
+                durations = pd.Series(list(stats['durations']), dtype='float') * 1000
+                row = {'callback': name, 'calls': stats['calls'], 'exceptions': stats['exceptions'],
+                       'p50_ms': durations.quantile(.5), 'p95_ms': durations.quantile(.95), 'max_ms': durations.max(),
+                       'db_ms': stats['db'] / calls * 1000, 'serialize_ms': stats['serialize'] / calls * 1000,
+                       'compute_ms': (stats['total'] - stats['db'] - stats['serialize']) / calls * 1000,
+                       'payload_kb': stats['payload'] / calls / 1024}
+                labels = ['<{}ms'.format(x) for x in histogram_buckets] + ['>{}ms'.format(histogram_buckets[-1])]
+                row.update(zip(labels, stats['histogram']))
+                rows.append(row)
+        if len(rows) == 0:
+            return pd.DataFrame()
+        return pd.DataFrame(rows).sort_values('p95_ms', ascending=False)
+
+    def slowest_calls(self):
+        # Sampled calls, slowest first, as (duration (s), utc time, callback)
+        with self.lock:
+            return [x[:3] for x in sorted(self.slowest, key=lambda x: x[0], reverse=True)]
+
+    def folded_stacks(self, callback=None):
+        '''
+        Sampled stacks of the slowest calls in folded format ("frame;frame;frame count" per line), the input of
+        flamegraph.pl, speedscope and similar
+        :param callback: optional callback name to only export its calls
+        '''
+        stacks = Counter()
+        with self.lock:
+            for (duration, timestamp, name, call_stacks) in self.slowest:
+                if callback is None or callback == name:
+                    stacks.update({name + ';' + stack: count for stack, count in call_stacks.items()})
+        return '\n'.join(['{} {}'.format(stack, count) for stack, count in sorted(stacks.items())]) + '\n'
+
+    def stacks_response(self):
+        from flask import request, Response
+        return Response(self.folded_stacks(request.args.get('callback')), mimetype='text/plain')
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+            self.slowest = []
+
+    def _start_sampling(self):
+        if self.sample_slowest <= 0:
+            return None
+        stacks = Counter()
+        with self.lock:
+            self.sampling[threading.get_ident()] = stacks
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample, name='callback-profiler', daemon=True)
+                self.sampler.start()
+        return stacks
+
+    def _stop_sampling(self):
+        with self.lock:
+            self.sampling.pop(threading.get_ident(), None)
+
+    def _sample(self):
+        # Runs for the life of the process, only walks the threads currently in a profiled call
+        while True:
+            time.sleep(self.sample_interval)
+            with self.lock:
+                sampling = dict(self.sampling)
+            if len(sampling) == 0:
+                continue
+            frames = sys._current_frames()
+            for thread_id, stacks in sampling.items():
+                frame, stack = frames.get(thread_id), []
+                # Stop at the profiler, the server and dash dispatch frames below it are the same for every call
+                while frame is not None and frame.f_code is not CallbackProfiler.profile.__code__:
+                    stack.append('{} ({}:{})'.format(frame.f_code.co_name, os.path.basename(frame.f_code.co_filename),
+                                                     frame.f_code.co_firstlineno))
+                    frame = frame.f_back
+                if len(stack) > 0:
+                    stacks[';'.join(reversed(stack))] += 1
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        call = getattr(self.local, 'call', None)
+        if call is not None and not call['in_read_sql']:
+            call['cursor_start'] = time.perf_counter()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        call = getattr(self.local, 'call', None)
+        if call is not None and 'cursor_start' in call:
+            call['db'] += time.perf_counter() - call.pop('cursor_start')
+
+
+profiler = CallbackProfiler(enabled=config.get('profiler', 'enabled', fallback='False') == 'True',
+                            sample_slowest=config.getint('profiler', 'sample_slowest', fallback=10),
+                            sample_interval_ms=config.getint('profiler', 'sample_interval_ms', fallback=5))
@@ -1,165 +1,379 @@
-from lib.stravaApi import get_strava_client, strava_connected
+from lib.stravaApi import get_strava_client, strava_connected, StravaRateLimiter
+from lib.pelotonApi import peloton_mapping_df, match_peloton_titles, roundTime
+from lib.strydAPI import get_stryd_df_summary
+from lib.timeline import AthleteTimeline
+from lib.pmc import update_pmc_daily
+from lib.power_curve import rebuild_power_curve_bests
+from lib.sample_store import sample_store
+from lib.callback_cache import bump_data_version
+from lib.refresh_metrics import RefreshMetrics, track, propagate, rows_written
 from lib.ouraAPI import pull_oura_data
 from lib.withingsAPI import pull_withings_data
 from lib.fitbodAPI import pull_fitbod_data
 from lib.sqlalchemy_declarative import *
 from sqlalchemy import func, delete
 import datetime
+import time
 from lib.fitlyAPI import *
 import pandas as pd
 import configparser
 from dash_app import dash_app
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import deque
+import threading
 
 config = configparser.ConfigParser()
 config.read('./config.ini')
 
+# Tables written by each source, their data version is bumped when a pull writes to them so cached pages reading them
+# recompute
+source_tables = {
+    'withings': ['withings'],
+    'fitbod': ['fitbod', 'fitbod_muscles', 'fitbod_daily_bests'],
+    'oura': ['oura_readiness_summary', 'oura_activity_summary', 'oura_activity_samples', 'oura_sleep_summary',
+             'oura_sleep_samples'],
+    'strava': ['strava_summary', 'strava_samples', 'strava_mmp', 'strava_zone_seconds', 'power_curve_bests',
+               'pmc_daily', 'hrv_workout_step_log'],
+}
+
+
+def bump_tables(tables):
+    if len(tables) == 0:
+        return
+    try:
+        bump_data_version(*tables)
+    except BaseException as e:
+        dash_app.server.logger.error('Error updating data versions: {}'.format(e))
+
+
+def bump_source_tables(*sources):
+    bump_tables([table for source in sources for table in source_tables[source]])
+
+
+def partly_written(source):
+    # Tables of a source whose pull raised, every one of them if the stage wrote anything before the error
+    return source_tables[source] if rows_written() != 0 else []
 
 
 def latest_refresh():
-    session, engine = db_connect()
-    latest_date = session.query(func.max(dbRefreshStatus.timestamp_utc))[0][0]
-    engine.dispose()
-    session.close()
-    return latest_date
+    with db_session() as session:
+        return session.query(func.max(dbRefreshStatus.timestamp_utc))[0][0]
 
 
-def refresh_database(process='system', truncate=False, truncateDate=None):
-    # If either truncate parameter is passed
-    if truncate or truncateDate:
-        session, engine = db_connect()
-        # If only truncating past a certain date
-        if truncateDate:
-            try:
-                dash_app.server.logger.debug('Truncating strava_summary')
-                session.execute(delete(stravaSummary).where(stravaSummary.start_date_utc >= truncateDate))
-                dash_app.server.logger.debug('Truncating strava_samples')
-                session.execute(delete(stravaSamples).where(stravaSamples.timestamp_local >= truncateDate))
-                dash_app.server.logger.debug('Truncating strava_best_samples')
-                session.execute(delete(stravaBestSamples).where(stravaBestSamples.timestamp_local >= truncateDate))
-                dash_app.server.logger.debug('Truncating oura_readiness_summary')
-                session.execute(delete(ouraReadinessSummary).where(ouraReadinessSummary.report_date >= truncateDate))
-                dash_app.server.logger.debug('Truncating oura_sleep_summary')
-                session.execute(delete(ouraSleepSummary).where(ouraSleepSummary.report_date >= truncateDate))
-                dash_app.server.logger.debug('Truncating oura_sleep_samples')
-                session.execute(delete(ouraSleepSamples).where(ouraSleepSamples.report_date >= truncateDate))
-                dash_app.server.logger.debug('Truncating oura_activity_summary')
-                session.execute(delete(ouraActivitySummary).where(ouraActivitySummary.summary_date >= truncateDate))
-                dash_app.server.logger.debug('Truncating oura_activity_samples')
-                session.execute(delete(ouraActivitySamples).where(ouraActivitySamples.timestamp_local >= truncateDate))
-                dash_app.server.logger.debug('Truncating hrv_workout_step_log')
-                session.execute(delete(hrvWorkoutStepLog).where(hrvWorkoutStepLog.date >= truncateDate))
-                dash_app.server.logger.debug('Truncating withings')
-                session.execute(delete(withings).where(withings.date_utc >= truncateDate))
-                session.commit()
-            except BaseException as e:
-                session.rollback()
-                dash_app.server.logger.error(e)
-        else:
-            try:
-                dash_app.server.logger.debug('Truncating strava_summary')
-                session.execute(delete(stravaSummary))
-                dash_app.server.logger.debug('Truncating strava_samples')
-                session.execute(delete(stravaSamples))
-                dash_app.server.logger.debug('Truncating strava_best_samples')
-                session.execute(delete(stravaBestSamples))
-                dash_app.server.logger.debug('Truncating oura_readiness_summary')
-                session.execute(delete(ouraReadinessSummary))
-                dash_app.server.logger.debug('Truncating oura_sleep_summary')
-                session.execute(delete(ouraSleepSummary))
-                dash_app.server.logger.debug('Truncating oura_sleep_samples')
-                session.execute(delete(ouraSleepSamples))
-                dash_app.server.logger.debug('Truncating oura_activity_summary')
-                session.execute(delete(ouraActivitySummary))
-                dash_app.server.logger.debug('Truncating oura_activity_samples')
-                session.execute(delete(ouraActivitySamples))
-                dash_app.server.logger.debug('Truncating hrv_workout_step_log')
-                session.execute(delete(hrvWorkoutStepLog))
-                dash_app.server.logger.debug('Truncating withings')
-                session.execute(delete(withings))
-                session.commit()
-            except BaseException as e:
-                session.rollback()
-                dash_app.server.logger.error(e)
+def scrape_strava_activities(new_activities, athlete_id):
+    '''
+    Download stage runs on a thread pool (activity streams, peloton and stryd listings) while the analysis/insert
+    stage runs on this thread, one activity at a time in start date order so ftp/rhr lookups see earlier workouts
+    :param new_activities: list of FitlyActivity not yet in the db
+    :param athlete_id: athlete to assign to the activities
+    '''
+    workers = config.getint('strava', 'download_workers', fallback=4)
+    new_activities = sorted(new_activities, key=lambda x: x.start_date)
+    # One client and limiter shared by every download thread so they all see the same rate limit usage
+    client = get_strava_client(rate_limiter=StravaRateLimiter(buffer=workers))
 
-        engine.dispose()
-        session.close()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        peloton_future = executor.submit(propagate(peloton_mapping_df))
+        stryd_future = executor.submit(propagate(get_stryd_df_summary)) if any(
+            'run' in x.type.lower() for x in new_activities) else None
+
+        # Only keep a few activities downloaded ahead of the insert stage to bound memory
+        pending = deque()
+        activities = iter(new_activities)
+        try:
+            for fitly_act in activities:
+                pending.append((fitly_act, executor.submit(propagate(fitly_act.fetch_streams), client)))
+                if len(pending) >= workers * 2:
+                    break
+            # Match every new activity to its peloton class in one pass
+            with track('match_peloton_titles'):
+                peloton_titles = match_peloton_titles(
+                    pd.DataFrame({'activity_id': [x.id for x in new_activities],
+                                  'start': [roundTime(x.start_date) for x in new_activities]}),
+                    peloton_future.result())
+            # Athlete ftp/weight/rhr history loaded once for every activity in this refresh
+            with track('athlete_timeline'):
+                timeline = AthleteTimeline(athlete_id, stryd_df=stryd_future.result() if stryd_future else None)
+            while pending:
+                fitly_act, future = pending.popleft()
+                future.result()
+                next_act = next(activities, None)
+                if next_act is not None:
+                    pending.append((next_act, executor.submit(propagate(next_act.fetch_streams), client)))
+                fitly_act.stravaScrape(athlete_id=athlete_id, peloton_titles=peloton_titles, timeline=timeline)
+        except BaseException:
+            # Don't keep downloading activities that will not be inserted
+            for fitly_act, future in pending:
+                future.cancel()
+            raise
 
+
+def pull_withings_stage(upstream):
     # Pull Weight Data
     try:
         dash_app.server.logger.info('Pulling withings data...')
-        pull_withings_data()
+        written = ['withings'] if pull_withings_data() > 0 else []
         withings_status = 'Successful'
     except BaseException as e:
         dash_app.server.logger.error('Error pulling withings data: {}'.format(e))
         withings_status = e
+        written = partly_written('withings')
+    bump_tables(written)
+    return withings_status
+
 
+def pull_fitbod_stage(upstream):
     # Pull Fitbod Data
     try:
         dash_app.server.logger.info('Pulling fitbod data...')
-        pull_fitbod_data()
+        written = ['fitbod', 'fitbod_daily_bests'] if pull_fitbod_data() > 0 else []
         fitbod_status = 'Successful'
     except BaseException as e:
-        dash_app.server.logger.error('Error pulling withings data: {}'.format(e))
+        dash_app.server.logger.error('Error pulling fitbod data: {}'.format(e))
         fitbod_status = e
+        written = partly_written('fitbod')
+    bump_tables(written)
+    return fitbod_status
+
 
-    # Pull Oura Data before strava because resting heart rate used in strava sample heart rate zones
+def pull_oura_stage(upstream):
+    # Pull Oura Data
     try:
         dash_app.server.logger.info('Pulling oura data...')
-        oura_status = pull_oura_data()
-        oura_status = 'Successful' if oura_status else 'Oura cloud not yet updated'
+        synced, written = pull_oura_data() or (False, [])
+        oura_status = 'Successful' if synced else 'Oura cloud not yet updated'
     except BaseException as e:
         dash_app.server.logger.error('Error pulling oura data: {}'.format(e))
         oura_status = e
+        written = partly_written('oura')
+    bump_tables(written)
+    return oura_status
 
+
+def pull_strava_stage(upstream):
     # Only pull strava data if oura cloud has been updated with latest day
+    if upstream['oura'] != 'Successful':
+        dash_app.server.logger.info('Oura cloud not yet updated. Waiting to pull Strava data')
+        return 'Awaiting oura cloud update'
 
     # Pull Strava Data
-    if oura_status == 'Successful':
-        try:
-            dash_app.server.logger.info('Pulling strava data...')
-
-            if strava_connected():
-                athlete_id = 1  # TODO: Make this dynamic if ever expanding to more users
-                client = get_strava_client()
-                after = config.get('strava', 'activities_after_date')
-                activities = client.get_activities(after=after, limit=0)  # Use after to sort from oldest to newest
-                session, engine = db_connect()
-                athlete_info = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
-                min_non_warmup_workout_time = athlete_info.min_non_warmup_workout_time
-                # Loop through the activities, and create a dict of the dataframe stream data of each activity
-                db_activities = pd.read_sql(
-                    sql=session.query(stravaSummary.activity_id).filter(
-                        stravaSummary.athlete_id == athlete_id).distinct(stravaSummary.activity_id).statement,
-                    con=engine)
-                engine.dispose()
-                session.close()
-                new_activities = []
-                for act in activities:
-                    # If not already in db, parse and insert
-                    if act.id not in db_activities['activity_id'].unique():
-                        new_activities.append(FitlyActivity(act))
-                        dash_app.server.logger.info('New Workout found: "{}"'.format(act.name))
-                # If new workouts found, analyze and insert
-                if len(new_activities) > 0:
-                    for fitly_act in new_activities:
-                        fitly_act.stravaScrape(athlete_id=athlete_id)
+    try:
+        dash_app.server.logger.info('Pulling strava data...')
+
+        if strava_connected():
+            athlete_id = 1  # TODO: Make this dynamic if ever expanding to more users
+            client = get_strava_client()
+            after = config.get('strava', 'activities_after_date')
+            activities = client.get_activities(after=after, limit=0)  # Use after to sort from oldest to newest
+            session, engine = db_connect()
+            athlete_info = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
+            min_non_warmup_workout_time = athlete_info.min_non_warmup_workout_time
+            # Loop through the activities, and create a dict of the dataframe stream data of each activity
+            db_activities = pd.read_sql(
+                sql=session.query(stravaSummary.activity_id).filter(
+                    stravaSummary.athlete_id == athlete_id).distinct(stravaSummary.activity_id).statement,
+                con=engine)
+            session.close()
+            new_activities = []
+            for act in activities:
+                # If not already in db, parse and insert
+                if act.id not in db_activities['activity_id'].unique():
+                    new_activities.append(FitlyActivity(act))
+                    dash_app.server.logger.info('New Workout found: "{}"'.format(act.name))
+            # If new workouts found, analyze and insert
+            if len(new_activities) > 0:
+                scrape_strava_activities(new_activities, athlete_id)
+                # Roll fitness/fatigue forward from the earliest new workout
+                dash_app.server.logger.info('Updating pmc_daily...')
+                with track('update_pmc_daily'):
+                    update_pmc_daily(athlete_id, from_date=min(x.start_date_local for x in new_activities).date())
+            with track('hrv_training_workflow'):
                 hrv_training_workflow(min_non_warmup_workout_time=min_non_warmup_workout_time)
 
-            dash_app.server.logger.debug('stravaScrape() complete...')
-            strava_status = 'Successful'
-        except BaseException as e:
-            dash_app.server.logger.error('Error pulling strava data: {}'.format(e))
-            strava_status = e
-    else:
-        dash_app.server.logger.info('Oura cloud not yet updated. Waiting to pull Strava data')
-        strava_status = 'Awaiting oura cloud update'
+        dash_app.server.logger.debug('stravaScrape() complete...')
+        strava_status = 'Successful'
+    except BaseException as e:
+        dash_app.server.logger.error('Error pulling strava data: {}'.format(e))
+        strava_status = e
+    # Strava writes to most of its tables for every new activity, so bump them all if anything was written
+    if rows_written() != 0:
+        bump_source_tables('strava')
+    return strava_status
+
+
+# Refresh stages as name: (function, stages it has to wait for). Each function is passed the statuses of the stages it
+# waits for and returns its own status. Strava reads the resting hr (oura), weight (withings) and 1rms (fitbod) as of
+# each workout, the provider pulls don't depend on each other so they run at the same time
+refresh_stages = {
+    'withings': (pull_withings_stage, []),
+    'fitbod': (pull_fitbod_stage, []),
+    'oura': (pull_oura_stage, []),
+    'strava': (pull_strava_stage, ['withings', 'fitbod', 'oura']),
+}
+
+
+# Stages given up on by an earlier refresh whose threads are still writing, as name: future. The scheduler's
+# max_instances only covers refresh_database itself, so a stage isn't started again until its previous run is done
+_still_running = {}
+_still_running_lock = threading.Lock()
+
+
+def run_refresh_stages(stages, metrics=None):
+    '''
+    Run each stage on a thread pool as soon as the stages it waits for have finished. A stage still running after its
+    timeout ([cron] <stage>_timeout_minutes) is given up on: it is recorded as timed out so the stages waiting for it
+    can go ahead, but the thread itself can't be stopped and finishes in the background. Until it does, later refreshes
+    skip that stage
+    :param stages: dict of name: (function, list of stage names to wait for), see refresh_stages
+    :param metrics: optional RefreshMetrics to record each stage in
+    :return: dict of name: status (string or the exception raised)
+    '''
+    timeouts = {name: config.getfloat('cron', name + '_timeout_minutes', fallback=30) * 60 for name in stages}
+    metrics = metrics if metrics is not None else RefreshMetrics()
+    status, running = {}, {}
+    executor = ThreadPoolExecutor(max_workers=len(stages))
+    try:
+        while len(status) < len(stages):
+            skipped = False
+            for name, (func, after) in stages.items():
+                if name not in status and name not in running and all(x in status for x in after):
+                    with _still_running_lock:
+                        previous = _still_running.get(name)
+                        if previous is not None and previous.done():
+                            del _still_running[name]
+                        elif previous is not None:
+                            dash_app.server.logger.error(
+                                '{} refresh from an earlier run is still running, skipping it'.format(name))
+                            status[name], skipped = 'Still running', True
+                            continue
+                    running[name] = (executor.submit(metrics.call, name, func, {x: status[x] for x in after}),
+                                     time.monotonic(), time.monotonic() + timeouts[name])
+            if skipped:
+                # Stages waiting on a skipped stage can start now
+                continue
+            if len(running) == 0:
+                raise ValueError('Refresh stages wait on each other or on a stage that does not exist: {}'.format(
+                    [x for x in stages if x not in status]))
+            wait([x[0] for x in running.values()], timeout=max(0, min([x[2] for x in running.values()]) -
+                                                                 time.monotonic()), return_when=FIRST_COMPLETED)
+            for name, (future, started, deadline) in list(running.items()):
+                if future.done():
+                    try:
+                        status[name] = future.result()
+                    except BaseException as e:
+                        status[name] = e
+                    dash_app.server.logger.info(
+                        '{} refresh finished in {:.1f}s'.format(name, time.monotonic() - started))
+                elif time.monotonic() >= deadline:
+                    dash_app.server.logger.error('{} refresh timed out, continuing without it'.format(name))
+                    status[name] = 'Timed out after {:g} minutes'.format(timeouts[name] / 60)
+                    with _still_running_lock:
+                        _still_running[name] = future
+                else:
+                    continue
+                del running[name]
+    finally:
+        # Don't hold up the refresh on stages that timed out
+        executor.shutdown(wait=False)
+    return status
+
+
+def refresh_database(process='system', truncate=False, truncateDate=None):
+    metrics = RefreshMetrics()
+    # If either truncate parameter is passed
+    if truncate or truncateDate:
+        with metrics.track('truncate'):
+            session, engine = db_connect()
+            # Everything stored per activity is deleted for exactly the summaries deleted, so no activity is left
+            # half loaded (start_date_local and start_date_utc fall either side of the cutoff for some activities)
+            truncated = None if not truncateDate else [x for (x,) in session.query(stravaSummary.activity_id).filter(
+                stravaSummary.start_date_utc >= truncateDate).all()]
+            try:
+                dash_app.server.logger.debug('Truncating strava_samples')
+                sample_store.delete(truncated)
+            except BaseException as e:
+                dash_app.server.logger.error(e)
+            # If only truncating past a certain date
+            if truncateDate:
+                try:
+                    dash_app.server.logger.debug('Truncating strava_summary')
+                    session.execute(delete(stravaSummary).where(stravaSummary.activity_id.in_(truncated)))
+                    dash_app.server.logger.debug('Truncating strava_mmp')
+                    session.execute(delete(stravaMeanMaxPower).where(stravaMeanMaxPower.activity_id.in_(truncated)))
+                    dash_app.server.logger.debug('Truncating strava_zone_seconds')
+                    session.execute(delete(stravaZoneSeconds).where(stravaZoneSeconds.activity_id.in_(truncated)))
+                    dash_app.server.logger.debug('Truncating oura_readiness_summary')
+                    session.execute(
+                        delete(ouraReadinessSummary).where(ouraReadinessSummary.report_date >= truncateDate))
+                    dash_app.server.logger.debug('Truncating oura_sleep_summary')
+                    session.execute(delete(ouraSleepSummary).where(ouraSleepSummary.report_date >= truncateDate))
+                    dash_app.server.logger.debug('Truncating oura_sleep_samples')
+                    session.execute(delete(ouraSleepSamples).where(ouraSleepSamples.report_date >= truncateDate))
+                    dash_app.server.logger.debug('Truncating oura_activity_summary')
+                    session.execute(delete(ouraActivitySummary).where(ouraActivitySummary.summary_date >= truncateDate))
+                    dash_app.server.logger.debug('Truncating oura_activity_samples')
+                    session.execute(
+                        delete(ouraActivitySamples).where(ouraActivitySamples.timestamp_local >= truncateDate))
+                    dash_app.server.logger.debug('Truncating hrv_workout_step_log')
+                    session.execute(delete(hrvWorkoutStepLog).where(hrvWorkoutStepLog.date >= truncateDate))
+                    dash_app.server.logger.debug('Truncating pmc_daily')
+                    session.execute(delete(pmcDaily).where(pmcDaily.date >= truncateDate))
+                    dash_app.server.logger.debug('Truncating withings')
+                    session.execute(delete(withings).where(withings.date_utc >= truncateDate))
+                    dash_app.server.logger.debug('Truncating ingest_hashes')
+                    clear_ingest_hashes(session, source_tables['oura'], since=truncateDate)
+                    session.commit()
+                except BaseException as e:
+                    session.rollback()
+                    dash_app.server.logger.error(e)
+            else:
+                try:
+                    dash_app.server.logger.debug('Truncating strava_summary')
+                    session.execute(delete(stravaSummary))
+                    dash_app.server.logger.debug('Truncating strava_mmp')
+                    session.execute(delete(stravaMeanMaxPower))
+                    dash_app.server.logger.debug('Truncating strava_zone_seconds')
+                    session.execute(delete(stravaZoneSeconds))
+                    dash_app.server.logger.debug('Truncating oura_readiness_summary')
+                    session.execute(delete(ouraReadinessSummary))
+                    dash_app.server.logger.debug('Truncating oura_sleep_summary')
+                    session.execute(delete(ouraSleepSummary))
+                    dash_app.server.logger.debug('Truncating oura_sleep_samples')
+                    session.execute(delete(ouraSleepSamples))
+                    dash_app.server.logger.debug('Truncating oura_activity_summary')
+                    session.execute(delete(ouraActivitySummary))
+                    dash_app.server.logger.debug('Truncating oura_activity_samples')
+                    session.execute(delete(ouraActivitySamples))
+                    dash_app.server.logger.debug('Truncating hrv_workout_step_log')
+                    session.execute(delete(hrvWorkoutStepLog))
+                    dash_app.server.logger.debug('Truncating pmc_daily')
+                    session.execute(delete(pmcDaily))
+                    dash_app.server.logger.debug('Truncating withings')
+                    session.execute(delete(withings))
+                    dash_app.server.logger.debug('Truncating ingest_hashes')
+                    clear_ingest_hashes(session, source_tables['oura'])
+                    session.commit()
+                except BaseException as e:
+                    session.rollback()
+                    dash_app.server.logger.error(e)
+
+            session.close()
+
+            # Efforts beaten by deleted activities have to come back into the power curve
+            try:
+                dash_app.server.logger.debug('Rebuilding power_curve_bests')
+                rebuild_power_curve_bests()
+            except BaseException as e:
+                dash_app.server.logger.error(e)
+            bump_source_tables(*source_tables.keys())
+
+    status = run_refresh_stages(refresh_stages, metrics)
 
     session, engine = db_connect()
     run_time = datetime.utcnow()
-    record = dbRefreshStatus(timestamp_utc=datetime.utcnow(), oura_status=oura_status,
-                             fitbod_status=fitbod_status,
-                             strava_status=strava_status, withings_status=withings_status, truncate=truncate,
-                             process=process)
+    record = dbRefreshStatus(timestamp_utc=run_time, oura_status=str(status['oura']),
+                             fitbod_status=str(status['fitbod']), strava_status=str(status['strava']),
+                             withings_status=str(status['withings']), truncate=truncate, process=process)
     # Insert and commit
     try:
         session.add(record)
@@ -170,9 +384,13 @@ def refresh_database(process='system', truncate=False, truncateDate=None):
         print('Failed to insert db refresh status:', str(e))
         dash_app.server.logger.error(e)
 
+    try:
+        metrics.write(run_time)
+    except BaseException as e:
+        dash_app.server.logger.error('Error inserting refresh stage metrics: {}'.format(e))
+
     dash_app.server.logger.info('Refresh Complete')
 
-    engine.dispose()
     session.close()
 
     return run_time
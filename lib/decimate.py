@@ -0,0 +1,88 @@
+import configparser
+import numpy as np
+import pandas as pd
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+# Points a high frequency line is reduced to, about the width (pixels) of the chart it is drawn on
+max_points = config.getint('charts', 'max_points', fallback=500)
+
+
+def _numeric(x):
+    # Datetimes as ns since epoch so they can be used in triangle areas
+    x = pd.Series(x)
+    if pd.api.types.is_datetime64_any_dtype(x):
+        return x.values.astype('datetime64[ns]').astype('int64').astype('float')
+    return x.values.astype('float')
+
+
+def lttb(x, y, n_out):
+    '''
+    Largest triangle three buckets: split the line into n_out - 2 buckets and keep the point of each that makes the
+    largest triangle with the point kept before it and the mean of the next bucket, which keeps the line's shape
+    :param x: ascending array-like of numbers or datetimes
+    :param y: array-like of values, nan is only kept where a whole bucket is nan
+    :param n_out: points to keep
+    :return: int array of the positions kept, ascending, always including the first and last point
+    '''
+    x, y = _numeric(x), np.asarray(y, dtype='float')
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    # Every point but the first and last falls in one of n_out - 2 buckets
+    edges = np.linspace(1, n - 1, n_out - 1).astype('int')
+    counts = np.diff(edges)
+    mean_x = np.add.reduceat(x[:-1], edges[:-1]) / counts
+    valid = ~np.isnan(y[:-1])
+    with np.errstate(invalid='ignore'):
+        mean_y = np.add.reduceat(np.where(valid, y[:-1], 0), edges[:-1]) / np.add.reduceat(valid, edges[:-1])
+    # The last bucket's third corner is the last point
+    mean_x, mean_y = np.append(mean_x[1:], x[-1]), np.append(mean_y[1:], y[-1])
+
+    kept = np.empty(n_out, dtype='int')
+    kept[0], kept[-1] = 0, n - 1
+    for i in range(n_out - 2):
+        start, end, a = edges[i], edges[i + 1], kept[i]
+        area = np.abs((x[a] - mean_x[i]) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (mean_y[i] - y[a]))
+        kept[i + 1] = start + np.argmax(np.where(np.isnan(area), -1, area))
+    return kept
+
+
+def min_max(y, n_out):
+    '''
+    Min/max envelope: the lowest and highest point of each of n_out / 2 buckets, so no peak or trough is lost
+    :param y: array-like of values, nan is only kept where a whole bucket is nan
+    :param n_out: points to keep
+    :return: int array of the positions kept, ascending
+    '''
+    y = np.asarray(y, dtype='float')
+    n = len(y)
+    if n_out >= n or n_out < 2:
+        return np.arange(n)
+    edges = np.linspace(0, n, n_out // 2 + 1).astype('int')
+    bucket = np.repeat(np.arange(len(edges) - 1), np.diff(edges))
+    # Sorted by bucket then value, the first of each bucket is its min and the last its max
+    lows = np.lexsort((np.where(np.isnan(y), np.inf, y), bucket))[edges[:-1]]
+    highs = np.lexsort((np.where(np.isnan(y), -np.inf, y), bucket))[edges[1:] - 1]
+    return np.union1d(lows, highs)
+
+
+def decimate(x, y, n_out=None, method='lttb', keep=None):
+    '''
+    Positions of a high frequency line worth plotting. The highest and lowest point are always kept exactly
+    :param x: ascending array-like of numbers or datetimes
+    :param y: array-like of values
+    :param n_out: points to reduce to, defaults to [charts] max_points
+    :param method: lttb for the shape of the line, min_max for an envelope of every bucket's extremes
+    :param keep: optional positions that must be kept (i.e. the edges of a highlighted interval)
+    :return: int array of positions, ascending, to select with .iloc
+    '''
+    n_out = max_points if n_out is None else n_out
+    y = np.asarray(y, dtype='float')
+    if len(y) <= n_out:
+        return np.arange(len(y))
+    positions = min_max(y, n_out) if method == 'min_max' else lttb(x, y, n_out)
+    extremes = [np.nanargmax(y), np.nanargmin(y)] if (~np.isnan(y)).any() else []
+    keep = np.asarray([] if keep is None else keep, dtype='int')
+    return np.union1d(positions, np.concatenate([extremes, keep[(keep >= 0) & (keep < len(y))]]).astype('int'))
@@ -1,7 +1,11 @@
 #! /usr/bin/env python
 import owncloud
 import os
-from lib.sqlalchemy_declarative import db_connect
+import re
+from sqlalchemy import func, inspect, text
+from lib.sqlalchemy_declarative import db_connect, fitbod
+from lib.fitbod_bests import migrate_fitbod_sets, update_daily_bests
+from lib.refresh_metrics import count_http
 import configparser
 import pandas as pd
 from dash_app import dash_app
@@ -11,12 +15,63 @@ config = configparser.ConfigParser()
 config.read('./config.ini')
 
 
+# Exercises in the export that are cardio, mobility or stretching rather than lifting
+non_lifting_exercises = ['Running', 'Cycling', 'Rowing', 'Elliptical', 'Stair Stepper', 'Foam', 'Cat Cow',
+                         "Child's Pose", 'Downward Dog', 'Up Dog', 'Stretch', 'Butt Kick', 'Chest Expansion',
+                         'Chin Drop', 'Crab Pose', 'Dead Hang', 'Head Tilt', 'Pigeon Pose', 'Reach Behind and Open',
+                         'Seated Figure Four', 'Seated Forward Bend', 'Standing Forward Bend', 'Shin Box Hip Flexor',
+                         'Shin Box Quad', 'Single Leg Straight Forward Bend', 'Standing Hip Circle', 'Walkout']
+# Matched anywhere in the exercise name, in a single pass over the column
+non_lifting_pattern = re.compile('|'.join([re.escape(x) for x in non_lifting_exercises]))
+
+
+def set_hashes(df):
+    '''
+    Content hash of each set, the same whether computed from the export or from rows already in the fitbod table.
+    Identical sets of the same workout are numbered so each keeps its own hash
+    :param df: sets with Date_UTC, Exercise, Reps, Weight (lbs), Duration, isWarmup and Note columns
+    :return: series of hex hashes aligned to df
+    '''
+    key = pd.DataFrame({'date': pd.to_datetime(df['Date_UTC']),
+                        'exercise': df['Exercise'].astype(str),
+                        'reps': pd.to_numeric(df['Reps']).fillna(0).astype('float'),
+                        # Stored as lbs, round off the float error of the kg conversion
+                        'weight': pd.to_numeric(df['Weight']).fillna(0).astype('float').round(3),
+                        'duration': pd.to_numeric(df['Duration']).fillna(0).astype('float'),
+                        'warmup': df['isWarmup'].astype(str).str.lower().isin(['true', '1', '1.0']),
+                        'note': df['Note'].fillna('').astype(str)}, index=df.index)
+    key['occurrence'] = key.groupby(list(key.columns), dropna=False).cumcount()
+    return pd.util.hash_pandas_object(key, index=False).map('{:016x}'.format)
+
+
+def hash_existing_sets(engine):
+    # fitbod tables loaded before sets were hashed have no set_hash column, add it and hash the rows already there
+    if 'set_hash' not in [x['name'] for x in inspect(engine).get_columns('fitbod')]:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE fitbod ADD COLUMN set_hash VARCHAR(40)'))
+            connection.execute(text('CREATE INDEX IF NOT EXISTS ix_fitbod_set_hash ON fitbod (set_hash)'))
+    with engine.begin() as connection:
+        if connection.execute(text('SELECT count(*) FROM fitbod WHERE set_hash IS NULL')).scalar() == 0:
+            return
+        dash_app.server.logger.info('Adding set hashes to fitbod table')
+        # Hashes number identical sets, so every row is rehashed rather than just the missing ones
+        df = pd.read_sql(sql=text('SELECT id, date_UTC AS Date_UTC, Exercise, Reps, Weight, Duration, isWarmup, Note '
+                                  'FROM fitbod ORDER BY id'), con=connection)
+        connection.execute(text('UPDATE fitbod SET set_hash = :set_hash WHERE id = :id'),
+                           [{'id': int(x), 'set_hash': y} for (x, y) in zip(df['id'], set_hashes(df))])
+
+
 def pull_fitbod_data():
-    # TODO: Update instead of truncate and load to only laod/delete new data as to preserve 1rm calculations
+    '''
+    Insert the sets of the fitbod export on nextcloud not already loaded
+    :return: number of sets inserted
+    '''
     dash_app.server.logger.debug('Logging into Nextcloud')
     oc = owncloud.Client(config.get('nextcloud', 'url'))
     # Login to NextCloud
     oc.login(config.get('nextcloud', 'username'), config.get('nextcloud', 'password'))
+    # The webdav session is only created by login
+    count_http(oc._session)
     # Get filename
     try:
         filepath = oc.list(config.get('fitbod', 'path'))[0].path
@@ -32,40 +87,7 @@ def pull_fitbod_data():
         df = pd.read_csv(filename)
 
         # Remove non-lifting exercises
-        df = df[df['Distance(m)'] == 0]
-
-        df = df[
-            (~df['Exercise'].str.contains('Running')) &
-            (~df['Exercise'].str.contains('Cycling')) &
-            (~df['Exercise'].str.contains('Rowing')) &
-            (~df['Exercise'].str.contains('Elliptical')) &
-            (~df['Exercise'].str.contains('Stair Stepper')) &
-            (~df['Exercise'].str.contains('Foam')) &
-            (~df['Exercise'].str.contains('Cat Cow')) &
-            (~df['Exercise'].str.contains("Child's Pose")) &
-            (~df['Exercise'].str.contains("Downward Dog")) &
-            (~df['Exercise'].str.contains("Up Dog")) &
-            (~df['Exercise'].str.contains("Stretch")) &
-            (~df['Exercise'].str.contains("Butt Kick")) &
-            (~df['Exercise'].str.contains("Chest Expansion")) &
-            (~df['Exercise'].str.contains("Chin Drop")) &
-            (~df['Exercise'].str.contains("Crab Pose")) &
-            (~df['Exercise'].str.contains("Dead Hang")) &
-            (~df['Exercise'].str.contains("Head Tilt")) &
-            (~df['Exercise'].str.contains("Pigeon Pose")) &
-            (~df['Exercise'].str.contains("Reach Behind and Open")) &
-            (~df['Exercise'].str.contains("Seated Figure Four")) &
-            (~df['Exercise'].str.contains("Seated Forward Bend")) &
-            (~df['Exercise'].str.contains("Standing Forward Bend")) &
-            (~df['Exercise'].str.contains("Shin Box Hip Flexor")) &
-            (~df['Exercise'].str.contains("Shin Box Quad")) &
-            (~df['Exercise'].str.contains("Single Leg Straight Forward Bend")) &
-            (~df['Exercise'].str.contains("Standing Hip Circle")) &
-            (~df['Exercise'].str.contains("Walkout")) &
-            (~df['Exercise'].str.contains("Walkout to Push Up"))
-
-
-        ]
+        df = df[(df['Distance(m)'] == 0) & (~df['Exercise'].str.contains(non_lifting_pattern))]
 
         # Create lbs column
         df['Weight'] = df['Weight(kg)'] * 2.20462
@@ -79,23 +101,28 @@ def pull_fitbod_data():
         # Remove unecessary columns
         df = df[['Date_UTC', 'Exercise', 'Reps', 'Weight', 'Duration', 'isWarmup', 'Note', 'one_rep_max',
                  'weight_duration_max']]
-        # TODO: Date currently is not unique to set - only unique to workout so should not be used as index
-        # df = df.set_index('Date_UTC')
-        df.index.name = 'id'
-        # DB Operations
+        # The export is the full history, only insert sets not already loaded so the 1rms wss_score() saved to the
+        # existing sets are kept
+        df['set_hash'] = set_hashes(df)
+        df['workout_date'] = df['Date_UTC'].dt.date
         session, engine = db_connect()
-        # Delete current database table
-        try:
-            session.execute('DROP TABLE fitbod')
-            session.commit()
-        except:
-            None
-        # Insert fitbod table into DB
-        df.to_sql('fitbod', engine, if_exists='append', index=True)
-        session.commit()
-        engine.dispose()
+        hash_existing_sets(engine)
+        migrate_fitbod_sets()
+        loaded = set([x for (x,) in session.query(fitbod.set_hash).all()])
+        next_id = (session.query(func.max(fitbod.id)).scalar() or 0) + 1
         session.close()
+        df = df[~df['set_hash'].isin(loaded)]
+        dash_app.server.logger.info('Inserting {} new fitbod sets'.format(len(df)))
+        if len(df) > 0:
+            # TODO: Date currently is not unique to set - only unique to workout so should not be used as index
+            # Ids are assigned here as tables created by earlier to_sql loads have no autoincrementing key
+            df.index = range(next_id, next_id + len(df))
+            df.index.name = 'id'
+            df.to_sql('fitbod', engine, if_exists='append', index=True)
+            update_daily_bests(df['workout_date'].unique().tolist())
         # Delete file in local folder
         os.remove(filename)
         # Empty the dir on nextcloud
-        oc.delete(filepath)
\ No newline at end of file
+        oc.delete(filepath)
+        return len(df)
+    return 0
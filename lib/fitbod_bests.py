@@ -0,0 +1,107 @@
+import pandas as pd
+from datetime import timedelta
+from sqlalchemy import delete, inspect, text
+from lib.sqlalchemy_declarative import db_session, db_insert, get_engine, fitbod, fitbodDailyBests
+from dash_app import dash_app
+
+# Trailing days of sets each workout's 1rms are estimated from
+one_rep_max_days = 180
+
+columns = ['Exercise', 'workout_date', 'set_id', 'Reps', 'Weight', 'Duration', 'Volume']
+
+_migrated = False
+
+
+def set_volume(df):
+    return df['Reps'].replace(0, 1) * df['Weight'].replace(0, 1) * df['Duration'].replace(0, 1)
+
+
+def best_sets(df, by):
+    # Highest volume set per group, the earliest set (lowest id) on ties as idxmax over the sets would pick
+    return df.sort_values(['Volume', 'set_id'], ascending=[False, True]).drop_duplicates(by)
+
+
+def migrate_fitbod_sets():
+    '''
+    Fill in workout_date on fitbod tables from older versions and build fitbod_daily_bests if it is empty
+    '''
+    global _migrated
+    if _migrated:
+        return
+    engine = get_engine()
+    if 'workout_date' not in [x['name'] for x in inspect(engine).get_columns('fitbod')]:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE fitbod ADD COLUMN workout_date DATE'))
+            connection.execute(text('CREATE INDEX IF NOT EXISTS ix_fitbod_workout_date ON fitbod (workout_date)'))
+    with engine.begin() as connection:
+        df = pd.read_sql(sql=text('SELECT id, date_UTC AS date_UTC FROM fitbod WHERE workout_date IS NULL'),
+                         con=connection)
+        if len(df) > 0:
+            dash_app.server.logger.info('Adding workout dates to fitbod table')
+            connection.execute(text('UPDATE fitbod SET workout_date = :workout_date WHERE id = :id'),
+                               [{'id': int(x), 'workout_date': str(y)} for (x, y) in
+                                zip(df['id'], pd.to_datetime(df['date_UTC']).dt.date)])
+            # Sets without a date were left out of the bests
+            connection.execute(delete(fitbodDailyBests))
+    with db_session() as session:
+        empty = session.query(fitbodDailyBests.exercise).first() is None
+    # Set before rebuilding as update_daily_bests() calls back in here
+    _migrated = True
+    if empty:
+        update_daily_bests()
+
+
+def update_daily_bests(days=None):
+    '''
+    Recompute fitbod_daily_bests for days whose sets were inserted
+    :param days: list of dates, None rebuilds every day
+    '''
+    migrate_fitbod_sets()
+    with db_session() as session:
+        query = session.query(fitbod.id.label('set_id'), fitbod.exercise, fitbod.workout_date, fitbod.reps,
+                              fitbod.weight, fitbod.duration)
+        if days is not None:
+            query = query.filter(fitbod.workout_date.in_(days))
+        df = pd.read_sql(sql=query.statement, con=session.bind)
+        if days is None:
+            session.execute(delete(fitbodDailyBests))
+        else:
+            session.execute(delete(fitbodDailyBests).where(fitbodDailyBests.workout_date.in_(days)))
+    if len(df) > 0:
+        df['Volume'] = set_volume(df)
+        db_insert(best_sets(df, ['Exercise', 'workout_date'])[columns].set_index(['Exercise', 'workout_date']),
+                  'fitbod_daily_bests')
+
+
+def trailing_bests(date):
+    '''
+    Best set of each exercise over the one_rep_max_days before (not including) date
+    :param date: workout date
+    :return: df with a row per exercise
+    '''
+    migrate_fitbod_sets()
+    with db_session() as session:
+        df = pd.read_sql(sql=session.query(fitbodDailyBests).filter(
+            fitbodDailyBests.workout_date >= date - timedelta(days=one_rep_max_days),
+            fitbodDailyBests.workout_date < date).statement, con=session.bind)
+    return best_sets(df, 'Exercise').reset_index(drop=True)
+
+
+def workout_sets(date):
+    # Every set logged on date
+    migrate_fitbod_sets()
+    with db_session() as session:
+        return pd.read_sql(sql=session.query(fitbod).filter(fitbod.workout_date == date).order_by(fitbod.id).statement,
+                           con=session.bind)
+
+
+def save_one_rep_maxes(df):
+    '''
+    Write the 1rms a workout was scored against back to its sets, in a single executemany
+    :param df: sets with id, one_rep_max and weight_duration_max columns
+    '''
+    with db_session() as session:
+        session.execute(text('UPDATE fitbod SET one_rep_max = :one_rep_max, '
+                             'weight_duration_max = :weight_duration_max WHERE id = :id'),
+                        [{'id': int(x), 'one_rep_max': float(y), 'weight_duration_max': int(z)} for (x, y, z) in
+                         zip(df['id'], df['one_rep_max'], df['weight_duration_max'])])
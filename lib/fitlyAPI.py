@@ -1,30 +1,74 @@
 from datetime import datetime, timedelta
 import numpy as np
-from lib.sqlalchemy_declarative import db_connect, ouraSleepSummary, withings, athlete, db_insert, stravaSummary, \
-    fitbod, hrvWorkoutStepLog
-from sqlalchemy import func, cast, Date
-from sweat.io.models.dataframes import WorkoutDataFrame, Athlete
+from lib.sqlalchemy_declarative import db_connect, db_session, ouraSleepSummary, withings, athlete, db_insert, \
+    stravaSummary, stravaMeanMaxPower, hrvWorkoutStepLog
+from sqlalchemy import func, delete
 from sweat.pdm import critical_power
 from sweat.metrics.core import weighted_average_power
 from sweat.metrics.power import *
 import stravalib
 from lib.stravaApi import get_strava_client
 from stravalib import unithelper
-from lib.pelotonApi import peloton_mapping_df, roundTime
-from lib.strydAPI import get_stryd_df_summary
+from lib.pelotonApi import peloton_mapping_df, match_peloton_titles, roundTime
+from lib.timeline import AthleteTimeline
+from lib.power_curve import update_power_curve_bests
+from lib.fitbod_bests import workout_sets, trailing_bests, save_one_rep_maxes
+from lib.hrv_plan import backfill_hrv_plan, append_hrv_plan
+from lib.sample_store import sample_store
+from lib.activity_data import write_zone_seconds
+from lib.refresh_metrics import tracked
+from lib.mmp import mean_max_power, pack_mmp, mmp_matrix, mmp_samples
+from lib.zones import classify_zones, power_zone_thresholds, heartrate_zone_thresholds, zone_intensity_seconds, \
+    ride_power_intensities, run_power_intensities, heartrate_intensities
 from dateutil.relativedelta import relativedelta
 from dash_app import dash_app
 
 types = ['time', 'latlng', 'distance', 'altitude', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'temp',
          'moving', 'grade_smooth']
 
+# In memory dtypes of the df_samples channels, enforced once built and whenever a channel is added
+sample_schema = {'time': 'int32', 'heartrate': 'int16', 'cadence': 'int16', 'watts': 'int16', 'moving': 'int8',
+                 'power_zone': 'int8', 'hr_zone': 'int8', 'distance': 'float32', 'altitude': 'float32',
+                 'velocity_smooth': 'float32', 'temp': 'float32', 'grade_smooth': 'float32', 'latitude': 'float32',
+                 'longitude': 'float32'}
 
-def calctime(time_sec, startdate):
+
+def sample_column(name, values):
+    '''
+    Cast a df_samples channel to its sample_schema dtype. Integer channels that still have gaps (only when a stream
+    has no values at all, everything else is interpolated) stay float32 so nan survives
+    :param name: channel name
+    :param values: array-like of the channel values
+    :return: numpy array
+    '''
+    dtype = np.dtype(sample_schema[name])
+    values = np.asarray(values, dtype='float')
+    if dtype.kind == 'i':
+        if np.isnan(values).any():
+            return values.astype('float32')
+        return np.rint(values).astype(dtype)
+    return values.astype(dtype)
+
+
+def constant_column(value, length):
+    # Same value on every sample (activity id, name...), categorical so it only costs a byte per sample
+    if value is None:
+        return pd.Categorical.from_codes(np.full(length, -1, dtype='int8'), categories=[])
+    return pd.Categorical.from_codes(np.zeros(length, dtype='int8'), categories=[value])
+
+
+def latlng_array(latlng):
+    '''
+    Split a latlng stream into an (n, 2) float array
+    :param latlng: list of [lat, lng] pairs
+    :return: numpy array of lat, lng with nan for samples without a position
+    '''
     try:
-        timestamp = startdate + timedelta(seconds=int(time_sec))
-    except BaseException as e:
-        timestamp = startdate
-    return timestamp
+        return np.asarray(latlng, dtype='float').reshape(-1, 2)
+    except (TypeError, ValueError):
+        # Stream with missing/malformed positions
+        return np.array([x if isinstance(x, list) and len(x) == 2 else [np.nan, np.nan] for x in latlng],
+                        dtype='float').reshape(-1, 2)
 
 
 class FitlyActivity(stravalib.model.Activity):
@@ -33,10 +77,13 @@ class FitlyActivity(stravalib.model.Activity):
         activity.__class__ = FitlyActivity
         return activity
 
-    def stravaScrape(self, athlete_id):
+    @tracked
+    def stravaScrape(self, athlete_id, peloton_titles=None, timeline=None):
+        # Reuse the refresh's timeline when given, otherwise load one just for this activity
+        timeline = timeline if timeline is not None else AthleteTimeline(athlete_id)
         # # Set up athlete for the workout
         dash_app.server.logger.debug('Activity id "{}": Assigning athlete id {}'.format(self.id, athlete_id))
-        self.assign_athlete(athlete_id)
+        self.assign_athlete(timeline)
         # Build activity samples df
         dash_app.server.logger.debug('Activity id "{}": Building df_samples'.format(self.id))
         self.build_df_samples()
@@ -45,16 +92,16 @@ class FitlyActivity(stravalib.model.Activity):
         self.build_df_summary()
         # Update strava names of peloton workouts
         dash_app.server.logger.debug('Activity id "{}": Pulling peloton title'.format(self.id))
-        self.write_peloton_title_to_strava()
+        self.write_peloton_title_to_strava(peloton_titles=peloton_titles)
         # Get FTP
         dash_app.server.logger.debug('Activity id "{}": Pulling ftp'.format(self.id))
-        self.get_ftp()
+        self.get_ftp(timeline)
         # Get most recent resting heart rate
         dash_app.server.logger.debug('Activity id "{}": Pulling resting hr'.format(self.id))
-        self.get_rest_hr()
+        self.get_rest_hr(timeline)
         # Get most recent weight
         dash_app.server.logger.debug('Activity id "{}": Pulling weight'.format(self.id))
-        self.get_weight()
+        self.get_weight(timeline)
         # Calculate power zones
         dash_app.server.logger.debug('Activity id "{}": Calculating power zones'.format(self.id))
         self.calculate_power_zones()
@@ -67,127 +114,52 @@ class FitlyActivity(stravalib.model.Activity):
         # Get summary analytics
         dash_app.server.logger.debug('Activity id "{}": Calculating summary analytics'.format(self.id))
         self.get_summary_analytics()
-        # Write strava_best_samples
+        # Write strava_mmp
         dash_app.server.logger.debug('Activity id "{}": Writing mean max power to DB'.format(self.id))
         self.compute_mean_max_power(dbinsert=True)
         # Write df_summary and df_samples to db
         dash_app.server.logger.debug('Activity id "{}": Writing df_summary and df_samples to DB'.format(self.id))
         self.write_dfs_to_db()
+        # Let later activities in this refresh see this one if it was an ftp test
+        timeline.record_activity(self.start_date_local, self.type, self.name, self.average_watts)
 
-    def assign_athlete(self, athlete_id):
-        session, engine = db_connect()
-        athlete_info = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
-        engine.dispose()
-        session.close()
-        self.athlete_id = athlete_id
+    def assign_athlete(self, timeline):
+        athlete_info = timeline.athlete
+        self.athlete_id = timeline.athlete_id
         self.athlete_name = athlete_info.name
         self.athlete_sex = athlete_info.sex
         self.athlete_birthday = athlete_info.birthday
-        self.hearrate_zones = {
-            1: float(athlete_info.hr_zone_threshold_1),
-            2: float(athlete_info.hr_zone_threshold_2),
-            3: float(athlete_info.hr_zone_threshold_3),
-            4: float(athlete_info.hr_zone_threshold_4)
-        }
-        if 'ride' in self.type.lower():
-            self.power_zones = {
-                1: float(athlete_info.cycle_power_zone_threshold_1),
-                2: float(athlete_info.cycle_power_zone_threshold_2),
-                3: float(athlete_info.cycle_power_zone_threshold_3),
-                4: float(athlete_info.cycle_power_zone_threshold_4),
-                5: float(athlete_info.cycle_power_zone_threshold_5),
-                6: float(athlete_info.cycle_power_zone_threshold_6)
-            }
-        elif 'run' in self.type.lower():
-            self.power_zones = {
-                1: float(athlete_info.run_power_zone_threshold_1),
-                2: float(athlete_info.run_power_zone_threshold_2),
-                3: float(athlete_info.run_power_zone_threshold_3),
-                4: float(athlete_info.run_power_zone_threshold_4)
-            }
-
-    def write_peloton_title_to_strava(self):
-        ## Assumes recorded ride is started within 5 minutes of peloton video
-        client = get_strava_client()
-        peloton_df = peloton_mapping_df()
-        start = roundTime(self.start_date)
-        activity = peloton_df[
-            (peloton_df['start'] >= (start - timedelta(minutes=5))) & (
-                    peloton_df['start'] <= (start + timedelta(minutes=5)))]
-        if len(activity) > 0:
-            self.peloton_title = activity.name.values[0]
+        self.hearrate_zones = timeline.heartrate_zones()
+        power_zones = timeline.power_zones(self.type)
+        if power_zones is not None:
+            self.power_zones = power_zones
+
+    @tracked
+    def write_peloton_title_to_strava(self, peloton_titles=None):
+        # peloton_titles is the activity_id: title dict matched for the whole refresh by datapull
+        if peloton_titles is None:
+            peloton_titles = match_peloton_titles(
+                pd.DataFrame({'activity_id': [self.id], 'start': [roundTime(self.start_date)]}), peloton_mapping_df())
+        if self.id in peloton_titles:
+            self.peloton_title = peloton_titles[self.id]
+            client = get_strava_client()
             client.update_activity(activity_id=self.id, name=self.peloton_title)
 
-    def get_rest_hr(self):
+    def get_rest_hr(self, timeline):
         # TODO: Build this out so hearrate data can be pulled from other data sources, and resort to athlete table if no source is connected that contains weight data
         # Assign rhr to activities by their start date
-        session, engine = db_connect()
-        # Try grabbing last resting heartrate from oura
-        hr_lowest = session.query(ouraSleepSummary.hr_lowest).filter(
-            ouraSleepSummary.report_date <= self.start_date.date()).order_by(
-            ouraSleepSummary.report_date.desc()).first()
-
-        # If activity is prior to first oura data record, use first oura data record
-        if not hr_lowest:
-            hr_lowest = session.query(ouraSleepSummary.hr_lowest).order_by(ouraSleepSummary.report_date.asc()).first()
-
-        # Resort to manaully entered static athlete resting heartrate if no data source to pull from
-        if not hr_lowest:
-            hr_lowest = session.query(athlete.resting_hr).filter(athlete.athlete_id == self.athlete_id).first()
+        self.hr_lowest = timeline.resting_hr(self.start_date)
 
-        engine.dispose()
-        session.close()
-        self.hr_lowest = hr_lowest[0]
-
-    def get_weight(self):
+    def get_weight(self, timeline):
         # TODO: Build this out so weight data can be pulled from other data sources, and resort to athlete table if no source is connected that contains weight data
-        session, engine = db_connect()
-
-        # Try grabbing last weight in withings before current workout
-        weight = session.query(withings.weight).filter(withings.date_utc <= self.start_date).order_by(
-            withings.date_utc.desc()).first()
-        # Else try getting most recent weight from withings
-        if not weight:
-            weight = session.query(withings.weight).order_by(withings.date_utc.asc()).first()
-        # If no weights in withings, resort to manually entered static weight from athlete table
-        if not weight:
-            weight = session.query(athlete.weight_lbs).filter(athlete.athlete_id == self.athlete_id).first()
-        engine.dispose()
-        session.close()
-
-        weight = float(weight[0])
+        weight = timeline.weight(self.start_date)
         self.weight = weight
         self.kg = weight * 0.453592
 
-    def get_ftp(self):
+    def get_ftp(self, timeline):
         # TODO: Update with auto calculated critical power so users do not have to flag (or take) FTP tests
-        if 'run' in self.type.lower():
-            stryd_df = get_stryd_df_summary()
-            stryd_df = stryd_df[stryd_df.index <= self.start_date_local]
-            try:
-                self.ftp = stryd_df.loc[stryd_df.index.max()].stryd_ftp
-            except:
-                # If no FTP test prior to current activity
-                self.ftp = 223
-
-        elif 'ride' in self.type.lower():
-            # TODO: Switch over to using Critical Power for everything once we get the critical power model working
-            session, engine = db_connect()
-            try:
-                self.ftp = float(
-                    session.query(stravaSummary.average_watts).order_by(stravaSummary.start_date_local.desc()).filter(
-                        stravaSummary.start_date_local < self.start_date_local,
-                        stravaSummary.type.ilike('%ride%'),
-                        stravaSummary.name.ilike('%ftp test%')).first()[0]) * .95
-            except:
-                # If no FTP test prior to current activity
-                self.ftp = 211
-
-        else:
-            self.ftp = None
-
-        if self.ftp is not None:
-            self.ftp = None if float(self.ftp) == 0.0 else self.ftp
+        # TODO: Switch over to using Critical Power for everything once we get the critical power model working
+        self.ftp = timeline.ftp(self.start_date_local, self.type)
 
     def wss_score(self):
         '''
@@ -207,42 +179,27 @@ class FitlyActivity(stravalib.model.Activity):
 
         # Convert pd date to datetime to compare in sqlalchemy queries
         date = self.start_date.date()
-        # Query exercises within trailing 6 weeks of exercise date
-        session, engine = db_connect()
-        df = pd.read_sql(
-            sql=session.query(fitbod).filter(
-                (date - timedelta(days=180)) <= cast(fitbod.date_utc, Date),
-                cast(fitbod.date_utc, Date) <= date
-            ).statement, con=engine).sort_index(ascending=True)
-        engine.dispose()
-        session.close()
+        df = workout_sets(date)
 
         # If no workout data found, return None as a WSS score can not be generated
         if len(df) == 0:
             return None, None
 
         else:
-            df['Volume'] = df['Reps'].replace(0, 1) * df['Weight'].replace(0, 1) * df['Duration'].replace(0, 1)
-            # Get 'Best' sets on all exercises in the 6 weeks preceeding current workout being analyzed
-            df_1rm = df.copy()
-            # Dont include current workout to get 1RMs to compare against
-            df_1rm = df_1rm[df_1rm['date_UTC'] != date]
-            df_1rm = df_1rm.loc[df_1rm.groupby('Exercise')['Volume'].agg(pd.Series.idxmax)].reset_index()
-            # Calculate Brzycki 1RM based off last 6 weeks of workouts
+            # Get 'Best' sets on all exercises in the 6 months preceeding current workout being analyzed
+            df_1rm = trailing_bests(date)
+            # Calculate Brzycki 1RM based off last 6 months of workouts
             df_1rm['one_rep_max'] = (df_1rm['Weight'] * (36 / (37 - df_1rm['Reps'])))
 
             # TODO: Update from just adding 30% to max to a more accurate 1 'rep' max formula
             # Calculate max weight_duration for intensity on timed exercises that could use weights (i.e. planks) (+30% on max weight_duratopm)
-            df_1rm.at[df_1rm['Reps'] == 0, 'weight_duration_max'] = (df_1rm['Weight'].replace(0, 1) * df_1rm[
+            df_1rm.loc[df_1rm['Reps'] == 0, 'weight_duration_max'] = (df_1rm['Weight'].replace(0, 1) * df_1rm[
                 'Duration'].replace(0, 1)) * 1.3
             # Calculate max reps (for bodyweight exercises) (+30% on max reps)
-            df_1rm.at[df_1rm['Weight'] == 0, 'max_reps'] = df_1rm['Volume'] * 1.3
-
-            # Filter main df back to current workout which we are assigning 1rms to
+            df_1rm.loc[df_1rm['Weight'] == 0, 'max_reps'] = df_1rm['Volume'] * 1.3
 
-            df = df[df['date_UTC'] == date]
             # Merge in 1rms
-            df = df.merge(df_1rm[['Exercise', 'one_rep_max', 'weight_duration_max']], how='left',
+            df = df.merge(df_1rm.reindex(columns=['Exercise', 'one_rep_max', 'weight_duration_max']), how='left',
                           left_on='Exercise',
                           right_on='Exercise')
 
@@ -251,31 +208,21 @@ class FitlyActivity(stravalib.model.Activity):
             df['weight_duration_max'] = df['weight_duration_max_y'].fillna(0)
 
             # Save 1rms to fitbod table
-            session, engine = db_connect()
-            for exercise in df[~np.isnan(df['one_rep_max'])]['Exercise'].drop_duplicates():
-                records = session.query(fitbod).filter(cast(fitbod.date_utc, Date) == date,
-                                                       fitbod.exercise == exercise).all()
-                for record in records:
-                    record.one_rep_max = float(df.loc[df['Exercise'] == exercise]['one_rep_max'].values[0])
-                    record.weight_duration_max = int(
-                        df.loc[df['Exercise'] == exercise]['weight_duration_max'].values[0])
-                    session.commit()
-            engine.dispose()
-            session.close()
+            save_one_rep_maxes(df)
 
             df['set_intensity'] = df['Weight'] / df['one_rep_max']
             # Restrict max intensity from being 1 or greater for INOL calc
-            df.at[df['set_intensity'] >= 1, 'set_intensity'] = .99
+            df.loc[df['set_intensity'] >= 1, 'set_intensity'] = .99
 
             # Set all inol to base INOLs so score gets applied to bodyweight exercises
             df['inol'] = base_inol
             # Calculate INOL where one_rep_max's exist in last 6 weeks
-            df.at[((df['Weight'] != 0) & (df['one_rep_max'] != 0)), 'inol'] = df['Reps'] / (
+            df.loc[((df['Weight'] != 0) & (df['one_rep_max'] != 0)), 'inol'] = df['Reps'] / (
                     (1 - (df['set_intensity'])) * 100)
 
             # If one rep max was hit, set the exercise inol to max inol per exercise
-            df = df.groupby(['date_UTC', 'Exercise']).sum().reset_index()
-            df.at[(df['inol'] > max_inol_per_exercise), 'inol'] = max_inol_per_exercise
+            df = df.groupby(['date_UTC', 'Exercise']).sum(numeric_only=True).reset_index()
+            df.loc[(df['inol'] > max_inol_per_exercise), 'inol'] = max_inol_per_exercise
 
             # ## Doesn't Work well with INOL Formula since both reps and weight are really required for it to work
             # # For bodyweight exercise, there is no weight, so use reps/max reps for intensity
@@ -308,6 +255,7 @@ class FitlyActivity(stravalib.model.Activity):
             # return df['wSS'].sum()
             return workout_tss, ri
 
+    @tracked
     def get_summary_analytics(self):
         self.trimp, self.hrss, self.wap, self.tss, self.ri, self.variability_index, self.efficiency_factor = None, None, None, None, None, None, None
         activity_length = self.df_samples['time'].max()
@@ -317,7 +265,7 @@ class FitlyActivity(stravalib.model.Activity):
             self.tss, self.ri = self.wss_score()
 
         elif self.max_watts is not None and self.ftp is not None:
-            self.wap = weighted_average_power(self.df_samples['watts'].to_numpy())
+            self.wap = weighted_average_power(self.df_samples['watts'].to_numpy(dtype='float'))
             self.ri = relative_intensity(self.wap, self.ftp)
             self.tss = stress_score(self.wap, self.ftp, activity_length)
             self.variability_index = self.wap / self.df_samples['watts'].mean()
@@ -325,16 +273,16 @@ class FitlyActivity(stravalib.model.Activity):
         if self.max_heartrate is not None:
             # Calculate heartrate metrics
             athlete_lthr = .89 * self.athlete_max_hr
-            self.df_samples['hrr'] = self.df_samples['heartrate'].apply(
-                lambda x: (x - self.hr_lowest) / (self.athlete_max_hr - self.hr_lowest))
-            self.trimp = ((1 / 60) * self.df_samples['hrr'] * (0.64 * np.exp(1.92 * self.df_samples['hrr']))).sum()
+            hrr = (self.df_samples['heartrate'].to_numpy(dtype='float') - self.hr_lowest) / (
+                    self.athlete_max_hr - self.hr_lowest)
+            self.trimp = np.nansum((1 / 60) * hrr * (0.64 * np.exp(1.92 * hrr)))
             athlete_hrr_lthr = (athlete_lthr - self.hr_lowest) / (self.athlete_max_hr - self.hr_lowest)
             self.hrss = (self.trimp / (60 * athlete_hrr_lthr * (0.64 * np.exp(1.92 * athlete_hrr_lthr)))) * 100
-            self.df_samples = self.df_samples.drop(columns='hrr')
 
         if self.max_heartrate is not None and self.wap is not None:
             self.efficiency_factor = self.wap / self.df_samples['heartrate'].mean()
 
+    @tracked
     def build_df_summary(self):
         self.df_summary = pd.DataFrame()
         self.df_summary['activity_id'] = [self.id]
@@ -383,32 +331,36 @@ class FitlyActivity(stravalib.model.Activity):
         self.df_summary['type'] = [self.type]
         self.df_summary.set_index(['start_date_utc'], inplace=True)
 
+    @tracked
+    def fetch_streams(self, client=None):
+        # Network only, so can be run ahead of time on a download thread (see datapull.scrape_strava_activities)
+        client = client if client is not None else get_strava_client()
+        self.streams = client.get_activity_streams(self.id, types=types)
+        return self
+
+    @tracked
     def build_df_samples(self):
         seconds = 1
-        streams = get_strava_client().get_activity_streams(self.id, types=types)
-        self.df_samples = pd.DataFrame(columns=types)
-        # Write each row to a dataframe
+        if getattr(self, 'streams', None) is None:
+            self.fetch_streams()
+        streams = self.streams
+        # Typed arrays straight from the raw stream data, only for the streams the activity has
+        channels = {}
         for item in types:
-            if item in streams.keys():
-                self.df_samples[item] = pd.Series(streams[item].data, index=None)
-        self.df_samples['start_date_local'] = self.start_date_local
-        self.df_samples['timestamp_local'] = pd.Series(
-            map(calctime, self.df_samples['time'], self.df_samples['start_date_local']))
-        self.df_samples.set_index('timestamp_local', inplace=True)
-
-        # Parse latlngs into seperate columns
-        try:
-            self.df_samples['latitude'] = self.df_samples['latlng'].apply(
-                lambda x: x[0] if isinstance(x, list) else None).apply(
-                pd.to_numeric,
-                errors='coerce')
-            self.df_samples['longitude'] = self.df_samples['latlng'].apply(
-                lambda x: x[1] if isinstance(x, list) else None).apply(
-                pd.to_numeric,
-                errors='coerce')
-        except KeyError:
-            self.df_samples['latitude'] = None
-            self.df_samples['longitude'] = None
+            if item not in streams.keys():
+                continue
+            elif item == 'latlng':
+                latlng = latlng_array(streams[item].data)
+                channels['latitude'] = latlng[:, 0]
+                channels['longitude'] = latlng[:, 1]
+            else:
+                channels[item] = np.asarray(streams[item].data, dtype='float')
+        # Raw streams no longer needed once in df_samples
+        self.streams = None
+        self.df_samples = pd.DataFrame({k: pd.Series(v) for (k, v) in channels.items()})
+        # Samples without a time fall back to the start of the activity
+        self.df_samples.index = pd.DatetimeIndex(pd.Timestamp(self.start_date_local) + pd.to_timedelta(
+            np.trunc(self.df_samples['time']).fillna(0), unit='s'), name='timestamp_local')
 
         # Interpolate samples - each workout in samples data should already be at 1s intervals, calling resample fills in gaps so mean() does not matter
         self.df_samples = self.df_samples.resample(str(seconds) + 'S').mean()
@@ -418,7 +370,7 @@ class FitlyActivity(stravalib.model.Activity):
         try:  # Indoor activity samples wont have altitudes
             self.df_samples['altitude'] = self.df_samples['altitude'] * 3.28084
         except KeyError:
-            self.df_samples['altitude'] = None
+            self.df_samples['altitude'] = np.nan
 
         try:
             # Convert celcius to farenheit
@@ -438,148 +390,85 @@ class FitlyActivity(stravalib.model.Activity):
             pass
 
         # Add Time Interval
-        epoch = pd.to_datetime('1970-01-01')
-        self.df_samples['time_interval'] = self.df_samples['time'].astype('int').apply(
-            lambda x: epoch + timedelta(seconds=x))
+        self.df_samples['time_interval'] = pd.to_datetime('1970-01-01') + pd.to_timedelta(
+            self.df_samples['time'].astype('int'), unit='s')
+
+        for column in self.df_samples.columns:
+            if column in sample_schema:
+                self.df_samples[column] = sample_column(column, self.df_samples[column])
 
         # Add date column
-        self.df_samples['date'] = self.df_samples.index.date
+        self.df_samples['date'] = pd.Categorical(self.df_samples.index.date)
         # Add activity id and name back in
-        self.df_samples['activity_id'] = self.id
-        self.df_samples['act_name'] = self.name
+        self.df_samples['activity_id'] = constant_column(self.id, len(self.df_samples))
+        self.df_samples['act_name'] = constant_column(self.name, len(self.df_samples))
 
+    @tracked
     def calculate_power_zones(self):
         if self.max_watts is not None:
             if self.ftp is not None:
-                if 'ride' in self.type.lower():
-                    pz_5, pz_6 = self.power_zones[5], self.power_zones[6]
-                elif 'run' in self.type.lower():
-                    pz_5, pz_6 = 99, 99
-                self.df_samples['power_zone'] = np.nan
-
-                for i in self.df_samples.index:
-                    watts = self.df_samples.loc[i].watts
-                    if watts is not None:
-                        if watts <= round(self.ftp * self.power_zones[1]):
-                            self.df_samples.at[i, 'power_zone'] = 1
-                        elif watts <= round(self.ftp * self.power_zones[2]):
-                            self.df_samples.at[i, 'power_zone'] = 2
-                        elif watts <= round(self.ftp * self.power_zones[3]):
-                            self.df_samples.at[i, 'power_zone'] = 3
-                        elif watts <= round(self.ftp * self.power_zones[4]):
-                            self.df_samples.at[i, 'power_zone'] = 4
-                        elif watts <= round(self.ftp * pz_5):
-                            self.df_samples.at[i, 'power_zone'] = 5
-                        elif watts <= round(self.ftp * pz_6):
-                            self.df_samples.at[i, 'power_zone'] = 6
-                        else:
-                            self.df_samples.at[i, 'power_zone'] = 7
-                    else:
-                        return np.nan
+                thresholds = power_zone_thresholds(self.ftp, self.power_zones, self.type)
+                self.df_samples['power_zone'] = sample_column('power_zone',
+                                                              classify_zones(self.df_samples['watts'], thresholds))
 
+    @tracked
     def calculate_heartate_zones(self):
         if self.max_heartrate is not None:
             age = relativedelta(datetime.today(), self.athlete_birthday).years
             self.athlete_max_hr = 220 - age
             self.rhr = self.hr_lowest
             self.hrr = self.athlete_max_hr - self.rhr
-            z1 = round((self.hrr * self.hearrate_zones[1]) + self.rhr)
-            z2 = round((self.hrr * self.hearrate_zones[2]) + self.rhr)
-            z3 = round((self.hrr * self.hearrate_zones[3]) + self.rhr)
-            z4 = round((self.hrr * self.hearrate_zones[4]) + self.rhr)
-
-            self.df_samples['hr_zone'] = np.nan
-            for i in self.df_samples.index:
-                heartrate = self.df_samples.loc[i].heartrate
-                if heartrate is not None:
-                    if heartrate <= z1:
-                        self.df_samples.at[i, 'hr_zone'] = 1
-                    elif heartrate <= z2:
-                        self.df_samples.at[i, 'hr_zone'] = 2
-                    elif heartrate <= z3:
-                        self.df_samples.at[i, 'hr_zone'] = 3
-                    elif heartrate <= z4:
-                        self.df_samples.at[i, 'hr_zone'] = 4
-                    else:
-                        self.df_samples.at[i, 'hr_zone'] = 5
-                else:
-                    return np.nan
+            thresholds = heartrate_zone_thresholds(self.rhr, self.hrr, self.hearrate_zones)
+            self.df_samples['hr_zone'] = sample_column('hr_zone', classify_zones(self.df_samples['heartrate'], thresholds))
 
+    @tracked
     def calculate_zone_intensities(self):
-        df_zone_intensities = self.df_samples.copy()
-        df_zone_intensities = df_zone_intensities[df_zone_intensities['time'] != 0]
         # Check if power data, if not use heartrate data
         metric = 'power' if self.max_watts is not None and self.ftp is not None else 'heartrate' if self.max_heartrate is not None else 'none'
-
-        for i in df_zone_intensities.index:
-            # Check if power or heartrate data
-            if metric == 'power':
-                # If power data, check if run zones or ride zones should be used
-                if 'run' in self.type.lower():
-                    df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                          i, 'power_zone'] in [1,
-                                                                                               2] else 'med' if \
-                        df_zone_intensities.at[i, 'power_zone'] == 3 else 'high' if \
-                        df_zone_intensities.at[
-                            i, 'power_zone'] in [4, 5] else None
-                elif 'ride' in self.type.lower():
-                    df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                          i, 'power_zone'] in [1, 2,
-                                                                                               3] else 'med' if \
-                        df_zone_intensities.at[i, 'power_zone'] == 4 else 'high' if \
-                        df_zone_intensities.at[
-                            i, 'power_zone'] in [5, 6, 7] else None
-            elif metric == 'heartrate':
-                df_zone_intensities.at[i, 'intensity'] = 'low' if df_zone_intensities.at[
-                                                                      i, 'hr_zone'] in [1,
-                                                                                        2] else 'med' if \
-                    df_zone_intensities.at[i, 'hr_zone'] == 3 else 'high' if df_zone_intensities.at[
-                                                                                 i, 'hr_zone'] in [4,
-                                                                                                   5] else None
-        if 'intensity' in df_zone_intensities.columns:
-            intensity_seconds = df_zone_intensities['intensity'].value_counts()
-            try:
-                self.df_summary['low_intensity_seconds'] = [intensity_seconds.low]
-            except AttributeError:
-                self.df_summary['low_intensity_seconds'] = None
-            try:
-                self.df_summary['med_intensity_seconds'] = [intensity_seconds.med]
-            except AttributeError:
-                self.df_summary['med_intensity_seconds'] = None
-            try:
-                self.df_summary['high_intensity_seconds'] = [intensity_seconds.high]
-            except AttributeError:
-                self.df_summary['high_intensity_seconds'] = None
-
+        zone_column, intensities = None, None
+        if metric == 'power':
+            # If power data, check if run zones or ride zones should be used
+            zone_column = 'power_zone'
+            if 'run' in self.type.lower():
+                intensities = run_power_intensities
+            elif 'ride' in self.type.lower():
+                intensities = ride_power_intensities
+        elif metric == 'heartrate':
+            zone_column = 'hr_zone'
+            intensities = heartrate_intensities
+
+        if intensities is not None:
+            zones = self.df_samples.loc[self.df_samples['time'] != 0, zone_column]
+            intensity_seconds = zone_intensity_seconds(zones, intensities)
+            self.df_summary['low_intensity_seconds'] = [intensity_seconds['low']]
+            self.df_summary['med_intensity_seconds'] = [intensity_seconds['med']]
+            self.df_summary['high_intensity_seconds'] = [intensity_seconds['high']]
+
+    @tracked
     def compute_mean_max_power(self, dbinsert=False):
         if self.max_watts is not None:
-            df = self.df_samples.copy()
-            df = df.rename(columns={"watts": "power", "velocity_smooth": "speed"})
-            self.mmp_df = pd.Series(WorkoutDataFrame(df).compute_mean_max_power(), name='mmp').to_frame()
+            self.mmp_df = pd.Series(mean_max_power(self.df_samples['watts']), name='mmp').to_frame()
             # Update time index so it starts at 1 second (instead of 0)
             self.mmp_df['time'] = [x for x in range(1, len(self.mmp_df) + 1)]
             self.mmp_df.set_index('time', inplace=True)
             if dbinsert:
-                df = self.df_samples.copy()
-                df.rename(columns={'time': 'interval'}, inplace=True)
-                for col in ['distance', 'velocity_smooth', 'heartrate', 'cadence', 'watts', 'moving', 'grade_smooth',
-                            'latitude', 'longitude', 'altitude', 'power_zone', 'hr_zone', 'temp']:
-                    if col in df.columns:
-                        df = df.drop(columns=col)
-                df = df[df['interval'] != 0]
-                df['mmp'] = df['interval'].map(self.mmp_df['mmp'].to_dict())
-                df['watts_per_kg'] = df['mmp'] / self.kg
-                df['timestamp_local'] = df.index
-                df['type'] = self.type
-                df['athlete_id'] = self.athlete_id
-                df.set_index(['activity_id', 'interval'], inplace=True)
-                db_insert(df, 'strava_best_samples')
+                df = pd.DataFrame({'activity_id': [self.id], 'athlete_id': [self.athlete_id], 'type': [self.type],
+                                   'start_date_local': [self.start_date_local],
+                                   'mmp': [pack_mmp(self.mmp_df['mmp'])]})
+                # Replace the curve of an activity loaded before, strava_mmp is keyed on activity_id
+                with db_session() as session:
+                    session.execute(delete(stravaMeanMaxPower).where(stravaMeanMaxPower.activity_id == self.id))
+                db_insert(df.set_index('activity_id'), 'strava_mmp')
+                # Merge with the stored (float32) values so power_curve_bests matches a rebuild
+                update_power_curve_bests(
+                    mmp_samples(df.assign(weight=self.weight), mmp_matrix(df['mmp'])).reset_index(drop=True))
 
     def sweatpy_cp_model(self, model='3_parameter_non_linear'):
         # Models that can be passed = '2_parameter_non_linear', '3_parameter_non_linear', 'extended_5_3','extended_7_3'
         # Run CP model to return fitted params
         return critical_power.model_fit(self.mmp_df.index, self.mmp_df['mmp'], model=model)
 
+    @tracked
     def write_dfs_to_db(self):
         # Add athlete_id to df_summary
         self.df_summary['athlete_id'] = [self.athlete_id]
@@ -593,11 +482,12 @@ class FitlyActivity(stravalib.model.Activity):
         self.df_summary['weighted_average_power'] = [self.wap]
         self.df_summary['weight'] = [self.weight]
         # Add other columns to samples df
-        self.df_samples['type'] = self.type
-        self.df_samples['athlete_id'] = self.athlete_id
+        self.df_samples['type'] = constant_column(self.type, len(self.df_samples))
+        self.df_samples['athlete_id'] = constant_column(self.athlete_id, len(self.df_samples))
 
         db_insert(self.df_summary.fillna(np.nan), 'strava_summary')
-        db_insert(self.df_samples.fillna(np.nan), 'strava_samples')
+        sample_store.write(self.id, self.df_samples)
+        write_zone_seconds(self.id, self.start_date_local, self.df_samples)
 
 
 def hrv_training_workflow(min_non_warmup_workout_time, athlete_id=1):
@@ -605,26 +495,14 @@ def hrv_training_workflow(min_non_warmup_workout_time, athlete_id=1):
     Query db for oura hrv data, calculate rolling 7 day average, generate recommended workout and store in db.
     Once stored, continuously check if workout has been completed and fill in 'Compelted' field
     '''
-
-    # https://www.trainingpeaks.com/coach-blog/new-study-widens-hrv-evidence-for-more-athletes/
-
     session, engine = db_connect()
 
     # Check if entire table is empty, if so the earliest hrv plan can start is after 30 days of hrv readings
-    db_test = pd.read_sql(
-        sql=session.query(hrvWorkoutStepLog).filter(hrvWorkoutStepLog.athlete_id == athlete_id).statement,
-        con=engine, index_col='date')
-
-    if len(db_test) == 0:
-        min_oura_date = session.query(func.min(ouraSleepSummary.report_date))[0][0]
-        db_test.at[pd.to_datetime(min_oura_date + timedelta(29)), 'athlete_id'] = athlete_id
-        db_test.at[pd.to_datetime(min_oura_date + timedelta(29)), 'hrv_workout_step'] = 0
-        db_test.at[pd.to_datetime(min_oura_date + timedelta(29)), 'hrv_workout_step_desc'] = 'Low'
-        db_test.at[pd.to_datetime(min_oura_date + timedelta(29)), 'completed'] = 0
-        db_test.at[
-            pd.to_datetime(min_oura_date + timedelta(
-                29)), 'rationale'] = 'This is the first date 30 day hrv thresholds could be calculated'
-        db_insert(db_test, 'hrv_workout_step_log')
+    if session.query(hrvWorkoutStepLog.id).filter(hrvWorkoutStepLog.athlete_id == athlete_id).first() is None:
+        min_oura_date = session.query(func.min(ouraSleepSummary.report_date)).scalar()
+        if min_oura_date is not None:
+            backfill_hrv_plan(min_oura_date + timedelta(29), min_non_warmup_workout_time, athlete_id=athlete_id,
+                              rationale='This is the first date 30 day hrv thresholds could be calculated')
 
     # Check if a step has already been inserted for today and if so check if workout has been completed yet
     todays_plan = session.query(hrvWorkoutStepLog).filter(hrvWorkoutStepLog.athlete_id == athlete_id,
@@ -644,167 +522,9 @@ def hrv_training_workflow(min_non_warmup_workout_time, athlete_id=1):
                     todays_plan.completed = 1
                     session.commit()
 
-    # If plan not yet created for today, create it
+    # If plan not yet created for today, create it (and any days missed since the last step)
     else:
-        hrv_df = pd.read_sql(sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd).statement,
-                             con=engine, index_col='report_date').sort_index(ascending=True)
-
-        # Wait for today's hrv to be loaded into cloud
-        if hrv_df.index.max() == datetime.today().date():  # or (datetime.now() - timedelta(hours=12)) > pd.to_datetime(datetime.today().date()):
-
-            step_log_df = pd.read_sql(
-                sql=session.query(hrvWorkoutStepLog.date, hrvWorkoutStepLog.hrv_workout_step,
-                                  hrvWorkoutStepLog.completed).filter(
-                    hrvWorkoutStepLog.athlete_id == 1).statement,
-                con=engine, index_col='date').sort_index(ascending=False)
-
-            step_log_df = step_log_df[step_log_df.index == step_log_df.index.max()]
-
-            # Store last step in variable for starting point in loop
-            last_db_step = step_log_df['hrv_workout_step'].iloc[0]
-
-            # Resample to today
-            step_log_df.at[pd.to_datetime(datetime.today().date()), 'hrv_workout_step'] = None
-            step_log_df = step_log_df.set_index(pd.to_datetime(step_log_df.index))
-            step_log_df = step_log_df.resample('D').mean()
-            # Remove first row from df so it does not get re inserted into db
-            step_log_df = step_log_df.iloc[1:]
-
-            # We already know there is no step for today from "current_step" parameter, so manually add today's date
-            step_log_df.at[pd.to_datetime(datetime.today().date()), 'completed'] = 0
-
-            # Check if gap between today and max date in step log, if so merge in all workouts for 'completed' flag
-            if step_log_df['completed'].isnull().values.any():
-                workouts = pd.read_sql(
-                    sql=session.query(stravaSummary.start_day_local, stravaSummary.activity_id).filter(
-                        stravaSummary.elapsed_time > min_non_warmup_workout_time)
-                        .statement, con=engine,
-                    index_col='start_day_local')
-                # Resample workouts to the per day level - just take max activity_id in case they were more than 1 workout for that day to avoid duplication of hrv data
-                workouts = workouts.set_index(pd.to_datetime(workouts.index))
-                workouts = workouts.resample('D').max()
-                step_log_df = step_log_df.merge(workouts, how='left', left_index=True, right_index=True)
-                # Completed = True if a workout (not just warmup) was done on that day or was a rest day
-                for x in step_log_df.index:
-                    step_log_df.at[x, 'completed'] = 0 if np.isnan(step_log_df.at[x, 'activity_id']) else 1
-
-            # Generate row with yesterdays plan completions status for looping below through workout cycle logic
-            step_log_df['completed_yesterday'] = step_log_df['completed'].shift(1)
-
-            # Drop historical rows that were used for 'yesterday calcs' so we are only working with todays data
-            # step_log_df = step_log_df.iloc[1:]
-
-            # Calculate HRV metrics
-            hrv_df.set_index(pd.to_datetime(hrv_df.index), inplace=True)
-            hrv_df = hrv_df.resample('D').mean()
-
-            hrv_df['rmssd_7'] = hrv_df['rmssd'].rolling(7, min_periods=0).mean()
-            hrv_df['rmssd_7_yesterday'] = hrv_df['rmssd_7'].shift(1)
-            hrv_df['rmssd_30'] = hrv_df['rmssd'].rolling(30, min_periods=0).mean()
-            hrv_df['stdev_rmssd_30_threshold'] = hrv_df['rmssd'].rolling(30, min_periods=0).std() * .5
-            hrv_df['swc_upper'] = hrv_df['rmssd_30'] + hrv_df['stdev_rmssd_30_threshold']
-            hrv_df['swc_lower'] = hrv_df['rmssd_30'] - hrv_df['stdev_rmssd_30_threshold']
-            hrv_df['under_low_threshold'] = hrv_df['rmssd_7'] < hrv_df['swc_lower']
-            hrv_df['under_low_threshold_yesterday'] = hrv_df['under_low_threshold'].shift(1)
-            hrv_df['over_upper_threshold'] = hrv_df['rmssd_7'] > hrv_df['swc_upper']
-            hrv_df['over_upper_threshold_yesterday'] = hrv_df['over_upper_threshold'].shift(1)
-            for i in hrv_df.index:
-                if hrv_df.at[i, 'under_low_threshold_yesterday'] == False and hrv_df.at[
-                    i, 'under_low_threshold'] == True:
-                    hrv_df.at[i, 'lower_threshold_crossed'] = True
-                else:
-                    hrv_df.at[i, 'lower_threshold_crossed'] = False
-                if hrv_df.at[i, 'over_upper_threshold_yesterday'] == False and hrv_df.at[
-                    i, 'over_upper_threshold'] == True:
-                    hrv_df.at[i, 'upper_threshold_crossed'] = True
-                else:
-                    hrv_df.at[i, 'upper_threshold_crossed'] = False
-            # Merge dfs
-            df = pd.merge(step_log_df, hrv_df, how='left', right_index=True, left_index=True)
-
-            last_step = last_db_step
-            for i in df.index:
-                # Completed / Completed_yesterday could show erroneous data for rest days, as the 0 is brought in based off if a workout is found in strava summary
-                df.at[i, 'completed_yesterday'] = 1 if last_step == 4 or last_step == 5 else df.at[
-                    i, 'completed_yesterday']
-
-                hrv_increase = df.at[i, 'rmssd_7'] >= df.at[i, 'rmssd_7_yesterday']
-
-                ### Low Threshold Exceptions ###
-                # If lower threshold is crossed, switch to low intensity track
-                if df.at[i, 'lower_threshold_crossed'] == True:
-                    current_step = 4
-                    rationale = '7 day HRV average crossed the 30 day baseline lower threshold.'
-                    dash_app.server.logger.debug('Lower threshold crossed. Setting current step = 4')
-                # If we are below lower threshold, rest until back over threshold
-                elif df.at[i, 'under_low_threshold'] == True:
-                    current_step = 5
-                    rationale = '7 day HRV average is under the 30 day baseline lower threshold.'
-                    dash_app.server.logger.debug('HRV is under threshold. Setting current step = 5')
-
-                ### Upper Threshold Exceptions ###
-                # If upper threshold is crossed, switch to high  intensity
-                elif df.at[i, 'upper_threshold_crossed'] == True:
-                    current_step = 1
-                    rationale = '7 day HRV average crossed the 30 day baseline upper threshold.'
-                    dash_app.server.logger.debug('Upper threshold crossed. Setting current step = 1')
-                # If we are above upper threshold, load high intensity until back under threshold
-                elif df.at[i, 'over_upper_threshold'] == True:
-                    if hrv_increase:
-                        current_step = 1
-                        rationale = '7 day HRV average increased and is still over the 30 day baseline upper threshold.'
-                    else:
-                        current_step = 2
-                        rationale = "7 day HRV average decreased but is still over the 30 day baseline upper threshold."
-                    dash_app.server.logger.debug(
-                        'HRV is above threshold. Setting current step = {}.'.format(current_step))
-
-                ### Missed Workout Exceptions ###
-                # If workout was not completed yesterday but we are still within thresholds and current step is high/moderate go high if hrv increases, or stay on moderate if hrv decreases
-                elif df.at[i, 'completed_yesterday'] == 0 and df.at[i, 'under_low_threshold'] == False and df.at[
-                    i, 'over_upper_threshold'] == False and (last_step == 1 or last_step == 2):
-                    if hrv_increase:
-                        current_step = 1
-                        rationale = "7 day HRV average increased and yesterday's workout was not completed."
-                    else:
-                        current_step = 2
-                        rationale = "7 day HRV average decreased and yesterday's workout was not completed."
-                    dash_app.server.logger.debug(
-                        'No workout detected for previous day however still within thresholds. Maintaining last step = {}'.format(
-                            current_step))
-                else:
-                    dash_app.server.logger.debug(
-                        'No exceptions detected. Following the normal workout plan workflow.')
-                    rationale = '7 day HRV average is within the tresholds. Following the normal workout plan workflow.'
-                    # Workout workflow logic when no exceptions
-                    if last_step == 0:
-                        current_step = 1
-                    elif last_step == 1:
-                        current_step = 2 if hrv_increase else 6
-                    elif last_step == 2:
-                        current_step = 3
-                    elif last_step == 3:
-                        current_step = 1 if hrv_increase else 4
-                    elif last_step == 4:
-                        current_step = 6 if hrv_increase else 5
-                    elif last_step == 5:
-                        current_step = 6
-                    elif last_step == 6:
-                        current_step = 1 if hrv_increase else 4
-
-                df.at[i, 'completed'] = 1 if current_step == 4 or current_step == 5 else df.at[i, 'completed']
-                df.at[i, 'hrv_workout_step'] = current_step
-                last_step = current_step
-
-                df.at[i, 'rationale'] = rationale
-
-            df['athlete_id'] = athlete_id
-            df['hrv_workout_step_desc'] = df['hrv_workout_step'].map(
-                {0: 'Low', 1: 'High', 2: 'HIIT/MOD', 3: 'Low', 4: 'Rest', 5: 'Rest', 6: 'Low'})
-
-            # Insert into db
-            df = df[['athlete_id', 'hrv_workout_step', 'hrv_workout_step_desc', 'completed', 'rationale']]
-            db_insert(df, 'hrv_workout_step_log')
-
-    engine.dispose()
+        days = append_hrv_plan(min_non_warmup_workout_time, athlete_id=athlete_id)
+        dash_app.server.logger.debug('Planned {} days of the hrv workout plan'.format(days))
+
     session.close()
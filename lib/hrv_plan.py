@@ -0,0 +1,166 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+from sqlalchemy import delete, func
+from lib.sqlalchemy_declarative import db_session, db_insert, ouraSleepSummary, stravaSummary, hrvWorkoutStepLog
+
+# https://www.trainingpeaks.com/coach-blog/new-study-widens-hrv-evidence-for-more-athletes/
+
+step_descriptions = {0: 'Low', 1: 'High', 2: 'HIIT/MOD', 3: 'Low', 4: 'Rest', 5: 'Rest', 6: 'Low'}
+
+# Rest steps count as completed
+rest_steps = [4, 5]
+
+rationales = ['7 day HRV average crossed the 30 day baseline lower threshold.',
+              '7 day HRV average is under the 30 day baseline lower threshold.',
+              '7 day HRV average crossed the 30 day baseline upper threshold.',
+              '7 day HRV average increased and is still over the 30 day baseline upper threshold.',
+              '7 day HRV average decreased but is still over the 30 day baseline upper threshold.',
+              "7 day HRV average increased and yesterday's workout was not completed.",
+              "7 day HRV average decreased and yesterday's workout was not completed.",
+              '7 day HRV average is within the tresholds. Following the normal workout plan workflow.']
+
+# Normal workout plan workflow, next step from the last step when the 7 day average (decreased, increased)
+next_steps = {0: (1, 1), 1: (6, 2), 2: (3, 3), 3: (4, 1), 4: (5, 6), 5: (6, 6), 6: (4, 1)}
+
+
+def hrv_thresholds(rmssd):
+    '''
+    Rolling hrv baseline and which side of it the 7 day average is on
+    :param rmssd: daily series of rmssd (resampled so every day has a row)
+    :return: df with the 7/30 day averages, smallest worthwhile change thresholds and threshold flags
+    '''
+    df = pd.DataFrame(index=rmssd.index)
+    df['rmssd_7'] = rmssd.rolling(7, min_periods=0).mean()
+    df['rmssd_7_yesterday'] = df['rmssd_7'].shift(1)
+    df['rmssd_30'] = rmssd.rolling(30, min_periods=0).mean()
+    df['stdev_rmssd_30_threshold'] = rmssd.rolling(30, min_periods=0).std() * .5
+    df['swc_upper'] = df['rmssd_30'] + df['stdev_rmssd_30_threshold']
+    df['swc_lower'] = df['rmssd_30'] - df['stdev_rmssd_30_threshold']
+    df['under_low_threshold'] = df['rmssd_7'] < df['swc_lower']
+    df['over_upper_threshold'] = df['rmssd_7'] > df['swc_upper']
+    # Crossed when over/under today but not yesterday (the first day has no yesterday to cross from)
+    df['lower_threshold_crossed'] = df['under_low_threshold'] & ~df['under_low_threshold'].shift(1, fill_value=True)
+    df['upper_threshold_crossed'] = df['over_upper_threshold'] & ~df['over_upper_threshold'].shift(1, fill_value=True)
+    df['hrv_increase'] = df['rmssd_7'] >= df['rmssd_7_yesterday']
+    return df
+
+
+def plan_steps(last_step, last_completed, lower_crossed, under_low, upper_crossed, over_upper, hrv_increase,
+               workout_done):
+    '''
+    Walk the hrv workout plan over consecutive days. Threshold exceptions don't depend on the plan so are resolved
+    for every day at once, only the days following the plan's own workflow are walked one after the other
+    :param last_step: step of the day before the first day
+    :param last_completed: whether the day before the first day was completed
+    :param lower_crossed: bool array per day, the flags of hrv_thresholds()
+    :param under_low: bool array per day
+    :param upper_crossed: bool array per day
+    :param over_upper: bool array per day
+    :param hrv_increase: bool array per day
+    :param workout_done: bool array per day, whether a (non warmup) workout was done
+    :return: int arrays of step, completed and rationale (index of rationales) per day
+    '''
+    lower_crossed, under_low = np.asarray(lower_crossed, dtype='bool'), np.asarray(under_low, dtype='bool')
+    upper_crossed, over_upper = np.asarray(upper_crossed, dtype='bool'), np.asarray(over_upper, dtype='bool')
+    hrv_increase = np.asarray(hrv_increase, dtype='bool')
+    # Step and rationale of the threshold exceptions, -1 where the plan decides
+    forced = np.select([lower_crossed, under_low, upper_crossed, over_upper & hrv_increase, over_upper],
+                       [4, 5, 1, 1, 2], -1)
+    reasons = np.select([lower_crossed, under_low, upper_crossed, over_upper & hrv_increase, over_upper],
+                        [0, 1, 2, 3, 4], -1)
+    steps = forced.copy()
+    completed = np.array(workout_done, dtype='int')
+    for i in range(len(steps)):
+        if steps[i] < 0:
+            increase = bool(hrv_increase[i])
+            # A missed workout while on high/moderate holds there instead of moving on
+            if last_completed == 0 and last_step in (1, 2):
+                steps[i], reasons[i] = (1, 5) if increase else (2, 6)
+            else:
+                steps[i], reasons[i] = next_steps[last_step][increase], 7
+        if steps[i] in rest_steps:
+            completed[i] = 1
+        last_step, last_completed = steps[i], completed[i]
+    return steps, completed, reasons
+
+
+def read_hrv_thresholds():
+    with db_session() as session:
+        df = pd.read_sql(sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd).statement,
+                         con=session.bind, index_col='report_date').sort_index(ascending=True)
+    df.set_index(pd.to_datetime(df.index), inplace=True)
+    return hrv_thresholds(df['rmssd'].resample('D').mean())
+
+
+def plan_days(start_date, end_date, last_step, last_completed, min_non_warmup_workout_time, athlete_id=1):
+    '''
+    Plan every day from start_date through end_date
+    :param last_step: step of the day before start_date
+    :param last_completed: completed flag of the day before start_date
+    :param min_non_warmup_workout_time: activities longer than this (seconds) complete a day's workout
+    :return: df indexed by date in the hrv_workout_step_log format
+    '''
+    days = pd.date_range(start_date, end_date, freq='D')
+    df = read_hrv_thresholds().reindex(days)
+    with db_session() as session:
+        workout_days = [x for (x,) in session.query(stravaSummary.start_day_local).filter(
+            stravaSummary.elapsed_time > min_non_warmup_workout_time,
+            stravaSummary.start_day_local >= days.min().date()).distinct().all()]
+    flags = df[['lower_threshold_crossed', 'under_low_threshold', 'upper_threshold_crossed', 'over_upper_threshold',
+                'hrv_increase']].fillna(False).astype('bool')
+    steps, completed, reasons = plan_steps(last_step, last_completed, flags['lower_threshold_crossed'].values,
+                                           flags['under_low_threshold'].values,
+                                           flags['upper_threshold_crossed'].values,
+                                           flags['over_upper_threshold'].values, flags['hrv_increase'].values,
+                                           days.isin(pd.to_datetime(workout_days)))
+    df = pd.DataFrame({'athlete_id': athlete_id, 'hrv_workout_step': steps,
+                       'hrv_workout_step_desc': pd.Series(steps).map(step_descriptions).values,
+                       'completed': completed, 'rationale': np.array(rationales)[reasons]}, index=days.date)
+    df.index.name = 'date'
+    return df
+
+
+def latest_plannable_date():
+    # Days are only planned once their hrv has been loaded, and never past today
+    with db_session() as session:
+        latest_hrv = session.query(func.max(ouraSleepSummary.report_date)).scalar()
+    return None if latest_hrv is None else min(latest_hrv, datetime.today().date())
+
+
+def backfill_hrv_plan(start_date, min_non_warmup_workout_time, athlete_id=1, rationale=None):
+    '''
+    Restart the plan at step 0 on start_date and replay every day since in one pass, replacing the logged plan
+    :param start_date: date to restart the plan on
+    :param min_non_warmup_workout_time: activities longer than this (seconds) complete a day's workout
+    :param rationale: rationale logged on start_date
+    '''
+    start_date = pd.to_datetime(start_date).date()
+    df = pd.DataFrame({'athlete_id': athlete_id, 'hrv_workout_step': 0, 'hrv_workout_step_desc': step_descriptions[0],
+                       'completed': 0, 'rationale': rationale}, index=pd.Index([start_date], name='date'))
+    end_date = latest_plannable_date()
+    if end_date is not None and end_date > start_date:
+        df = pd.concat([df, plan_days(start_date + timedelta(days=1), end_date, 0, 0, min_non_warmup_workout_time,
+                                      athlete_id)])
+    with db_session() as session:
+        session.execute(delete(hrvWorkoutStepLog).where(hrvWorkoutStepLog.athlete_id == athlete_id,
+                                                        hrvWorkoutStepLog.date >= start_date))
+    db_insert(df, 'hrv_workout_step_log')
+
+
+def append_hrv_plan(min_non_warmup_workout_time, athlete_id=1):
+    '''
+    Plan the days since the last logged step through today, once today's hrv has been loaded
+    :param min_non_warmup_workout_time: activities longer than this (seconds) complete a day's workout
+    :return: number of days planned
+    '''
+    with db_session() as session:
+        last = session.query(hrvWorkoutStepLog).filter(hrvWorkoutStepLog.athlete_id == athlete_id).order_by(
+            hrvWorkoutStepLog.date.desc()).first()
+        last = None if last is None else (last.date, last.hrv_workout_step, last.completed)
+    if last is None or latest_plannable_date() != datetime.today().date() or last[0] >= datetime.today().date():
+        return 0
+    df = plan_days(last[0] + timedelta(days=1), datetime.today().date(), last[1], int(last[2] or 0),
+                   min_non_warmup_workout_time, athlete_id)
+    db_insert(df, 'hrv_workout_step_log')
+    return len(df)
@@ -0,0 +1,190 @@
+import math
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from lib.sqlalchemy_declarative import db_session, db_insert, get_engine, stravaMeanMaxPower, stravaSummary
+from dash_app import dash_app
+
+# Set once the legacy strava_best_samples table has been checked for / moved into strava_mmp
+_migrated = False
+
+
+def power_curve_intervals(max_interval):
+    '''
+    Interval lengths (seconds) plotted on the power curve
+    :param max_interval: longest interval available
+    :return: list of ints
+    '''
+    # 1 second intervals from 0-60 seconds
+    interval_lengths = [i for i in range(1, 61)]
+    # 15 second intervals from 1:15 - 5:00 mins
+    interval_lengths += [i for i in range(75, 301, 15)]
+    # 30 second intervals for 5:00 - 10:00
+    interval_lengths += [i for i in range(330, 601, 30)]
+    # 1 minute intervals for everything after 10 mins
+    interval_lengths += [i for i in range(660, (int(math.floor(max_interval / 10.0)) * 10) + 1, 60)]
+    return interval_lengths
+
+
+def mean_max_power(power, intervals=None):
+    '''
+    Mean maximal power for every duration from 1 second up to len(power) - 1 seconds, the same values (bit for bit)
+    as sweat's WorkoutDataFrame.compute_mean_max_power: the best difference in accumulated energy over t samples / t
+    :param power: array-like of 1 second power samples (nan allowed)
+    :param intervals: optional list of durations to compute instead of every duration (i.e. power_curve_intervals())
+    :return: float array of mmp for durations 1..len(power) - 1, or for each of intervals (nan if longer than the ride)
+    '''
+    power = np.asarray(power, dtype='float')
+    # Accumulated energy, where a missing sample stays missing but does not reset the running total (as pandas cumsum)
+    missing = np.isnan(power)
+    energy = np.cumsum(np.where(missing, 0, power))
+    energy[missing] = np.nan
+    # np.max propagates nan, fmax skips it (only needed when there are gaps)
+    best = np.fmax.reduce if missing.any() else np.max
+
+    n = len(energy)
+    durations = np.arange(1, n) if intervals is None else np.asarray(intervals, dtype='int')
+    mmp = np.full(len(durations), np.nan)
+    diff = np.empty(n)
+    for i, t in enumerate(durations):
+        if t < 1 or t >= n:
+            continue
+        # Energy in every window of t seconds, reusing one buffer
+        np.subtract(energy[t:], energy[:-t], out=diff[:n - t])
+        mmp[i] = best(diff[:n - t]) / t
+    return mmp
+
+
+def pack_mmp(mmp):
+    # Little endian float32, position 0 is the 1 second best
+    return np.asarray(mmp, dtype='<f4').tobytes()
+
+
+def unpack_mmp(blob):
+    return np.frombuffer(blob, dtype='<f4').astype('float')
+
+
+def mmp_matrix(blobs, intervals=None):
+    '''
+    Stack packed curves into a single array, padding activities shorter than an interval with nan
+    :param blobs: list of packed mmp arrays (strava_mmp.mmp)
+    :param intervals: optional durations (seconds) to use as the columns, None for 1 second up to the longest activity
+    :return: float array with a row per blob and a column per interval
+    '''
+    return curve_matrix([unpack_mmp(x) for x in blobs], intervals)
+
+
+def curve_matrix(curves, intervals=None):
+    # mmp_matrix() of curves already unpacked
+    if intervals is None:
+        columns = np.arange(max([len(x) for x in curves], default=0))
+    else:
+        columns = np.asarray(intervals, dtype='int') - 1
+    matrix = np.full((len(curves), len(columns)), np.nan)
+    for i, curve in enumerate(curves):
+        valid = (columns >= 0) & (columns < len(curve))
+        matrix[i, valid] = curve[columns[valid]]
+    return matrix
+
+
+def read_mmp_summary(activity_ids=None, activity_type=None):
+    '''
+    strava_mmp rows (still packed) with the weight (lbs) stored on the activity's summary, in start date order
+    :param activity_ids: optional list of activity ids
+    :param activity_type: optional ilike pattern for the activity type (i.e. '%ride%')
+    :return: df of activity_id, athlete_id, type, start_date_local, mmp, weight
+    '''
+    migrate_best_samples()
+    with db_session() as session:
+        query = session.query(stravaMeanMaxPower.activity_id, stravaMeanMaxPower.athlete_id, stravaMeanMaxPower.type,
+                              stravaMeanMaxPower.start_date_local, stravaMeanMaxPower.mmp,
+                              stravaSummary.weight).outerjoin(stravaSummary,
+                                                              stravaSummary.activity_id == stravaMeanMaxPower.activity_id)
+        if activity_ids is not None:
+            query = query.filter(stravaMeanMaxPower.activity_id.in_([int(x) for x in activity_ids]))
+        if activity_type is not None:
+            query = query.filter(stravaMeanMaxPower.type.ilike(activity_type))
+        return pd.read_sql(sql=query.order_by(stravaMeanMaxPower.start_date_local.asc()).statement, con=session.bind)
+
+
+def read_mmp(activity_ids=None, activity_type=None, intervals=None):
+    '''
+    Mean max power curves for a set of activities as one 2-D array
+    :param activity_ids: optional list of activity ids
+    :param activity_type: optional ilike pattern for the activity type (i.e. '%ride%')
+    :param intervals: optional durations (seconds) to return, None for every duration
+    :return: (df with a row per activity, see read_mmp_summary(), float array with a row per activity and a column
+             per interval)
+    '''
+    df = read_mmp_summary(activity_ids, activity_type)
+    matrix = mmp_matrix(df.pop('mmp'), intervals)
+    return df, matrix
+
+
+def mmp_samples(df, matrix, intervals=None):
+    '''
+    Long format of read_mmp() (a row per activity and interval, as the old strava_best_samples table was stored),
+    with watts_per_kg from the weight as of each activity
+    :param df: activities, one per row of matrix, with activity_id, athlete_id, type, start_date_local and weight
+    :param matrix: mmp with a column per interval
+    :param intervals: durations (seconds) of the matrix columns, None for 1 second up to the width of matrix
+    :return: df of interval, activity_id, mmp, watts_per_kg, timestamp_local, time_interval, date, athlete_id, type
+    '''
+    intervals = np.arange(1, matrix.shape[1] + 1) if intervals is None else np.asarray(intervals, dtype='int')
+    rows, cols = np.nonzero(~np.isnan(matrix))
+    return sparse_mmp_samples(df, rows, intervals[cols], matrix[rows, cols])
+
+
+def sparse_mmp_samples(df, rows, intervals, mmp):
+    '''
+    mmp_samples() from parallel arrays instead of a dense matrix
+    :param df: activities with activity_id, athlete_id, type, start_date_local and weight
+    :param rows: position in df of each sample
+    :param intervals: duration (seconds) of each sample
+    :param mmp: mmp of each sample
+    '''
+    samples = pd.DataFrame({'interval': intervals, 'activity_id': df['activity_id'].values[rows], 'mmp': mmp})
+    samples['watts_per_kg'] = samples['mmp'] / (df['weight'].values[rows].astype('float') * 0.453592)
+    # Samples are 1 second, so the timestamp of an interval is just its offset from the start of the activity
+    offset = pd.to_timedelta(samples['interval'], unit='s')
+    samples['timestamp_local'] = pd.to_datetime(df['start_date_local']).values[rows] + offset
+    samples['time_interval'] = pd.to_datetime('1970-01-01') + offset
+    samples['date'] = samples['timestamp_local'].dt.date
+    samples['athlete_id'] = df['athlete_id'].values[rows]
+    samples['type'] = df['type'].values[rows]
+    return samples
+
+
+def migrate_best_samples():
+    '''
+    Move the row per second strava_best_samples table of older versions into strava_mmp and drop it
+    '''
+    global _migrated
+    if _migrated:
+        return
+    engine = get_engine()
+    with engine.connect() as connection:
+        legacy = engine.dialect.has_table(connection, 'strava_best_samples')
+    if legacy:
+        dash_app.server.logger.info('Migrating strava_best_samples to strava_mmp')
+        df = pd.read_sql(sql='SELECT activity_id, interval, mmp, timestamp_local, type, athlete_id '
+                             'FROM strava_best_samples ORDER BY activity_id, interval', con=engine)
+        with db_session() as session:
+            existing = [x[0] for x in session.query(stravaMeanMaxPower.activity_id).all()]
+        rows = []
+        for activity_id, x in df[~df['activity_id'].isin(existing)].groupby('activity_id'):
+            curve = np.full(int(x['interval'].max()), np.nan)
+            curve[x['interval'].values - 1] = x['mmp'].values
+            first = x.iloc[0]
+            rows.append({'activity_id': activity_id, 'athlete_id': first['athlete_id'], 'type': first['type'],
+                         'start_date_local': pd.to_datetime(first['timestamp_local']) - timedelta(
+                             seconds=int(first['interval'])),
+                         'mmp': pack_mmp(curve)})
+        if len(rows) > 0:
+            db_insert(pd.DataFrame(rows).set_index('activity_id'), 'strava_mmp')
+        with db_session() as session:
+            session.execute('DROP TABLE strava_best_samples')
+        # Give the space back to the filesystem (can't run inside a transaction)
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT').execute('VACUUM')
+    _migrated = True
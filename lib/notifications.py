@@ -1,14 +1,12 @@
-from lib.sqlalchemy_declarative import db_connect, withings, stravaSummary, athlete
+from lib.sqlalchemy_declarative import db_session, withings, stravaSummary, athlete
 from sqlalchemy import func
 from datetime import datetime, timedelta
 import dash_bootstrap_components as dbc
 
 
 def last_body_measurement_notification():
-    session, engine = db_connect()
-    last_measurement_date = session.query(func.max(withings.date_utc))[0][0]
-    engine.dispose()
-    session.close()
+    with db_session() as session:
+        last_measurement_date = session.query(func.max(withings.date_utc))[0][0]
 
     if last_measurement_date:
         days_since_last_measurement = datetime.utcnow().date() - last_measurement_date.date()
@@ -21,17 +19,13 @@ def last_body_measurement_notification():
 
 
 def last_ftp_test_notification(ftp_type):
-    session, engine = db_connect()
-
-    last_ftp_test_date = \
-        session.query(func.max(stravaSummary.start_date_utc)).filter(
-            (stravaSummary.name.ilike('%ftp test%')) & (stravaSummary.type.ilike(ftp_type))
-        )[0][0]
-    ftp_week_threshold = session.query(athlete).filter(
-        athlete.athlete_id == 1).first().ftp_test_notification_week_threshold
-
-    engine.dispose()
-    session.close()
+    with db_session() as session:
+        last_ftp_test_date = \
+            session.query(func.max(stravaSummary.start_date_utc)).filter(
+                (stravaSummary.name.ilike('%ftp test%')) & (stravaSummary.type.ilike(ftp_type))
+            )[0][0]
+        ftp_week_threshold = session.query(athlete).filter(
+            athlete.athlete_id == 1).first().ftp_test_notification_week_threshold
 
     if last_ftp_test_date:
         weeks_since_ftp_test = ((datetime.utcnow() - last_ftp_test_date).days) / 7.0
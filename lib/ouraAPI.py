@@ -1,10 +1,13 @@
 from oura import OuraClient
-from lib.sqlalchemy_declarative import db_connect, db_insert, ouraReadinessSummary, ouraActivitySummary, \
-    ouraActivitySamples, ouraSleepSamples, ouraSleepSummary, apiTokens
+from lib.sqlalchemy_declarative import db_connect, db_upsert, ouraReadinessSummary, ouraActivitySummary, \
+    ouraSleepSummary, apiTokens
 from sqlalchemy import func, delete
 from datetime import datetime, timedelta
 import pandas as pd
+import numpy as np
+from itertools import chain
 from dash_app import dash_app
+from lib.refresh_metrics import count_http
 import configparser
 import ast
 
@@ -22,7 +25,6 @@ def current_token_dict():
         session, engine = db_connect()
         token_dict = session.query(apiTokens.tokens).filter(apiTokens.service == 'Oura').first()
         token_dict = ast.literal_eval(token_dict[0]) if token_dict else {}
-        engine.dispose()
         session.close()
     except BaseException as e:
         dash_app.server.logger.error(e)
@@ -45,7 +47,6 @@ def save_oura_token(token_dict):
     # config.set("oura", "token_dict", str(token_dict))
     # with open('config.ini', 'w') as configfile:
     #     config.write(configfile)
-    engine.dispose()
     session.close()
 
 
@@ -85,11 +86,49 @@ def connect_oura_link(auth_client):
     return url[0]
 
 
+def flatten_samples(values):
+    '''
+    Lay the sample lists of every day end to end
+    :param values: list with a list of samples per day
+    :return: (float array of every sample, int array of the number of samples of each day)
+    '''
+    lengths = np.array([len(x) for x in values], dtype='int')
+    return np.array(list(chain.from_iterable(values)), dtype='float'), lengths
+
+
+def flatten_digits(values):
+    # flatten_samples() for series oura sends as a string of single digit samples (i.e. '1122233')
+    lengths = np.array([len(x) for x in values], dtype='int')
+    return (np.frombuffer(''.join(values).encode('ascii'), dtype='uint8') - ord('0')).astype('float'), lengths
+
+
+def sample_positions(lengths):
+    '''
+    :param lengths: number of samples of each day
+    :return: (day, position within the day) of every sample once the days are laid end to end
+    '''
+    day = np.repeat(np.arange(len(lengths)), lengths)
+    return day, np.arange(len(day)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+
+def take_samples(values, lengths, day, position):
+    '''
+    Look up flattened samples by day and position, nan where the day has no sample at that position
+    :param values: flattened samples (see flatten_samples())
+    :param lengths: number of samples of each day in values
+    :param day: day of each sample to take
+    :param position: position within the day of each sample to take
+    '''
+    taken = np.full(len(day), np.nan)
+    valid = position < lengths[day]
+    taken[valid] = values[(np.cumsum(lengths) - lengths)[day[valid]] + position[valid]]
+    return taken
+
+
 def pull_readiness_data(oura, days_back=7):
     session, engine = db_connect()
     # Get latest date in db and pull everything after
     start = session.query(func.max(ouraReadinessSummary.report_date))
-    engine.dispose()
     session.close()
     start = '1999-01-01' if start[0][0] is None else datetime.strftime(start[0][0] - timedelta(days=days_back),
                                                                        '%Y-%m-%d')
@@ -109,24 +148,19 @@ def pull_readiness_data(oura, days_back=7):
         return []
 
 
-def insert_readiness_data(df_readiness_summary, days_back=7):
-    session, engine = db_connect()
-    start = session.query(func.max(ouraReadinessSummary.report_date))
-    start = '1999-01-01' if start[0][0] is None else datetime.strftime(start[0][0] - timedelta(days=days_back),
-                                                                       '%Y-%m-%d')
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        dash_app.server.logger.debug('Deleting >= {} records from oura_readiness_summary'.format(start))
-        session.execute(delete(ouraReadinessSummary).where(ouraReadinessSummary.summary_date >= start))
-        session.commit()
-    except BaseException as e:
-        dash_app.server.logger.error(e)
+def upsert_oura_data(df, table_name, day_column=None):
+    # Write only the days that changed since the last pull (see db_upsert())
+    dash_app.server.logger.debug('Upserting {}'.format(table_name))
+    counts = db_upsert(df, table_name, day_column)
+    dash_app.server.logger.info(
+        '{}: {inserted} inserted, {updated} updated, {deleted} deleted, {unchanged} unchanged'.format(table_name,
+                                                                                                      **counts))
+    # The table when anything was written to it, so only the pages reading it are recomputed
+    return [table_name] if counts['inserted'] + counts['updated'] + counts['deleted'] > 0 else []
 
-    engine.dispose()
-    session.close()
 
-    dash_app.server.logger.debug('Inserting oura readiness summary')
-    db_insert(df_readiness_summary, 'oura_readiness_summary')
+def insert_readiness_data(df_readiness_summary):
+    return upsert_oura_data(df_readiness_summary, 'oura_readiness_summary')
 
 
 def pull_activity_data(oura, days_back=7):
@@ -135,7 +169,6 @@ def pull_activity_data(oura, days_back=7):
     session, engine = db_connect()
     # Get latest date in db and pull everything after
     start = session.query(func.max(ouraActivitySummary.summary_date))[0][0]
-    engine.dispose()
     session.close()
 
     start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
@@ -152,79 +185,46 @@ def pull_activity_data(oura, days_back=7):
             df_activity_summary['day_start'].apply(lambda x: x[:-6]))
         df_activity_summary = df_activity_summary.drop(columns=['met_1min', 'day_end', 'day_start'], axis=1)
 
-        # Generate Activity Samples
-        df_1min_list, df_5min_list = [], []
-        for x in oura_data:
-            # build 1 min metrics df
-            df_1min = pd.Series(x['met_1min'], name='met_1min').to_frame()
-            df_1min['timestamp_local'] = pd.to_datetime(x['day_start']) + pd.to_timedelta(df_1min.index, unit='m')
-            df_1min = df_1min.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df_1min.index = df_1min.index.tz_localize(None)
-            df_1min['summary_date'] = x['summary_date']
-            df_1min_list.append(df_1min)
-
-            # build 5 min metrics df
-            df_5min = pd.Series([int(y) for y in x['class_5min']], name='class_5min').to_frame()
-            df_5min['class_5min_desc'] = df_5min['class_5min'].fillna('5').astype('str').map(
-                {'0': 'Rest', '1': 'Inactive', '2': 'Low', '3': 'Medium', '4': 'High', '5': 'Non-Wear'})
-            df_5min['timestamp_local'] = pd.to_datetime(x['day_start']) + pd.to_timedelta(df_5min.index * 5, unit='m')
-            df_5min = df_5min.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df_5min.index = df_5min.index.tz_localize(None)
-            df_5min['summary_date'] = x['summary_date']
-            df_5min_list.append(df_5min)
-
-        df_1min = pd.concat(df_1min_list)
-        df_5min = pd.concat(df_5min_list)
-
-        df_activity_samples = df_1min.merge(df_5min, how='left', left_index=True, right_index=True)
-        df_activity_samples['summary_date'] = df_activity_samples['summary_date_x']
-        df_activity_samples = df_activity_samples.drop(columns=['summary_date_x', 'summary_date_y'], axis=1)
+        # Generate Activity Samples, every day laid end to end in one pass
+        met_1min, met_lengths = flatten_samples([x['met_1min'] for x in oura_data])
+        class_5min, class_lengths = flatten_digits([x['class_5min'] for x in oura_data])
+        day, minute = sample_positions(met_lengths)
+        # Remove timezone info from date, we are just storing whatever the local time was, where the person was
+        day_start = pd.to_datetime(pd.Series([x['day_start'][:-6] for x in oura_data])).values
+        df_activity_samples = pd.DataFrame({'met_1min': met_1min}, index=pd.DatetimeIndex(
+            day_start[day] + minute.astype('timedelta64[m]'), name='timestamp_local'))
+        # The 5 min class only lines up with (is stored on) every 5th minute
+        df_activity_samples['class_5min'] = np.where(minute % 5 == 0, take_samples(class_5min, class_lengths, day,
+                                                                                   minute // 5), np.nan)
+        df_activity_samples['class_5min_desc'] = df_activity_samples['class_5min'].map(
+            {0: 'Rest', 1: 'Inactive', 2: 'Low', 3: 'Medium', 4: 'High', 5: 'Non-Wear'})
+        df_activity_samples['summary_date'] = np.array([x['summary_date'] for x in oura_data])[day]
 
         return df_activity_summary, df_activity_samples
     else:
         return [], []
 
 
-def insert_activity_data(df_activity_summary, df_activity_samples, days_back=7):
-    session, engine = db_connect()
-    start = session.query(func.max(ouraActivitySummary.summary_date))[0][0]
-    start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
-
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        dash_app.server.logger.debug('Deleting >= {} records from oura_activity_summary'.format(start))
-        session.execute(delete(ouraActivitySummary).where(ouraActivitySummary.summary_date >= start))
-        dash_app.server.logger.debug('Deleting >= {} records from oura_activity_samples'.format(start))
-        session.execute(delete(ouraActivitySamples).where(ouraActivitySamples.timestamp_local >= start))
-        session.commit()
-    except BaseException as e:
-        dash_app.server.logger.error(e)
-
-    engine.dispose()
-    session.close()
-
+def insert_activity_data(df_activity_summary, df_activity_samples):
+    written = []
     # Insert Activity Summary
-    dash_app.server.logger.debug('Inserting oura activity summary')
     try:
-        db_insert(df_activity_summary, 'oura_activity_summary')
+        written += upsert_oura_data(df_activity_summary, 'oura_activity_summary')
     except BaseException as e:
         dash_app.server.logger.error(e)
 
     # Insert Activity Samples
-    dash_app.server.logger.debug('Inserting oura activity samples')
     try:
-        db_insert(df_activity_samples, 'oura_activity_samples')
+        written += upsert_oura_data(df_activity_samples, 'oura_activity_samples', day_column='summary_date')
     except BaseException as e:
         dash_app.server.logger.error(e)
+    return written
 
 
 def pull_sleep_data(oura, days_back=7):
     session, engine = db_connect()
     # Get latest date in db and pull everything after
     start = session.query(func.max(ouraSleepSummary.report_date))[0][0]
-    engine.dispose()
     session.close()
     start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
 
@@ -246,82 +246,73 @@ def pull_sleep_data(oura, days_back=7):
         df_sleep_summary = df_sleep_summary.drop(columns=['rmssd_5min', 'hr_5min', 'bedtime_end', 'bedtime_start'],
                                                  axis=1)
 
-        # Sleep Samples
-        df_samples_list = []
-        for x in oura_data:
-            df = pd.concat([pd.Series(x['hr_5min'], name='hr_5min'), pd.Series(x['rmssd_5min'], name='rmssd_5min'),
-                            pd.Series([int(y) for y in x['hypnogram_5min']], name='hypnogram_5min')],
-                           axis=1)
-            df['hypnogram_5min_desc'] = df['hypnogram_5min'].map(
-                {1: 'Deep', 2: 'Light', 3: 'REM', 4: 'Awake'})
-            df['timestamp_local'] = pd.to_datetime(x['bedtime_start']) + pd.to_timedelta(df.index * 5, unit='m')
-
-            df['summary_date'] = pd.to_datetime(x['summary_date'])
-            df['report_date'] = df['summary_date'] + timedelta(days=1)
-            df = df.set_index('timestamp_local')
-            # Remove timezone info from date, we are just storing whatever the local time was, where the person was
-            df.index = df.index.tz_localize(None)
-            df_samples_list.append(df)
-
-        df_sleep_samples = pd.concat(df_samples_list)
+        # Sleep Samples, every night laid end to end in one pass
+        hr_5min, hr_lengths = flatten_samples([x['hr_5min'] for x in oura_data])
+        rmssd_5min, rmssd_lengths = flatten_samples([x['rmssd_5min'] for x in oura_data])
+        hypnogram_5min, hypnogram_lengths = flatten_digits([x['hypnogram_5min'] for x in oura_data])
+        # Nights are as long as their longest series, the shorter ones are padded with nan
+        night, sample = sample_positions(np.maximum.reduce([hr_lengths, rmssd_lengths, hypnogram_lengths]))
+        # Remove timezone info from date, we are just storing whatever the local time was, where the person was
+        bedtime_start = pd.to_datetime(pd.Series([x['bedtime_start'][:-6] for x in oura_data])).values
+        df_sleep_samples = pd.DataFrame({'hr_5min': take_samples(hr_5min, hr_lengths, night, sample),
+                                         'rmssd_5min': take_samples(rmssd_5min, rmssd_lengths, night, sample),
+                                         'hypnogram_5min': take_samples(hypnogram_5min, hypnogram_lengths, night,
+                                                                        sample)},
+                                        index=pd.DatetimeIndex(bedtime_start[night] + (sample * 5).astype(
+                                            'timedelta64[m]'), name='timestamp_local'))
+        for column in ['hr_5min', 'rmssd_5min', 'hypnogram_5min']:
+            # Only padded series need to be floats
+            if df_sleep_samples[column].notnull().all():
+                df_sleep_samples[column] = df_sleep_samples[column].astype('int')
+        df_sleep_samples['hypnogram_5min_desc'] = df_sleep_samples['hypnogram_5min'].map(
+            {1: 'Deep', 2: 'Light', 3: 'REM', 4: 'Awake'})
+        df_sleep_samples['summary_date'] = pd.to_datetime(pd.Series([x['summary_date'] for x in oura_data])).values[
+            night]
+        df_sleep_samples['report_date'] = df_sleep_samples['summary_date'] + timedelta(days=1)
 
         return df_sleep_summary, df_sleep_samples
     else:
         return [], []
 
 
-def insert_sleep_data(df_sleep_summary, df_sleep_samples, days_back=7):
-    session, engine = db_connect()
-    start = session.query(func.max(ouraSleepSummary.report_date))[0][0]
-    start = '1999-01-01' if start is None else datetime.strftime(start - timedelta(days=days_back), '%Y-%m-%d')
-
-    # Delete latest dates records from db to ensure values are being overridden from api pull
-    try:
-        dash_app.server.logger.debug('Deleting >= {} records from oura_sleep_summary'.format(start))
-        session.execute(delete(ouraSleepSummary).where(ouraSleepSummary.summary_date >= start))
-        dash_app.server.logger.debug('Deleting >= {} records from oura_sleep_samples'.format(start))
-        session.execute(delete(ouraSleepSamples).where(ouraSleepSamples.summary_date >= start))
-        session.commit()
-    except BaseException as e:
-        dash_app.server.logger.error(e)
-
-    engine.dispose()
-    session.close()
-
-    # print(df_sleep_samples.index)
-    # print(df_sleep_summary.index)
-
+def insert_sleep_data(df_sleep_summary, df_sleep_samples):
+    written = []
     # Insert Sleep Summary
-    dash_app.server.logger.debug('Inserting oura sleep summary')
     try:
-        db_insert(df_sleep_summary, 'oura_sleep_summary')
+        written += upsert_oura_data(df_sleep_summary, 'oura_sleep_summary')
     except BaseException as e:
         dash_app.server.logger.error(e)
 
     # Insert Sleep Samples
-    # dash_app.server.logger.debug('Inserting oura sleep samples')
     try:
-        db_insert(df_sleep_samples, 'oura_sleep_samples')
+        written += upsert_oura_data(df_sleep_samples, 'oura_sleep_samples', day_column='report_date')
     except BaseException as e:
         dash_app.server.logger.error(e)
+    return written
 
 
 def pull_oura_data():
+    '''
+    :return: (whether oura cloud has the latest day's sleep and readiness, tables written to), None when not connected
+    '''
     if oura_connected():
         days_back = int(config.get('oura', 'days_back'))
 
         token_dict = current_token_dict()
         oura = OuraClient(client_id=client_id, client_secret=client_secret, access_token=token_dict['access_token'],
                           refresh_token=token_dict['refresh_token'], refresh_callback=save_oura_token)
+        # The oauth session is on the client in older versions of oura, on its auth handler since 1.0
+        count_http(getattr(getattr(oura, '_auth_handler', oura), '_session'))
         df_readiness_summary = pull_readiness_data(oura, days_back)
         df_activity_summary, df_activity_samples = pull_activity_data(oura, days_back)
         df_sleep_summary, df_sleep_samples = pull_sleep_data(oura, days_back)
 
-        insert_readiness_data(df_readiness_summary, days_back)
-        insert_activity_data(df_activity_summary, df_activity_samples, days_back)
-        insert_sleep_data(df_sleep_summary, df_sleep_samples, days_back)
+        written = insert_readiness_data(df_readiness_summary)
+        written += insert_activity_data(df_activity_summary, df_activity_samples)
+        written += insert_sleep_data(df_sleep_summary, df_sleep_samples)
 
-        return df_sleep_summary.index.max() == df_readiness_summary.index.max()  # == df_activity_summary.index.max()
+        synced = df_sleep_summary.index.max() == df_readiness_summary.index.max()  # == df_activity_summary.index.max()
+        return synced, written
 
     # Oura API returns times (bedtime_start, bedtime_end etc. in the timezone of the location where went to sleep.
     # Do not need to convert to UTC because we want the time we went to sleep wherever we went to sleep, not necessarily always EST
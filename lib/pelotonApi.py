@@ -7,6 +7,8 @@ import decimal
 from datetime import datetime, timezone, date, timedelta
 import configparser
 import pandas as pd
+from lib.sqlalchemy_declarative import db_session, db_insert, pelotonWorkouts
+from lib.refresh_metrics import count_http
 
 # Pulled from
 # https://github.com/geudrik/peloton-api
@@ -244,7 +246,7 @@ class PelotonAPI:
             'password': cls.peloton_password
         }
 
-        cls.peloton_session = requests.Session()
+        cls.peloton_session = count_http(requests.Session())
         resp = cls.peloton_session.post(_BASE_URL + '/auth/login', json=payload, headers=cls.headers)
         message = resp._content
 
@@ -546,6 +548,35 @@ class PelotonWorkoutFactory(PelotonAPI):
 
         return ret
 
+    @classmethod
+    def list_since(cls, start_time=None, results_per_page=100):
+        """ Return a list of PelotonWorkout instances started at or after start_time (utc), newest first.
+        Stops paging as soon as an older workout is seen, so only the delta is fetched
+        """
+
+        if cls.user_id is None:
+            cls._create_api_session()
+
+        uri = '/api/user/{}/workouts'.format(cls.user_id)
+        params = {
+            'page': 0,
+            'limit': results_per_page,
+            'sort_by': '-created',
+            'joins': 'ride,ride.instructor'
+        }
+
+        ret = []
+        while True:
+            res = cls._api_request(uri, params).json()
+            for workout in res['data']:
+                workout = PelotonWorkout(**workout)
+                if start_time is not None and workout.start_time.replace(tzinfo=None) < start_time:
+                    return ret
+                ret.append(workout)
+            params['page'] += 1
+            if params['page'] >= res['page_count']:
+                return ret
+
     @classmethod
     def get(cls, workout_id):
         """ Get workout details by workout_id
@@ -607,19 +638,65 @@ def roundTime(dt=None, roundTo=60):
     return (dt + timedelta(0, rounding - seconds, -dt.microsecond)).replace(tzinfo=None)
 
 
-def peloton_mapping_df():
-    workouts = PelotonWorkout.list()
-    df = pd.DataFrame()
-    for workout in workouts:
+def sync_peloton_workouts():
+    '''
+    Pull only the peloton workouts newer than what is already in peloton_workouts and append them
+    :return: number of workouts inserted
+    '''
+    with db_session() as session:
+        max_start = session.query(pelotonWorkouts.start_utc).order_by(pelotonWorkouts.start_utc.desc()).first()
+        max_start = max_start[0] if max_start else None
+        # Workouts at the current max are re-listed by the api, don't insert them twice
+        existing_ids = [x[0] for x in session.query(pelotonWorkouts.workout_id).filter(
+            pelotonWorkouts.start_utc >= max_start)] if max_start else []
+
+    rows = []
+    for workout in PelotonWorkoutFactory.list_since(max_start):
+        if workout.id in existing_ids:
+            continue
         try:
             instructor = ' with {}'.format(workout.ride.instructor)
         except:
             instructor = ''
-        # Round activity to nerest minute to then align with strava data rounded to nearest minute
-        df = df.append({
-            'start': roundTime(pd.to_datetime(workout.start_time)),
-            'end': roundTime(pd.to_datetime(workout.end_time)),
+        rows.append({
+            'workout_id': workout.id,
+            'start_utc': workout.start_time.replace(tzinfo=None),
+            'end_utc': workout.end_time.replace(tzinfo=None),
             'type': workout.fitness_discipline,
             'name': workout.ride.title + instructor
-        }, ignore_index=True)
-    return df
+        })
+
+    if len(rows) > 0:
+        db_insert(pd.DataFrame(rows).set_index('workout_id'), 'peloton_workouts')
+    return len(rows)
+
+
+def peloton_mapping_df(sync=True):
+    if sync:
+        sync_peloton_workouts()
+    with db_session() as session:
+        df = pd.read_sql(sql=session.query(pelotonWorkouts.start_utc, pelotonWorkouts.end_utc, pelotonWorkouts.type,
+                                           pelotonWorkouts.name).statement, con=session.bind)
+    # Round activity to nerest minute to then align with strava data rounded to nearest minute
+    df['start'] = pd.to_datetime(df['start_utc']).dt.round('min')
+    df['end'] = pd.to_datetime(df['end_utc']).dt.round('min')
+    return df[['start', 'end', 'type', 'name']]
+
+
+def match_peloton_titles(activities, peloton_df, tolerance=timedelta(minutes=5)):
+    '''
+    Match strava activities to the peloton class they were recorded against
+    Assumes recorded ride is started within 5 minutes of peloton video
+    :param activities: df with activity_id and start (utc, rounded to the minute) columns
+    :param peloton_df: output of peloton_mapping_df()
+    :return: dict of activity_id: peloton title for every activity that matched
+    '''
+    if len(activities) == 0 or len(peloton_df) == 0:
+        return {}
+    activities = activities.assign(start=pd.to_datetime(activities['start']).astype('datetime64[ns]')).sort_values(
+        'start')
+    peloton_df = peloton_df[['start', 'name']].assign(
+        start=peloton_df['start'].astype('datetime64[ns]')).sort_values('start')
+    df = pd.merge_asof(activities, peloton_df, on='start', direction='nearest', tolerance=pd.Timedelta(tolerance))
+    df = df[df['name'].notnull()]
+    return dict(zip(df['activity_id'], df['name']))
@@ -0,0 +1,171 @@
+import numpy as np
+import pandas as pd
+from datetime import timedelta
+from sqlalchemy import delete, func
+from lib.sqlalchemy_declarative import db_session, db_insert, stravaSummary, pmcDaily
+
+atl_days = 7
+ctl_days = 42
+# Sport buckets pmc_daily is stored by. CTL/ATL are linear in stress, so any combination of the run/ride/all switches
+# on the performance page is just the sum of the selected buckets
+sports = ['run', 'ride', 'other']
+daily_columns = ['stress_score', 'tss', 'hrss', 'low_intensity_seconds', 'med_intensity_seconds',
+                 'high_intensity_seconds', 'tss_flag']
+
+# Set once get_pmc_daily has built pmc_daily from the existing workouts, so an athlete without any doesn't rebuild on
+# every page load
+_rebuilt = False
+
+
+def sport_of(activity_type):
+    activity_type = str(activity_type).lower()
+    if 'run' in activity_type:
+        return 'run'
+    elif 'ride' in activity_type:
+        return 'ride'
+    return 'other'
+
+
+def ewma(values, days, initial=0.0, block=128):
+    '''
+    Fitness/fatigue recurrence y[i] = x[i] * (1 - k) + y[i - 1] * k, with k = exp(-1 / days)
+    Solved in closed form (y[i] = k^i * (y[-1] * k + (1 - k) * cumsum(x[j] / k^j))) a block at a time so k^-j
+    can't overflow on long histories
+    :param values: daily stress scores
+    :param days: time constant (7 for ATL, 42 for CTL)
+    :param initial: value of the day before values[0]
+    :return: numpy array the same length as values
+    '''
+    k = np.exp(-1 / days)
+    values = np.asarray(values, dtype='float')
+    out = np.empty(len(values))
+    prev = initial
+    for start in range(0, len(values), block):
+        x = values[start:start + block]
+        powers = k ** np.arange(len(x))
+        out[start:start + len(x)] = powers * (prev * k + (1 - k) * np.cumsum(x / powers))
+        prev = out[start + len(x) - 1]
+    return out
+
+
+def tss_flags(df_summary):
+    # 1 on the workout that caused a higher ftp to be set, -1 for a lower ftp (used to color the stress bars)
+    flags = pd.Series(np.nan, index=df_summary.index)
+    for sport in ['run', 'ride']:
+        df = df_summary[df_summary['type'].fillna('').str.lower().str.contains(sport)]
+        df = df.assign(previous_ftp=df['ftp'].shift(1))
+        df = df[df['previous_ftp'].notnull()]
+        flag = pd.Series(np.select([df['previous_ftp'] > df['ftp'], df['previous_ftp'] < df['ftp']], [-1, 1],
+                                   np.nan), index=df.index)
+        # Highlight the workout which caused the new FTP to be set
+        flag = flag.shift(-1).dropna()
+        flags.loc[flag.index] = flag
+    return flags
+
+
+def update_pmc_daily(athlete_id=1, from_date=None):
+    '''
+    Recompute pmc_daily from from_date (the earliest day with new or changed workouts) forward, seeding the ewma with
+    the stored values of the day before. Rebuilds the whole table when from_date is None or there is nothing to seed from
+    :param athlete_id: athlete to update
+    :param from_date: date
+    '''
+    with db_session() as session:
+        df_summary = pd.read_sql(
+            sql=session.query(stravaSummary.start_date_local, stravaSummary.type, stravaSummary.ftp, stravaSummary.tss,
+                              stravaSummary.hrss, stravaSummary.low_intensity_seconds,
+                              stravaSummary.med_intensity_seconds, stravaSummary.high_intensity_seconds).filter(
+                stravaSummary.athlete_id == athlete_id).order_by(stravaSummary.start_date_local.asc()).statement,
+            con=session.bind)
+
+        first_date, last_date = session.query(func.min(pmcDaily.date), func.max(pmcDaily.date)).filter(
+            pmcDaily.athlete_id == athlete_id).first()
+        if from_date is not None and first_date is not None and pd.Timestamp(from_date).date() > first_date:
+            # Days after the last stored day have to be filled in too
+            from_date = min(pd.Timestamp(from_date).date(), last_date + timedelta(days=1))
+            prior = pd.read_sql(sql=session.query(pmcDaily.sport, pmcDaily.ctl, pmcDaily.atl).filter(
+                pmcDaily.athlete_id == athlete_id, pmcDaily.date == from_date - timedelta(days=1)).statement,
+                                con=session.bind).set_index('sport')
+        else:
+            from_date, prior = None, pd.DataFrame(columns=['ctl', 'atl'])
+
+        if from_date is None:
+            session.execute(delete(pmcDaily).where(pmcDaily.athlete_id == athlete_id))
+        else:
+            session.execute(delete(pmcDaily).where(pmcDaily.athlete_id == athlete_id, pmcDaily.date >= from_date))
+
+    if len(df_summary) == 0:
+        return
+
+    # Sum every workout's stress into its day and sport, with a row for every day/sport so the ewma steps one day at a time
+    df_summary['tss_flag'] = tss_flags(df_summary)
+    # If tss not available, use hrss
+    df_summary['stress_score'] = df_summary['tss'].fillna(df_summary['hrss']).fillna(0)
+    df_summary['date'] = pd.to_datetime(df_summary['start_date_local']).dt.normalize()
+    df_summary['sport'] = df_summary['type'].map(sport_of)
+    dates = pd.date_range(df_summary['date'].min(), df_summary['date'].max(), freq='D')
+    if from_date is not None:
+        dates = dates[dates >= pd.Timestamp(from_date)]
+    if len(dates) == 0:
+        return
+    daily = df_summary.groupby(['sport', 'date'])[daily_columns].sum()
+
+    frames = []
+    for sport in sports:
+        df = daily.loc[sport] if sport in daily.index.get_level_values('sport') else pd.DataFrame(columns=daily_columns)
+        df = df.reindex(dates, fill_value=0).astype('float')
+        df['ctl'] = ewma(df['stress_score'], ctl_days, initial=prior['ctl'].get(sport, 0))
+        df['atl'] = ewma(df['stress_score'], atl_days, initial=prior['atl'].get(sport, 0))
+        df['sport'] = sport
+        frames.append(df)
+
+    df = pd.concat(frames)
+    df['athlete_id'] = athlete_id
+    df.index = df.index.date
+    df.index.name = 'date'
+    db_insert(df, 'pmc_daily')
+
+
+def get_pmc_daily(athlete_id=1):
+    global _rebuilt
+    with db_session() as session:
+        df = pd.read_sql(sql=session.query(pmcDaily).filter(pmcDaily.athlete_id == athlete_id).statement,
+                         con=session.bind)
+    # First load after upgrading, build from all existing workouts
+    if len(df) == 0 and not _rebuilt:
+        update_pmc_daily(athlete_id)
+        _rebuilt = True
+        with db_session() as session:
+            df = pd.read_sql(sql=session.query(pmcDaily).filter(pmcDaily.athlete_id == athlete_id).statement,
+                             con=session.bind)
+    return df
+
+
+def pmc_series(pmc_df, selected_sports, end_date):
+    '''
+    Daily fitness/fatigue series for the selected sports, rolled forward (no stress) through end_date
+    :param pmc_df: pmc_daily rows (get_pmc_daily())
+    :param selected_sports: list of sports (run, ride, other) to sum for CTL and stress
+    :param end_date: last date to return (today + forecast days)
+    :return: df indexed by day with the daily_columns and CTL, ATL
+    '''
+    if len(pmc_df) == 0:
+        # No workouts yet, nothing to decay
+        return pd.DataFrame(0.0, index=pd.DatetimeIndex([pd.Timestamp(end_date)]),
+                            columns=daily_columns + ['CTL', 'ATL'])
+    pmc_df = pmc_df.assign(date=pd.to_datetime(pmc_df['date']))
+    # ATL should always be based off of ALL sports
+    atl = pmc_df.groupby('date')['atl'].sum()
+    df = pmc_df[pmc_df['sport'].isin(selected_sports)].groupby('date')[daily_columns + ['ctl']].sum()
+    df = df.reindex(atl.index, fill_value=0)
+    df['atl'] = atl
+
+    # Decay fitness and fatigue from the last stored day out to end_date
+    last = df.index.max()
+    df = df.reindex(pd.date_range(df.index.min(), max(pd.Timestamp(end_date), last), freq='D'))
+    future = df.index > last
+    days_since = (df.index[future] - last).days.values
+    df.loc[future, daily_columns] = 0
+    df.loc[future, 'ctl'] = df.at[last, 'ctl'] * np.exp(-1 / ctl_days) ** days_since
+    df.loc[future, 'atl'] = df.at[last, 'atl'] * np.exp(-1 / atl_days) ** days_since
+    return df.rename(columns={'ctl': 'CTL', 'atl': 'ATL'})
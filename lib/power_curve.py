@@ -0,0 +1,134 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import delete, func, and_, bindparam
+from lib.sqlalchemy_declarative import db_session, db_insert, stravaMeanMaxPower, powerCurveBests
+from lib.pmc import sport_of
+from lib.mmp import read_mmp_summary, unpack_mmp, sparse_mmp_samples, migrate_best_samples
+
+columns = ['interval', 'activity_id', 'mmp', 'watts_per_kg', 'timestamp_local', 'time_interval', 'date', 'athlete_id']
+
+
+def frontier(df):
+    '''
+    Keep only the efforts that beat every later effort at the same interval. Walking forward in time the kept efforts
+    get weaker, so the best effort since any date is simply the first kept effort on/after that date
+    :param df: best samples with at least interval, mmp and timestamp_local columns
+    :return: df filtered to the frontier
+    '''
+    df = df[df['mmp'].notnull()].sort_values(['interval', 'timestamp_local'], ascending=[True, False])
+    later_best = df.groupby('interval')['mmp'].cummax().groupby(df['interval']).shift(1)
+    return df[later_best.isnull() | (df['mmp'] > later_best)]
+
+
+def rebuild_power_curve_bests(sport=None):
+    '''
+    Rebuild power_curve_bests from strava_mmp, needed after activities are deleted since efforts they beat may come back
+    :param sport: run, ride or other. None rebuilds every sport
+    '''
+    df = read_mmp_summary()
+    with db_session() as session:
+        if sport is None:
+            session.execute(delete(powerCurveBests))
+        else:
+            session.execute(delete(powerCurveBests).where(powerCurveBests.sport == sport))
+
+    df['sport'] = df['type'].map(sport_of)
+    if sport is not None:
+        df = df[df['sport'] == sport]
+    frames = []
+    for (name, x) in df.groupby('sport'):
+        # Walk back from the latest activity, keeping the efforts that beat everything after them
+        later_best = np.full(0, np.nan)
+        rows, intervals, mmp = [], [], []
+        for i in reversed(range(len(x))):
+            curve = unpack_mmp(x['mmp'].iloc[i])
+            if len(curve) > len(later_best):
+                later_best = np.append(later_best, np.full(len(curve) - len(later_best), np.nan))
+            later = later_best[:len(curve)]
+            kept = np.flatnonzero(~np.isnan(curve) & ~(curve <= later))
+            np.fmax(later, curve, out=later)
+            rows.append(np.full(len(kept), i))
+            intervals.append(kept + 1)
+            mmp.append(curve[kept])
+        if len(rows) > 0:
+            frames.append(sparse_mmp_samples(x, np.concatenate(rows), np.concatenate(intervals),
+                                             np.concatenate(mmp)).assign(sport=name))
+    if len(frames) > 0:
+        df = pd.concat(frames)
+        db_insert(df[columns + ['sport']].set_index(['sport', 'interval', 'activity_id']), 'power_curve_bests')
+
+
+def update_power_curve_bests(df):
+    '''
+    Merge a newly inserted activity's best samples into power_curve_bests, only writing the rows that changed
+    :param df: best samples of one activity (mmp_samples() of the curve inserted into strava_mmp)
+    '''
+    df = df.reset_index()
+    sport = sport_of(df['type'].iloc[0])
+    df = df[columns].assign(sport=sport)
+    with db_session() as session:
+        # An activity loaded again replaces its own efforts (efforts only its old curve beat need a rebuild to return)
+        session.execute(delete(powerCurveBests).where(powerCurveBests.sport == sport,
+                                                      powerCurveBests.activity_id.in_(
+                                                          [int(x) for x in df['activity_id'].unique()])))
+    with db_session() as session:
+        # Only the existing rows that survive are kept as is, so just read enough to compare against
+        current = pd.read_sql(
+            sql=session.query(powerCurveBests.interval, powerCurveBests.activity_id, powerCurveBests.mmp,
+                              powerCurveBests.timestamp_local).filter(
+                powerCurveBests.sport == sport,
+                powerCurveBests.interval.between(int(df['interval'].min()), int(df['interval'].max()))).statement,
+            con=session.bind)
+        new = frontier(pd.concat([current, df]))
+        # Efforts the new activity beat drop out of the frontier
+        removed = current.merge(new[['interval', 'activity_id']], how='left', on=['interval', 'activity_id'],
+                                indicator=True)
+        removed = removed[removed['_merge'] == 'left_only']
+        if len(removed) > 0:
+            session.execute(delete(powerCurveBests).where(and_(powerCurveBests.sport == sport,
+                                                               powerCurveBests.interval == bindparam('b_interval'),
+                                                               powerCurveBests.activity_id == bindparam('b_activity_id'))),
+                            [{'b_interval': int(x), 'b_activity_id': int(y)} for (x, y) in
+                             zip(removed['interval'], removed['activity_id'])])
+    added = new[new['activity_id'].isin(df['activity_id'].unique())]
+    if len(added) > 0:
+        db_insert(added.set_index(['sport', 'interval', 'activity_id']), 'power_curve_bests')
+
+
+def best_per_interval(df):
+    # First kept effort in the window is the best of the window
+    if len(df) == 0:
+        return df.set_index('interval')
+    return df.loc[df.groupby('interval')['mmp'].idxmax()].set_index('interval').sort_index()
+
+
+def power_curve_windows(sport, intervals, windows):
+    '''
+    Read the frontier once and split it into each window
+    :param sport: run, ride or other
+    :param intervals: list of interval lengths (seconds)
+    :param windows: dict of name: since datetime (None for all time)
+    :return: dict of name: df indexed by interval
+    '''
+    with db_session() as session:
+        df = pd.read_sql(sql=session.query(powerCurveBests).filter(powerCurveBests.sport == sport,
+                                                                   powerCurveBests.interval.in_(intervals)).statement,
+                         con=session.bind)
+    df['timestamp_local'] = pd.to_datetime(df['timestamp_local'])
+    return {name: best_per_interval(df if since is None else df[df['timestamp_local'] >= since]) for (name, since) in
+            windows.items()}
+
+
+def max_power_curve_interval(sport):
+    migrate_best_samples()
+    with db_session() as session:
+        max_interval = session.query(func.max(powerCurveBests.interval)).filter(powerCurveBests.sport == sport).scalar()
+        # First load after upgrading, build from existing best samples
+        rebuild = max_interval is None and session.query(stravaMeanMaxPower.activity_id).filter(
+            stravaMeanMaxPower.type.ilike('%' + sport + '%')).first() is not None
+    if rebuild:
+        rebuild_power_curve_bests()
+        with db_session() as session:
+            max_interval = session.query(func.max(powerCurveBests.interval)).filter(
+                powerCurveBests.sport == sport).scalar()
+    return max_interval
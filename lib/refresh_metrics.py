@@ -0,0 +1,162 @@
+import time
+import threading
+import pandas as pd
+from datetime import datetime
+from contextlib import contextmanager
+from functools import wraps
+from sqlalchemy import event
+from lib.sqlalchemy_declarative import db_insert, get_engine
+
+# Refresh being measured and the metric rows open on each thread (innermost last). Rows written, http calls and bytes
+# are added to every open row, so a stage's totals include the activities scraped within it
+_local = threading.local()
+_counter_lock = threading.Lock()
+
+
+def _open_rows():
+    if not hasattr(_local, 'rows'):
+        _local.rows = []
+    return _local.rows
+
+
+class RefreshMetrics(object):
+    '''
+    Collects the refresh_stage_metrics rows of one refresh
+    '''
+
+    def __init__(self):
+        self.rows = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def track(self, stage, activity_id=None):
+        '''
+        Measure the with block as a stage of this refresh. Wall and cpu time are of the current thread only, work
+        handed to other threads only counts if wrapped with propagate()
+        :param stage: name of the stage (or activity step)
+        :param activity_id: activity the step belongs to, None for refresh stages
+        '''
+        open_rows = _open_rows()
+        row = {'stage': stage, 'parent': open_rows[-1]['stage'] if len(open_rows) > 0 else None,
+               'activity_id': activity_id, 'started_utc': datetime.utcnow(), 'rows_written': 0, 'http_calls': 0,
+               'bytes_downloaded': 0}
+        previous = getattr(_local, 'refresh', None)
+        _local.refresh = self
+        open_rows.append(row)
+        wall, cpu = time.monotonic(), time.thread_time()
+        try:
+            yield row
+        finally:
+            row['wall_seconds'] = time.monotonic() - wall
+            row['cpu_seconds'] = time.thread_time() - cpu
+            # By identity, rows still open on this thread can hold the same values
+            del open_rows[max(i for i, x in enumerate(open_rows) if x is row)]
+            _local.refresh = previous
+            with self.lock:
+                self.rows.append(row)
+
+    def call(self, stage, func, *args, **kwargs):
+        # Run func as a stage of this refresh (i.e. submitted to a thread pool)
+        with self.track(stage):
+            return func(*args, **kwargs)
+
+    def write(self, refresh_utc):
+        '''
+        Insert the collected rows
+        :param refresh_utc: db_refresh.timestamp_utc of the refresh
+        '''
+        with self.lock:
+            rows = list(self.rows)
+        if len(rows) > 0:
+            db_insert(pd.DataFrame(rows).assign(refresh_utc=refresh_utc).set_index('refresh_utc'),
+                      'refresh_stage_metrics')
+
+
+@contextmanager
+def track(stage, activity_id=None):
+    # Measure the with block as a stage of the refresh running on this thread, does nothing outside of a refresh
+    refresh = getattr(_local, 'refresh', None)
+    if refresh is None:
+        yield None
+    else:
+        with refresh.track(stage, activity_id) as row:
+            yield row
+
+
+def tracked(func):
+    '''
+    Decorator measuring a FitlyActivity method as a step of the activity (see track())
+    '''
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with track(func.__name__, activity_id=self.id):
+            return func(self, *args, **kwargs)
+
+    return wrapper
+
+
+def propagate(func):
+    '''
+    Wrap func so when run on another thread it counts towards the refresh stages open on this thread
+    :param func: function to be submitted to a thread pool
+    '''
+    refresh, open_rows = getattr(_local, 'refresh', None), list(_open_rows())
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'refresh', None), _open_rows()
+        _local.refresh, _local.rows = refresh, list(open_rows)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.refresh, _local.rows = previous
+
+    return wrapper
+
+
+def count(**counters):
+    '''
+    Add to the counters of every row open on this thread
+    :param counters: rows_written, http_calls and/or bytes_downloaded
+    '''
+    open_rows = _open_rows()
+    if len(open_rows) > 0:
+        with _counter_lock:
+            for row in open_rows:
+                for name, value in counters.items():
+                    row[name] += value
+
+
+def rows_written():
+    # Rows written so far by the innermost stage open on this thread, None outside of a refresh
+    open_rows = _open_rows()
+    return open_rows[-1]['rows_written'] if len(open_rows) > 0 else None
+
+
+def _count_rows_written(conn, cursor, statement, parameters, context, executemany):
+    # Inserts through db_insert (pandas to_sql) and session writes all run through the engine
+    if context is not None and (context.isinsert or context.isupdate or context.isdelete) and cursor.rowcount > 0:
+        count(rows_written=cursor.rowcount)
+
+
+def count_http(session):
+    '''
+    Count the calls made through a provider api client's requests session towards the refresh stages open on the
+    calling thread
+    :param session: requests.Session (or subclass, i.e. OAuth2Session) the client sends its requests with
+    :return: session
+    '''
+    if _count_response not in session.hooks['response']:
+        session.hooks['response'].append(_count_response)
+    return session
+
+
+def _count_response(response, **kwargs):
+    # Response hook, kwargs are the ones the request was sent with
+    if len(_open_rows()) > 0:
+        # Unless streamed, Session.send reads the body right after the hooks anyway
+        size = response.headers.get('Content-Length', 0) if kwargs.get('stream') else len(response.content)
+        count(http_calls=1, bytes_downloaded=int(size))
+
+event.listen(get_engine(), 'after_cursor_execute', _count_rows_written)
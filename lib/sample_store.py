@@ -0,0 +1,143 @@
+import os
+import glob
+import pandas as pd
+import configparser
+from lib.sqlalchemy_declarative import db_session, db_insert, stravaSamples, stravaSummary
+from lib.refresh_metrics import count
+from sqlalchemy import delete
+from dash_app import dash_app
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+config = configparser.ConfigParser()
+config.read('./config.ini')
+
+# Every column of strava_samples but the index, what a full read returns whichever store the samples are in
+sample_columns = [x.name for x in stravaSamples.__table__.columns if x.name != 'timestamp_local']
+
+
+class SqliteSampleStore(object):
+    '''
+    Activity samples as rows of the strava_samples table (default)
+    '''
+
+    def write(self, activity_id, df_samples):
+        db_insert(df_samples, 'strava_samples')
+
+    def read(self, activity_id, columns=None):
+        '''
+        :param activity_id: activity to read
+        :param columns: optional list of columns to read, None for all of them
+        :return: df indexed by timestamp_local
+        '''
+        with db_session() as session:
+            return pd.read_sql(sql=self._query(session, columns).filter(
+                stravaSamples.activity_id == activity_id).statement, con=session.bind, index_col=['timestamp_local'])
+
+    def read_since(self, start, columns=None):
+        # Samples of every activity from start (timestamp_local) onwards
+        with db_session() as session:
+            return pd.read_sql(sql=self._query(session, columns).filter(
+                stravaSamples.timestamp_local >= start).statement, con=session.bind, index_col=['timestamp_local'])
+
+    def delete(self, activity_ids=None):
+        # Delete the samples of activity_ids, everything if None
+        with db_session() as session:
+            if activity_ids is None:
+                session.execute(delete(stravaSamples))
+            else:
+                # Chunked to stay under sqlite's bound parameter limit
+                for i in range(0, len(activity_ids), 500):
+                    session.execute(delete(stravaSamples).where(
+                        stravaSamples.activity_id.in_([int(x) for x in activity_ids[i:i + 500]])))
+
+    def _query(self, session, columns):
+        if columns is None:
+            return session.query(stravaSamples)
+        return session.query(stravaSamples.timestamp_local, *[getattr(stravaSamples, x) for x in columns])
+
+
+class ArrowSampleStore(object):
+    '''
+    Activity samples as one uncompressed Arrow IPC file per activity, read through a memory map so only the
+    requested columns are ever loaded
+    :param path: directory holding the files
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, activity_id):
+        return os.path.join(self.path, '{}.arrow'.format(int(activity_id)))
+
+    def write(self, activity_id, df_samples):
+        df = df_samples.reset_index()
+        # Per activity constants are categoricals (see fitlyAPI.sample_schema), store them as plain values as
+        # strava_samples does instead of as arrow dictionaries
+        for column in df.select_dtypes('category').columns:
+            df[column] = df[column].astype(df[column].cat.categories.dtype)
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        # Write to a temp file first so a reader never maps a half written file
+        tmp = self._file(activity_id) + '.tmp'
+        with pa.OSFile(tmp, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp, self._file(activity_id))
+        count(rows_written=len(df_samples))
+
+    def read(self, activity_id, columns=None):
+        '''
+        :param activity_id: activity to read
+        :param columns: optional list of columns to read, None for all of them
+        :return: df indexed by timestamp_local
+        '''
+        if not os.path.exists(self._file(activity_id)):
+            return self._empty(columns)
+        with pa.memory_map(self._file(activity_id), 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+            # Files only hold the streams the activity has, the others come back as nan as they do from strava_samples
+            columns = sample_columns if columns is None else columns
+            table = table.select(['timestamp_local'] + [x for x in columns if x in table.column_names])
+            return table.to_pandas().set_index('timestamp_local').reindex(columns=columns)
+
+    def read_since(self, start, columns=None):
+        # Samples of every activity from start (timestamp_local) onwards
+        frames = [self.read(x, columns) for x in self._activities_since(start)]
+        if len(frames) == 0:
+            return self._empty(columns)
+        df = pd.concat(frames)
+        return df[df.index >= start]
+
+    def delete(self, activity_ids=None):
+        # Delete the samples of activity_ids, everything if None
+        files = glob.glob(os.path.join(self.path, '*.arrow')) if activity_ids is None else [
+            self._file(x) for x in activity_ids]
+        for file in files:
+            if os.path.exists(file):
+                os.remove(file)
+
+    def _empty(self, columns):
+        if columns is None:
+            columns = sample_columns
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='timestamp_local'))
+
+    def _activities_since(self, start, lookback=pd.Timedelta(days=1)):
+        # Activities started since start, by default including the day before since those can run past start
+        with db_session() as session:
+            return [x[0] for x in session.query(stravaSummary.activity_id).filter(
+                stravaSummary.start_date_local >= pd.to_datetime(start) - lookback).all()]
+
+
+def get_sample_store():
+    if config.get('samples', 'backend', fallback='sqlite') == 'arrow':
+        if pa is not None:
+            return ArrowSampleStore(config.get('samples', 'path', fallback='./samples'))
+        dash_app.server.logger.warning('pyarrow is not installed, storing samples in sqlite')
+    return SqliteSampleStore()
+
+
+sample_store = get_sample_store()
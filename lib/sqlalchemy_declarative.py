@@ -1,8 +1,16 @@
 import sys
-from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, Float, create_engine, BigInteger
+import hashlib
+import threading
+from datetime import datetime
+from contextlib import contextmanager
+from sqlalchemy import Column, Integer, String, Boolean, DateTime, Date, Float, create_engine, BigInteger, event, \
+    LargeBinary, text, delete
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, scoped_session
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.pool import QueuePool
 import configparser
+import pandas as pd
 
 config = configparser.ConfigParser()
 config.read('./config.ini')
@@ -19,15 +27,51 @@ Base = declarative_base()
 
 db = 'sqlite:///fitness.db'
 
+# Pragmas applied to every new sqlite connection checked into the pool
+sqlite_pragmas = {
+    'journal_mode': 'WAL',  # Readers (dash callbacks) no longer block on the refresh writer
+    'synchronous': 'NORMAL',  # Safe with WAL, avoids an fsync on every commit
+    'cache_size': -64000,  # Negative value is in KiB, so ~64MB page cache per connection
+    'mmap_size': 268435456,  # 256MB memory mapped reads
+    'temp_store': 'MEMORY',
+}
+
+# One engine (and connection pool) per db url for the life of the process
+_engines = {}
+_session_factories = {}
+_engine_lock = threading.Lock()
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in sqlite_pragmas.items():
+        cursor.execute('PRAGMA {}={}'.format(pragma, value))
+    cursor.close()
+
+
+def get_engine(db=db):
+    engine = _engines.get(db)
+    if engine is None:
+        with _engine_lock:
+            engine = _engines.get(db)
+            if engine is None:
+                if db.startswith('sqlite'):
+                    # Dash callbacks and the refresh scheduler share connections across threads
+                    engine = create_engine(db, poolclass=QueuePool, pool_size=5, max_overflow=10, pool_pre_ping=True,
+                                           connect_args={'check_same_thread': False, 'timeout': 30})
+                    event.listen(engine, 'connect', set_sqlite_pragmas)
+                else:
+                    engine = create_engine(db, pool_size=5, max_overflow=10, pool_pre_ping=True, pool_recycle=3600)
+                _session_factories[db] = sessionmaker(bind=engine)
+                _engines[db] = engine
+    return engine
+
 
 def db_connect(db=db):
     try:
         # Engine needs to be set to exact location for automation to work
-        engine = create_engine(db)
-        session_factory = sessionmaker(bind=engine)
-        Session = scoped_session(session_factory)
-        session = Session()
-        Session.remove()
+        engine = get_engine(db)
+        session = _session_factories[db]()
         return session, engine
     except Exception as e:
         print('Error setting up DB: ', str(e))
@@ -35,12 +79,97 @@ def db_connect(db=db):
         sys.exit()
 
 
+@contextmanager
+def db_session(db=db):
+    '''
+    Session scoped to a with block. Commits on success, rolls back on error, and always returns the connection to the
+    pool. Use session.bind for pd.read_sql / to_sql calls.
+    '''
+    session, engine = db_connect(db)
+    try:
+        yield session
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
 def db_insert(df, tableName):
-    session, engine = db_connect()
     # Insert into DB
-    df.to_sql(tableName, engine, if_exists='append', index=True)
-    engine.dispose()
-    session.close()
+    df.to_sql(tableName, get_engine(), if_exists='append', index=True)
+
+
+def db_upsert(df, tableName, day_column=None):
+    '''
+    Write df into tableName keyed on the table's primary key (the df index), one day at a time. Days hashing the same
+    as the last time they were written are skipped. Rows of the other days are inserted, or updated only where a value
+    differs, and rows of those days no longer in df are deleted. SQLite only (INSERT ... ON CONFLICT)
+    :param df: rows indexed by the table's primary key
+    :param tableName: table to write
+    :param day_column: column holding the day of each row, None if the index is the day
+    :return: dict of inserted, updated, deleted and unchanged row counts
+    '''
+    counts = {'inserted': 0, 'updated': 0, 'deleted': 0, 'unchanged': len(df)}
+    if len(df) == 0:
+        return counts
+    days = pd.DatetimeIndex(pd.to_datetime(df.index if day_column is None else df[day_column])).strftime('%Y-%m-%d')
+    # Column names are part of the hash so a change in what is stored rewrites every day
+    columns = ','.join([str(x) for x in [df.index.name] + list(df.columns)]).encode()
+    day_hashes = pd.Series(pd.util.hash_pandas_object(df, index=True).values).groupby(days.values).apply(
+        lambda x: hashlib.sha1(columns + x.values.tobytes()).hexdigest())
+
+    with db_session() as session:
+        written = dict(session.query(ingestHashes.day, ingestHashes.hash).filter(
+            ingestHashes.table_name == tableName, ingestHashes.day.in_(day_hashes.index.tolist())).all())
+    changed = day_hashes[[written.get(day) != day_hash for (day, day_hash) in day_hashes.items()]]
+    if len(changed) == 0:
+        return counts
+    df = df[days.isin(changed.index)]
+
+    # Staged through to_sql so values are stored in the same format db_insert() always wrote them in
+    staging, key = tableName + '_staging', '"{}"'.format(df.index.name)
+    values = ['"{}"'.format(x) for x in df.columns]
+    with get_engine().begin() as connection:
+        df.to_sql(staging, connection, if_exists='replace', index=True)
+        matched = connection.execute(text('SELECT count(*) FROM {0} WHERE {1} IN (SELECT {1} FROM {2})'.format(
+            tableName, key, staging))).scalar()
+        if day_column is not None:
+            counts['deleted'] = connection.execute(text(
+                'DELETE FROM {0} WHERE "{3}" IN (SELECT "{3}" FROM {2}) AND {1} NOT IN (SELECT {1} FROM {2})'.format(
+                    tableName, key, staging, day_column))).rowcount
+        # WHERE true is needed by sqlite to parse an upsert from a SELECT
+        written_rows = connection.execute(text(
+            'INSERT INTO {0} ({1}, {2}) SELECT {1}, {2} FROM {3} WHERE true ON CONFLICT({1}) DO UPDATE SET {4} '
+            'WHERE {5}'.format(tableName, key, ', '.join(values), staging,
+                               ', '.join(['{0} = excluded.{0}'.format(x) for x in values]),
+                               ' OR '.join(['{0}.{1} IS NOT excluded.{1}'.format(tableName, x) for x in values])))
+        ).rowcount
+        connection.execute(text('DROP TABLE {}'.format(staging)))
+        connection.execute(sqlite_insert(ingestHashes.__table__).values(
+            [{'table_name': tableName, 'day': day, 'hash': day_hash, 'updated_utc': datetime.utcnow()} for
+             (day, day_hash) in changed.items()]).on_conflict_do_update(
+            index_elements=['table_name', 'day'],
+            set_={'hash': text('excluded.hash'), 'updated_utc': text('excluded.updated_utc')}))
+
+    counts['inserted'] = len(df) - matched
+    counts['updated'] = written_rows - counts['inserted']
+    counts['unchanged'] -= counts['inserted'] + counts['updated']
+    return counts
+
+
+def clear_ingest_hashes(session, tableNames, since=None):
+    '''
+    Forget the days db_upsert() wrote to tables that are being truncated, so the next pull writes them again
+    :param session: session the truncate runs in
+    :param tableNames: tables written with db_upsert()
+    :param since: optional first day truncated, None for every day
+    '''
+    query = delete(ingestHashes).where(ingestHashes.table_name.in_(tableNames))
+    if since is not None:
+        query = query.where(ingestHashes.day >= pd.to_datetime(since).strftime('%Y-%m-%d'))
+    session.execute(query)
 
 
 ##### Athlete Table #####
@@ -132,20 +261,40 @@ class stravaSamples(Base):
     hr_lowest = Column('hr_lowest', Integer())
 
 
-class stravaBestSamples(Base):
-    __tablename__ = 'strava_best_samples'
-    activity_id = Column('activity_id', BigInteger(), index=True, primary_key=True)
-    interval = Column('interval', Integer, index=True, primary_key=True)
+class stravaMeanMaxPower(Base):
+    # One row per activity, mean max power for every duration packed as little endian float32 (see lib/mmp.py)
+    __tablename__ = 'strava_mmp'
+    activity_id = Column('activity_id', BigInteger(), primary_key=True)
+    athlete_id = Column('athlete_id', BigInteger())
+    type = Column('type', String(255))
+    start_date_local = Column('start_date_local', DateTime(), index=True)
+    mmp = Column('mmp', LargeBinary())
+
+
+class powerCurveBests(Base):
+    # Efforts from strava_mmp that beat every later effort at the same interval (see lib/power_curve.py)
+    __tablename__ = 'power_curve_bests'
+    sport = Column('sport', String(255), primary_key=True)
+    interval = Column('interval', Integer, primary_key=True)
+    activity_id = Column('activity_id', BigInteger(), primary_key=True)
     mmp = Column('mmp', Float())
     watts_per_kg = Column('watts_per_kg', Float())
     timestamp_local = Column('timestamp_local', DateTime())
     time_interval = Column('time_interval', DateTime())
-    type = Column('type', String(255))
     date = Column('date', Date())
-    act_name = Column('act_name', String(255))
     athlete_id = Column('athlete_id', BigInteger())
 
 
+class stravaZoneSeconds(Base):
+    # Seconds spent in each power/hr zone per activity, counted at ingest for the zone charts
+    __tablename__ = 'strava_zone_seconds'
+    activity_id = Column('activity_id', BigInteger(), primary_key=True)
+    metric = Column('metric', String(20), primary_key=True)
+    zone = Column('zone', Integer(), primary_key=True)
+    seconds = Column('seconds', Integer())
+    start_date_local = Column('start_date_local', DateTime(), index=True)
+
+
 class stravaSummary(Base):
     __tablename__ = 'strava_summary'
     start_date_utc = Column('start_date_utc', DateTime(), index=True, primary_key=True)
@@ -196,6 +345,22 @@ class stravaSummary(Base):
     weight = Column('weight', Float())
 
 
+class pmcDaily(Base):
+    __tablename__ = 'pmc_daily'
+    athlete_id = Column('athlete_id', Integer(), primary_key=True)
+    date = Column('date', Date(), index=True, primary_key=True)
+    sport = Column('sport', String(255), primary_key=True)  # run, ride or other
+    stress_score = Column('stress_score', Float())
+    tss = Column('tss', Float())
+    hrss = Column('hrss', Float())
+    low_intensity_seconds = Column('low_intensity_seconds', Float())
+    med_intensity_seconds = Column('med_intensity_seconds', Float())
+    high_intensity_seconds = Column('high_intensity_seconds', Float())
+    tss_flag = Column('tss_flag', Float())
+    ctl = Column('ctl', Float())
+    atl = Column('atl', Float())
+
+
 ##### Oura Tables #####
 class ouraReadinessSummary(Base):
     __tablename__ = 'oura_readiness_summary'
@@ -329,6 +494,22 @@ class dbRefreshStatus(Base):
     fitbod_status = Column('fitbod_status', String(255))
 
 
+class refreshStageMetrics(Base):
+    # A row per refresh stage and per step of each activity scraped (see lib/refresh_metrics.py)
+    __tablename__ = 'refresh_stage_metrics'
+    id = Column('id', Integer(), index=True, primary_key=True, autoincrement=True)
+    refresh_utc = Column('refresh_utc', DateTime(), index=True)  # db_refresh.timestamp_utc
+    stage = Column('stage', String(255))
+    parent = Column('parent', String(255))  # Stage this one ran within
+    activity_id = Column('activity_id', BigInteger())
+    started_utc = Column('started_utc', DateTime())
+    wall_seconds = Column('wall_seconds', Float())
+    cpu_seconds = Column('cpu_seconds', Float())
+    rows_written = Column('rows_written', Integer())
+    http_calls = Column('http_calls', Integer())
+    bytes_downloaded = Column('bytes_downloaded', BigInteger())
+
+
 class withings(Base):
     __tablename__ = 'withings'
     date_utc = Column('date_utc', DateTime(), index=True, primary_key=True)
@@ -349,6 +530,22 @@ class fitbod(Base):
     note = Column('Note', String(255))
     one_rep_max = Column('one_rep_max', Float())
     weight_duration_max = Column('weight_duration_max', Float())
+    # Content hash of the set (see fitbodAPI.set_hashes), so re-imported exports only insert new sets
+    set_hash = Column('set_hash', String(40), index=True)
+    # Day of date_UTC, so a workout's sets are an indexed lookup instead of casting every row's timestamp
+    workout_date = Column('workout_date', Date(), index=True)
+
+
+class fitbodDailyBests(Base):
+    # Highest volume set of each exercise per day, what 1rms are estimated from (see lib/fitbod_bests.py)
+    __tablename__ = 'fitbod_daily_bests'
+    exercise = Column('Exercise', String(255), primary_key=True)
+    workout_date = Column('workout_date', Date(), primary_key=True, index=True)
+    set_id = Column('set_id', Integer())
+    reps = Column('Reps', Integer())
+    weight = Column('Weight', Float())
+    duration = Column('Duration', Integer())
+    volume = Column('Volume', Float())
 
 
 class fitbod_muscles(Base):
@@ -357,60 +554,84 @@ class fitbod_muscles(Base):
     muscle = Column('Muscle', String(255))
 
 
-session, engine = db_connect()
-Base.metadata.create_all(engine)
-athlete_exists = True if len(session.query(athlete).all()) > 0 else False
-# If no athlete created in db, create one
-if not athlete_exists:
-    from datetime import datetime
-
-    dummy_athlete = athlete(
-        name='Athelte Name',
-        birthday=datetime.now(),
-        sex='M',
-        weight_lbs=150,
-        min_non_warmup_workout_time=900,
-        weekly_tss_goal=150,
-        rr_max_goal=8,
-        rr_min_goal=5,
-        weekly_workout_goal=100,
-        weekly_yoga_goal=100,
-        weekly_sleep_score_goal=3,
-        weekly_readiness_score_goal=3,
-        weekly_activity_score_goal=3,
-        daily_sleep_hr_target=8,
-        ftp_test_notification_week_threshold=6,
-        cycle_power_zone_threshold_1=.55,
-        cycle_power_zone_threshold_2=.75,
-        cycle_power_zone_threshold_3=.9,
-        cycle_power_zone_threshold_4=1.05,
-        cycle_power_zone_threshold_5=1.2,
-        cycle_power_zone_threshold_6=1.5,
-        run_power_zone_threshold_1=0.8,
-        run_power_zone_threshold_2=0.9,
-        run_power_zone_threshold_3=1,
-        run_power_zone_threshold_4=1.15,
-        hr_zone_threshold_1=.6,
-        hr_zone_threshold_2=.7,
-        hr_zone_threshold_3=.8,
-        hr_zone_threshold_4=.9)
-    session.add(dummy_athlete)
-    session.commit()
-
-db_refresh_record = True if len(session.query(dbRefreshStatus).all()) > 0 else False
-# Insert initial system load refresh record
-if not db_refresh_record:
-    from datetime import datetime
-
-    dummy_db_refresh_record = dbRefreshStatus(
-        timestamp_utc=datetime.utcnow(),
-        process='system',
-        oura_status='System Startup',
-        strava_status='System Startup',
-        withings_status='System Startup',
-        fitbod_status='System Startup')
-    session.add(dummy_db_refresh_record)
-    session.commit()
-
-engine.dispose()
-session.close()
+class ingestHashes(Base):
+    # Content hash of each day last written to a table by db_upsert(), so unchanged days are skipped
+    __tablename__ = 'ingest_hashes'
+    table_name = Column('table_name', String(255), primary_key=True)
+    day = Column('day', String(10), primary_key=True)
+    hash = Column('hash', String(40))
+    updated_utc = Column('updated_utc', DateTime())
+
+
+class dataVersions(Base):
+    # Bumped whenever a table's data changes, used to invalidate cached page callbacks (see lib/callback_cache.py)
+    __tablename__ = 'data_versions'
+    table_name = Column('table_name', String(255), primary_key=True)
+    version = Column('version', Integer())
+    updated_utc = Column('updated_utc', DateTime())
+
+
+class pelotonWorkouts(Base):
+    __tablename__ = 'peloton_workouts'
+    workout_id = Column('workout_id', String(255), primary_key=True)
+    start_utc = Column('start_utc', DateTime(), index=True)
+    end_utc = Column('end_utc', DateTime())
+    type = Column('type', String(255))
+    name = Column('name', String(255))
+
+
+Base.metadata.create_all(get_engine())
+
+with db_session() as session:
+    athlete_exists = True if len(session.query(athlete).all()) > 0 else False
+    # If no athlete created in db, create one
+    if not athlete_exists:
+        from datetime import datetime
+
+        dummy_athlete = athlete(
+            name='Athelte Name',
+            birthday=datetime.now(),
+            sex='M',
+            weight_lbs=150,
+            min_non_warmup_workout_time=900,
+            weekly_tss_goal=150,
+            rr_max_goal=8,
+            rr_min_goal=5,
+            weekly_workout_goal=100,
+            weekly_yoga_goal=100,
+            weekly_sleep_score_goal=3,
+            weekly_readiness_score_goal=3,
+            weekly_activity_score_goal=3,
+            daily_sleep_hr_target=8,
+            ftp_test_notification_week_threshold=6,
+            cycle_power_zone_threshold_1=.55,
+            cycle_power_zone_threshold_2=.75,
+            cycle_power_zone_threshold_3=.9,
+            cycle_power_zone_threshold_4=1.05,
+            cycle_power_zone_threshold_5=1.2,
+            cycle_power_zone_threshold_6=1.5,
+            run_power_zone_threshold_1=0.8,
+            run_power_zone_threshold_2=0.9,
+            run_power_zone_threshold_3=1,
+            run_power_zone_threshold_4=1.15,
+            hr_zone_threshold_1=.6,
+            hr_zone_threshold_2=.7,
+            hr_zone_threshold_3=.8,
+            hr_zone_threshold_4=.9)
+        session.add(dummy_athlete)
+        session.commit()
+
+    db_refresh_record = True if len(session.query(dbRefreshStatus).all()) > 0 else False
+    # Insert initial system load refresh record
+    if not db_refresh_record:
+        from datetime import datetime
+
+        dummy_db_refresh_record = dbRefreshStatus(
+            timestamp_utc=datetime.utcnow(),
+            process='system',
+            oura_status='System Startup',
+            strava_status='System Startup',
+            withings_status='System Startup',
+            fitbod_status='System Startup')
+        session.add(dummy_db_refresh_record)
+        session.commit()
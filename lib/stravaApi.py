@@ -1,4 +1,7 @@
 from stravalib.client import Client
+from stravalib.util.limiter import get_rates_from_response_headers, get_seconds_until_next_quarter
+from stravalib import exc
+import threading
 import datetime
 from datetime import datetime
 from sqlalchemy import delete
@@ -7,6 +10,8 @@ import configparser
 from dash_app import dash_app
 import ast
 import time
+import requests
+from lib.refresh_metrics import count_http
 
 config = configparser.ConfigParser()
 config.read('./config.ini')
@@ -21,7 +26,6 @@ def current_token_dict():
         session, engine = db_connect()
         token_dict = session.query(apiTokens.tokens).filter(apiTokens.service == 'Strava').first()
         token_dict = ast.literal_eval(token_dict[0]) if token_dict else {}
-        engine.dispose()
         session.close()
     except BaseException as e:
         dash_app.server.logger.error(e)
@@ -39,14 +43,52 @@ def save_strava_token(token_dict):
     dash_app.server.logger.debug('Inserting new strava tokens')
     session.add(apiTokens(date_utc=datetime.utcnow(), service='Strava', tokens=str(token_dict)))
     session.commit()
-    engine.dispose()
     session.close()
 
 
-def get_strava_client():
+class DailyRateLimitExceeded(exc.RateLimitExceeded):
+    # stravalib's RateLimitExceeded drops its message, keep it so the refresh status recorded says why strava stopped
+    def __init__(self, msg, limit=None):
+        super(DailyRateLimitExceeded, self).__init__(msg, limit=limit)
+        self.args = (msg,)
+
+
+class StravaRateLimiter(object):
+    '''
+    Rate limiter that can be shared by every thread downloading from strava with the same client
+    Sleeps until the next 15 minute window when the short term limit is close, and raises once the daily limit
+    is close so the refresh stops and picks up the remaining activities on the next run
+    :param buffer: number of requests to hold back from each limit (requests already in flight on other threads)
+    '''
+
+    def __init__(self, buffer=4):
+        self.buffer = buffer
+        self.lock = threading.Lock()
+
+    def __call__(self, response_headers, *args):
+        rates = get_rates_from_response_headers(response_headers)
+        if not rates:
+            return
+        # Hold the lock while sleeping so the other download threads wait for the new window too
+        with self.lock:
+            if rates.long_usage >= rates.long_limit - self.buffer:
+                dash_app.server.logger.warning(
+                    'Strava daily rate limit reached ({}/{})'.format(rates.long_usage, rates.long_limit))
+                raise DailyRateLimitExceeded('Strava daily rate limit reached ({}/{})'.format(
+                    rates.long_usage, rates.long_limit), limit=rates.long_limit)
+            elif rates.short_usage >= rates.short_limit - self.buffer:
+                wait = get_seconds_until_next_quarter() + 1
+                dash_app.server.logger.info(
+                    'Strava 15 minute rate limit reached ({}/{}), sleeping {} seconds'.format(rates.short_usage,
+                                                                                                rates.short_limit,
+                                                                                                wait))
+                time.sleep(wait)
+
+
+def get_strava_client(rate_limiter=None):
     token_dict = current_token_dict()
     if token_dict:
-        client = Client()
+        client = Client(rate_limiter=rate_limiter, requests_session=count_http(requests.Session()))
         client.access_token = token_dict['access_token']
         client.refresh_token = token_dict['refresh_token']
         # If token is old, refresh it
@@ -60,7 +102,7 @@ def get_strava_client():
             client.access_token = refresh_response['access_token']
             client.refresh_token = refresh_response['refresh_token']
     else:
-        client = Client()
+        client = Client(rate_limiter=rate_limiter, requests_session=count_http(requests.Session()))
 
     return client
 
@@ -1,15 +1,18 @@
 import configparser
 import requests
 import datetime
+import os
+import threading
 import pandas as pd
 from dash_app import dash_app
+from lib.refresh_metrics import count_http
 
 config = configparser.ConfigParser()
 config.read('./config.ini')
 
-def auth_stryd_session():
+def auth_stryd_session(session=requests):
     requestJSON = {"email": config.get('stryd', 'username'), "password": config.get('stryd', 'password')}
-    responseData = requests.post("https://www.stryd.com/b/email/signin", json=requestJSON)
+    responseData = session.post("https://www.stryd.com/b/email/signin", json=requestJSON)
     if responseData.status_code != 200:
         dash_app.server.logger.debug("Stryd could not authenticate")
         authenticated = False
@@ -22,23 +25,97 @@ def auth_stryd_session():
         sessionID = tempData['token']
     return sessionID
 
+
+class StrydClient(object):
+    '''
+    Stryd calendar client that reuses one http session and auth token, and caches the calendar summary in memory and
+    on disk. Once the cache is older than cache_ttl only the days after the last cached workout are requested
+    :param cache_path: pickle file the calendar df is persisted to between runs
+    :param cache_ttl: timedelta the cached calendar is served without checking stryd for new workouts
+    :param token_ttl: timedelta before re-authenticating
+    :param days_back: how far back the first (uncached) pull goes
+    '''
+
+    def __init__(self, cache_path='./stryd_calendar.pkl', cache_ttl=datetime.timedelta(hours=1),
+                 token_ttl=datetime.timedelta(hours=12), days_back=180):
+        self.cache_path = cache_path
+        self.cache_ttl = cache_ttl
+        self.token_ttl = token_ttl
+        self.days_back = days_back
+        self.session = count_http(requests.Session())
+        self.token = None
+        self.token_time = None
+        self.df = None
+        self.fetched_at = None
+        self.lock = threading.Lock()
+
+    def get_token(self, refresh=False):
+        if refresh or self.token is None or datetime.datetime.now() - self.token_time > self.token_ttl:
+            self.token = auth_stryd_session(self.session)
+            self.token_time = datetime.datetime.now()
+        return self.token
+
+    def load_cache(self):
+        if self.df is None and os.path.exists(self.cache_path):
+            try:
+                cache = pd.read_pickle(self.cache_path)
+                self.df, self.fetched_at = cache['df'], cache['fetched_at']
+            except BaseException as e:
+                dash_app.server.logger.error('Could not read stryd cache: {}'.format(e))
+
+    def save_cache(self):
+        try:
+            pd.to_pickle({'df': self.df, 'fetched_at': self.fetched_at}, self.cache_path)
+        except BaseException as e:
+            dash_app.server.logger.error('Could not write stryd cache: {}'.format(e))
+
+    def fetch_calendar(self, start, end):
+        jsonData = {'srtDate': start.strftime("%m-%d-%Y"), 'endDate': end.strftime("%m-%d-%Y"), 'sortBy': 'StartDate'}
+        url = "https://www.stryd.com/b/api/v1/activities/calendar"
+        responseData = self.session.get(url, headers={'Authorization': 'Bearer: {}'.format(self.get_token())},
+                                        params=jsonData)
+        # Token expired early, sign in again and retry once
+        if responseData.status_code == 401:
+            responseData = self.session.get(url,
+                                            headers={'Authorization': 'Bearer: {}'.format(self.get_token(refresh=True))},
+                                            params=jsonData)
+        df = pd.DataFrame(responseData.json()['activities'])  # returns summary data for each workout
+        if len(df) == 0:
+            return pd.DataFrame(columns=['stryd_ftp', 'RSS'], index=pd.DatetimeIndex([], name='timestamp'))
+        df['timestamp'] = df['timestamp'].apply(datetime.datetime.fromtimestamp)
+        df.set_index(pd.to_datetime(df['timestamp']), inplace=True)
+        # Specify which columns from stryd we want to bring over
+        df = df[['ftp', 'stress']]
+        df.rename(columns={"ftp": "stryd_ftp", "stress": "RSS"}, inplace=True)
+        return df
+
+    def get_df_summary(self):
+        with self.lock:
+            self.load_cache()
+            now = datetime.datetime.now()
+            if self.df is not None and now - self.fetched_at < self.cache_ttl:
+                return self.df.copy()
+
+            end = now + datetime.timedelta(days=1)  # Pass tomorrow's date to ensure no issues with timezones
+            if self.df is None or len(self.df) == 0:
+                self.df = self.fetch_calendar(end - datetime.timedelta(days=self.days_back), end)
+            else:
+                # Only ask for the days since the last cached workout (overlapping a day for timezones)
+                new_df = self.fetch_calendar(self.df.index.max() - datetime.timedelta(days=1), end)
+                df = pd.concat([self.df, new_df])
+                self.df = df[~df.index.duplicated(keep='last')].sort_index()
+            self.fetched_at = now
+            self.save_cache()
+            return self.df.copy()
+
+
+stryd_client = StrydClient(cache_path=config.get('stryd', 'cache_path', fallback='./stryd_calendar.pkl'),
+                           cache_ttl=datetime.timedelta(minutes=config.getint('stryd', 'cache_ttl_minutes',
+                                                                               fallback=60)))
+
+
 ##############################
 ## get the list of workouts ##
 ##############################
 def get_stryd_df_summary():
-    sessionID = auth_stryd_session()
-    today = datetime.datetime.now() + datetime.timedelta(days=1) # Pass tomorrow's date to ensure no issues with timezones
-    start = today - datetime.timedelta(days=180)
-    headers = {'Authorization': 'Bearer: {}'.format(sessionID)}
-    url = "https://www.stryd.com/b/api/v1/activities/calendar?srtDate={start}&endDate={today}&sortBy=StartDate".format(
-        start=start.strftime("%m-%d-%Y"), today=today.strftime("%m-%d-%Y"))
-    jsonData = {'srtDate': start.strftime("%m-%d-%Y"), 'endDate': today.strftime("%m-%d-%Y"), 'sortBy': 'StartDate'}
-
-    responseData = requests.get(url, headers=headers, params=jsonData)
-    df = pd.DataFrame(responseData.json()['activities'])  # returns summary data for each workout
-    df['timestamp'] = df['timestamp'].apply(datetime.datetime.fromtimestamp)
-    df.set_index(pd.to_datetime(df['timestamp']), inplace=True)
-    # Specify which columns from stryd we want to bring over
-    df = df[['ftp', 'stress']]
-    df.rename(columns={"ftp": "stryd_ftp", "stress": "RSS"}, inplace=True)
-    return df
+    return stryd_client.get_df_summary()
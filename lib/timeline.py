@@ -0,0 +1,103 @@
+from bisect import bisect_left, bisect_right, insort
+from lib.sqlalchemy_declarative import db_session, athlete, ouraSleepSummary, withings, stravaSummary
+from lib.strydAPI import get_stryd_df_summary
+
+# Defaults used when no ftp test exists prior to an activity
+default_ride_ftp = 211
+default_run_ftp = 223
+
+
+def _naive(timestamp):
+    # Strava utc timestamps are tz aware, db timestamps are not
+    return timestamp.replace(tzinfo=None) if getattr(timestamp, 'tzinfo', None) is not None else timestamp
+
+
+class AthleteTimeline(object):
+    '''
+    In memory "latest value on or before" lookups for everything an activity needs to know about the athlete
+    (ftp, weight, resting hr, zone thresholds). Load once per refresh (or recompute) and share across activities
+    instead of querying the db for every activity
+    :param athlete_id: athlete to load
+    :param stryd_df: optional output of get_stryd_df_summary() if it has already been pulled, otherwise it is only
+                     pulled the first time a run ftp is asked for
+    '''
+
+    def __init__(self, athlete_id, stryd_df=None):
+        self.athlete_id = athlete_id
+        with db_session() as session:
+            self.athlete = session.query(athlete).filter(athlete.athlete_id == athlete_id).first()
+            # Detach so the loaded values survive the session closing
+            session.expunge(self.athlete)
+            rhr = session.query(ouraSleepSummary.report_date, ouraSleepSummary.hr_lowest).order_by(
+                ouraSleepSummary.report_date.asc()).all()
+            weights = session.query(withings.date_utc, withings.weight).order_by(withings.date_utc.asc()).all()
+            ftp_tests = session.query(stravaSummary.start_date_local, stravaSummary.average_watts).filter(
+                stravaSummary.athlete_id == athlete_id,
+                stravaSummary.type.ilike('%ride%'),
+                stravaSummary.name.ilike('%ftp test%')).order_by(stravaSummary.start_date_local.asc()).all()
+
+        self.rhr_dates = [x.report_date for x in rhr]
+        self.rhr_values = [x.hr_lowest for x in rhr]
+        self.weight_dates = [x.date_utc for x in weights]
+        self.weight_values = [x.weight for x in weights]
+        self.ride_ftp_tests = [(x.start_date_local, x.average_watts) for x in ftp_tests]
+        self.stryd_df = stryd_df
+
+    def record_activity(self, start_date_local, activity_type, name, average_watts):
+        # Keep ride ftp lookups current as activities are inserted during the same refresh
+        if 'ride' in activity_type.lower() and 'ftp test' in (name or '').lower():
+            insort(self.ride_ftp_tests, (_naive(start_date_local), average_watts))
+
+    def heartrate_zones(self):
+        return {x: float(getattr(self.athlete, 'hr_zone_threshold_{}'.format(x))) for x in [1, 2, 3, 4]}
+
+    def power_zones(self, activity_type):
+        if 'ride' in activity_type.lower():
+            return {x: float(getattr(self.athlete, 'cycle_power_zone_threshold_{}'.format(x))) for x in range(1, 7)}
+        elif 'run' in activity_type.lower():
+            return {x: float(getattr(self.athlete, 'run_power_zone_threshold_{}'.format(x))) for x in range(1, 5)}
+
+    def resting_hr(self, start_date):
+        # Last oura resting hr on or before the activity date, else first oura record, else static athlete value
+        i = bisect_right(self.rhr_dates, start_date.date())
+        if i > 0:
+            return self.rhr_values[i - 1]
+        elif self.rhr_values:
+            return self.rhr_values[0]
+        return self.athlete.resting_hr
+
+    def weight(self, start_date_utc):
+        # Last withings weight on or before the activity, else first withings record, else static athlete value
+        i = bisect_right(self.weight_dates, _naive(start_date_utc))
+        if i > 0:
+            return float(self.weight_values[i - 1])
+        elif self.weight_values:
+            return float(self.weight_values[0])
+        return float(self.athlete.weight_lbs)
+
+    def ftp(self, start_date_local, activity_type):
+        start_date_local = _naive(start_date_local)
+        if 'run' in activity_type.lower():
+            if self.stryd_df is None:
+                self.stryd_df = get_stryd_df_summary()
+            stryd_df = self.stryd_df[self.stryd_df.index <= start_date_local]
+            try:
+                ftp = stryd_df.loc[stryd_df.index.max()].stryd_ftp
+            except:
+                # If no FTP test prior to current activity
+                ftp = default_run_ftp
+
+        elif 'ride' in activity_type.lower():
+            # Last ride flagged as an ftp test strictly before the activity
+            i = bisect_left(self.ride_ftp_tests, (start_date_local,))
+            try:
+                ftp = float(self.ride_ftp_tests[i - 1][1]) * .95 if i > 0 else default_ride_ftp
+            except:
+                ftp = default_ride_ftp
+
+        else:
+            ftp = None
+
+        if ftp is not None:
+            ftp = None if float(ftp) == 0.0 else ftp
+        return ftp
@@ -5,8 +5,8 @@ from datetime import datetime
 import ast
 import configparser
 import pandas as pd
-import numpy as np
 from dash_app import dash_app
+from lib.refresh_metrics import count_http
 
 config = configparser.ConfigParser()
 config.read('./config.ini')
@@ -21,7 +21,6 @@ def current_token_dict():
         session, engine = db_connect()
         token_dict = session.query(apiTokens.tokens).filter(apiTokens.service == 'Withings').first()
         token_dict = ast.literal_eval(token_dict[0]) if token_dict else {}
-        engine.dispose()
         session.close()
     except BaseException as e:
         dash_app.server.logger.error(e)
@@ -62,7 +61,6 @@ def save_withings_token(tokens):
     session.add(apiTokens(date_utc=datetime.utcnow(), service='Withings', tokens=str(token_dict)))
     session.commit()
 
-    engine.dispose()
     session.close()
     dash_app.server.logger.debug('***** SAVED TOKENS *****')
 
@@ -87,6 +85,7 @@ def withings_connected():
         if token_dict:
             creds = nokia_creds(token_dict)
             client = NokiaApi(credentials=creds, refresh_cb=save_withings_token)
+            count_http(client.client)
             measures = client.get_measures(limit=1)
             dash_app.server.logger.debug('Withings Connected')
             return True
@@ -102,28 +101,51 @@ def connect_withings_link(auth_client):
     return url
 
 
+def get_measures_since(client, start):
+    '''
+    Measure groups taken on or after start, following the api's paging so a large history comes back in bounded pages
+    :param client: NokiaApi
+    :param start: utc datetime
+    :return: df of date_utc, weight (kg), fat_ratio and hydration
+    '''
+    # Epoch seconds, the client's own date conversion does not work with current versions of arrow
+    params = {'startdate': int(pd.Timestamp(start).timestamp())}
+    rows = []
+    while True:
+        page = client.get_measures(**params)
+        rows.extend([(x.data['date'], x.weight, x.fat_ratio, x.hydration) for x in page])
+        if not getattr(page, 'more', False):
+            break
+        params['offset'] = page.offset
+    df = pd.DataFrame(rows, columns=['date_utc', 'weight', 'fat_ratio', 'hydration'])
+    df['date_utc'] = pd.to_datetime(df['date_utc'], unit='s')
+    return df.set_index('date_utc').astype('float')
+
+
 def pull_withings_data():
+    '''
+    Insert the measurements taken since the latest one in the db
+    :return: number of measurements inserted
+    '''
     # UTC dates will get sampled into daily
     if withings_connected():
-        client = NokiaApi(nokia_creds(current_token_dict()), refresh_cb=save_withings_token)
-        df = pd.DataFrame([measure.__dict__ for measure in client.get_measures()])
-        df['date_utc'] = df['date'].apply(
-            lambda x: datetime.strptime(str(x.format('YYYY-MM-DD HH:mm:ss')), '%Y-%m-%d %H:%M:%S'))
-        df = df.drop(columns=['date'])
-        df = df.set_index(df['date_utc'])
-        df = df[['weight', 'fat_ratio', 'hydration']]
-        # Convert to lbs
-        df['weight'] *= 2.20462
-
-        # Filter to days later than what is already in db
+        # Only ask for measurements since the latest one already in the db
         session, engine = db_connect()
         withings_max_date = session.query(func.max(withings.date_utc)).first()[0]
         withings_max_date = datetime.strptime('1991-08-30 00:00:00',
                                               '%Y-%m-%d %H:%M:%S') if not withings_max_date else withings_max_date
-        engine.dispose()
         session.close()
 
-        df = df[(df.index > withings_max_date) & (~np.isnan(df['weight'])) & (~np.isnan(df['fat_ratio']))]
+        client = NokiaApi(nokia_creds(current_token_dict()), refresh_cb=save_withings_token)
+        count_http(client.client)
+        df = get_measures_since(client, withings_max_date)
+        # Convert to lbs
+        df['weight'] *= 2.20462
+
+        # startdate is inclusive, so the latest measurement already in the db comes back again
+        df = df[(df.index > withings_max_date) & (df['weight'].notnull()) & (df['fat_ratio'].notnull())]
         if len(df) > 0:
             dash_app.server.logger.info('New withings measurements found!')
             df.to_sql('withings', engine, if_exists='append', index=True)
+        return len(df)
+    return 0
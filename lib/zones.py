@@ -0,0 +1,81 @@
+import numpy as np
+
+# Which zones count towards low/med/high intensity seconds on the summary table
+ride_power_intensities = {'low': [1, 2, 3], 'med': [4], 'high': [5, 6, 7]}
+run_power_intensities = {'low': [1, 2], 'med': [3], 'high': [4, 5]}
+heartrate_intensities = {'low': [1, 2], 'med': [3], 'high': [4, 5]}
+
+
+def classify_zones(samples, thresholds):
+    '''
+    Classify every sample into a zone in one pass
+    :param samples: array-like of sample values (watts, heartrate...)
+    :param thresholds: ascending upper bounds (inclusive) of each zone, i.e. [z1_max, z2_max, ...]
+    :return: float array of zone codes starting at 1 (len(thresholds) + 1 for anything above the last threshold),
+             nan where the sample is nan
+    '''
+    samples = np.asarray(samples, dtype='float')
+    # right=True so a sample exactly on a threshold stays in the lower zone (sample <= threshold)
+    zones = np.digitize(samples, np.asarray(thresholds, dtype='float'), right=True) + 1
+    return np.where(np.isnan(samples), np.nan, zones)
+
+
+def classify_zones_batch(sample_arrays, thresholds):
+    '''
+    Classify the samples of many activities at once, each activity with its own thresholds. Activities sharing
+    thresholds (same ftp/heart rate reserve) go through classify_zones in a single call
+    :param sample_arrays: list of array-like samples, one per activity
+    :param thresholds: list of threshold lists, one per activity
+    :return: list of zone code arrays in the same order as sample_arrays
+    '''
+    groups = {}
+    for i, activity_thresholds in enumerate(thresholds):
+        groups.setdefault(tuple(float(x) for x in activity_thresholds), []).append(i)
+    zones = [None] * len(sample_arrays)
+    for activity_thresholds, positions in groups.items():
+        samples = [np.asarray(sample_arrays[i], dtype='float') for i in positions]
+        split = np.split(classify_zones(np.concatenate(samples), activity_thresholds),
+                         np.cumsum([len(x) for x in samples])[:-1])
+        for i, activity_zones in zip(positions, split):
+            zones[i] = activity_zones
+    return zones
+
+
+def power_zone_thresholds(ftp, power_zones, activity_type):
+    # Runs only have 4 power zones, so push the upper 2 bounds out of reach
+    if 'ride' in activity_type.lower():
+        pz_5, pz_6 = power_zones[5], power_zones[6]
+    else:
+        pz_5, pz_6 = 99, 99
+    return [round(ftp * x) for x in [power_zones[1], power_zones[2], power_zones[3], power_zones[4], pz_5, pz_6]]
+
+
+def heartrate_zone_thresholds(rhr, hrr, heartrate_zones):
+    return [round((hrr * heartrate_zones[x]) + rhr) for x in [1, 2, 3, 4]]
+
+
+def zone_intensity_seconds(zones, intensities):
+    '''
+    Count seconds spent in each intensity bucket
+    :param zones: array of zone codes (1 sample per second)
+    :param intensities: dict of intensity: [zones], i.e. ride_power_intensities
+    :return: dict of intensity: seconds, None when no seconds were spent in that intensity
+    '''
+    zones = np.asarray(zones, dtype='float')
+    seconds = {}
+    for intensity, intensity_zones in intensities.items():
+        count = int(np.isin(zones, intensity_zones).sum())
+        seconds[intensity] = count if count > 0 else None
+    return seconds
+
+
+def zone_seconds(zones, max_zone=7):
+    '''
+    Seconds spent in every zone, including the zones never reached
+    :param zones: array of zone codes (1 sample per second), nan where the sample had no zone
+    :param max_zone: highest zone to always return a count for
+    :return: int array of seconds, position 0 is zone 1
+    '''
+    zones = np.asarray(zones, dtype='float')
+    zones = zones[~np.isnan(zones)].astype('int')
+    return np.bincount(zones, minlength=max_zone + 1)[1:]
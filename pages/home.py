@@ -15,6 +15,8 @@ import operator
 from lib.util import calc_next_saturday, calc_prev_sunday
 import configparser
 from lib.util import utc_to_local
+from lib.callback_cache import cached
+from lib.decimate import decimate, max_points
 
 config = configparser.ConfigParser()
 config.read('./config.ini')
@@ -94,7 +96,6 @@ def modal_range_buttons(df, resample='D'):
 def get_max_week_ending():
     session, engine = db_connect()
     date = session.query(func.max(ouraSleepSummary.report_date))[0][0]
-    engine.dispose()
     session.close()
     return pd.to_datetime(date)
 
@@ -107,7 +108,6 @@ def generate_sleep_stages_chart(date):
             ouraSleepSamples.report_date == date, ouraSleepSamples.hypnogram_5min_desc != None).statement, con=engine,
         index_col='timestamp_local').sort_index(
         ascending=False)
-    engine.dispose()
     session.close()
 
     df['Task'] = df['hypnogram_5min_desc']
@@ -201,9 +201,13 @@ def generate_daily_movement_chart(date):
                           ouraActivitySamples.class_5min).filter(
             ouraActivitySamples.summary_date == date, ouraActivitySamples.class_5min != None).statement, con=engine,
         index_col='timestamp_local')
-    engine.dispose()
     session.close()
 
+    # Merge minutes into as many bars as the chart has room for, each bar the highest MET of its minutes
+    minutes = int(np.ceil(len(df) / max_points))
+    if minutes > 1:
+        df = df.resample('{}min'.format(minutes)).max().dropna(subset=['met_1min'])
+
     df['color'] = df['met_1min'].apply(daily_movement_color)
     df['action'] = df['met_1min'].apply(lambda x: daily_movement_color(x, name=True))
 
@@ -225,8 +229,8 @@ def generate_daily_movement_chart(date):
                              ),
                              go.Scatter(
                                  name='Low',
-                                 x=df.index,
-                                 y=[1 for x in df.index],
+                                 x=[df.index.min(), df.index.max()],
+                                 y=[1, 1],
                                  mode='lines',
                                  hoverinfo='x',
                                  line={'dash': 'dot', 'color': 'rgb(150,150,150)', 'width': .5},
@@ -234,8 +238,8 @@ def generate_daily_movement_chart(date):
                              ),
                              go.Scatter(
                                  name='Med',
-                                 x=df.index,
-                                 y=[3 for x in df.index],
+                                 x=[df.index.min(), df.index.max()],
+                                 y=[3, 3],
                                  mode='lines',
                                  hoverinfo='x',
                                  line={'dash': 'dot', 'color': 'rgb(150,150,150)', 'width': .5},
@@ -243,8 +247,8 @@ def generate_daily_movement_chart(date):
                              ),
                              go.Scatter(
                                  name='High',
-                                 x=df.index,
-                                 y=[7 for x in df.index],
+                                 x=[df.index.min(), df.index.max()],
+                                 y=[7, 7],
                                  mode='lines',
                                  hoverinfo='x',
                                  line={'dash': 'dot', 'color': 'rgb(150,150,150)', 'width': .5},
@@ -295,7 +299,6 @@ def generate_rhr_day_chart(date):
             sql=session.query(ouraSleepSamples.timestamp_local, ouraSleepSamples.hr_5min).filter(
                 ouraSleepSamples.report_date == date).statement, con=engine, index_col='timestamp_local')
 
-    engine.dispose()
     session.close()
 
     # Remove 0s from plotted line
@@ -304,6 +307,8 @@ def generate_rhr_day_chart(date):
 
     # Take average including all data
     df['rhr_avg'] = round(df['hr_5min'].mean())
+    # The lowest point is always kept, so the annotation below is still exact
+    df = df.iloc[decimate(df.index, df['hr_5min'])]
 
     return dcc.Graph(id='rhr-trend', className='twelve columns nospace', style={'height': '100%'},
                      config={
@@ -494,7 +499,6 @@ def calculate_streak_off_oura_readiness(date, readiness_lookup, df):
                 ouraReadinessSummary.score >= 85).statement, con=engine)
 
     df_readiness = df_readiness.set_index(pd.to_datetime(df_readiness['report_date']))
-    engine.dispose()
     session.close()
 
     current_streak, best_streak, temp_best_streak = 0, 0, 0
@@ -577,6 +581,7 @@ def calculate_streak(date, series, weekly_goal, sum_metric=None):
     return current_streak, best_streak
 
 
+@cached('oura_sleep_summary', 'oura_readiness_summary', 'oura_activity_summary', 'withings')
 def generate_content_kpi_trend(df_name, metric):
     rolling_days = 42
     session, engine = db_connect()
@@ -592,7 +597,6 @@ def generate_content_kpi_trend(df_name, metric):
         # If multiple measurements in a single day, average together to only show 1 point per day on trend
         df = df.resample('D').mean().ffill()
 
-    engine.dispose()
     session.close()
 
     metricAvg = df[metric].rolling(window=rolling_days).mean()
@@ -786,13 +790,14 @@ def generate_content_kpi_trend(df_name, metric):
     ])
 
 
+@cached('strava_summary', 'athlete', 'oura_sleep_summary', 'oura_activity_summary', 'oura_readiness_summary',
+        'withings')
 def update_kpis(date, days=7, chartHeight='14vh'):
     session, engine = db_connect()
     df_summary = pd.read_sql(
         sql=session.query(stravaSummary).filter(stravaSummary.start_date_utc <= date).statement, con=engine,
         index_col='start_date_local')
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
-    engine.dispose()
     session.close()
 
     ### Oura Donuts ###
@@ -1016,6 +1021,7 @@ def generate_contributor_bar(df, id, column_name, top_left_title, top_right_titl
         ])
 
 
+@cached('oura_sleep_summary')
 def generate_oura_sleep_header_kpi(date):
     session, engine = db_connect()
     df = pd.read_sql(
@@ -1028,7 +1034,6 @@ def generate_oura_sleep_header_kpi(date):
             sql=session.query(ouraSleepSummary.score).filter(ouraSleepSummary.report_date == date).statement,
             con=engine)
 
-    engine.dispose()
     session.close()
     score = df.loc[df.index.max()]['score']
     color = white if score >= 85 else 'rgb(66,66,66)'
@@ -1057,6 +1062,7 @@ def generate_oura_sleep_header_kpi(date):
     ]
 
 
+@cached('oura_sleep_summary', 'athlete')
 def generate_oura_sleep_header_chart(date, days=7, summary=False, graph_id='sleep-trend', resample='D'):
     session, engine = db_connect()
 
@@ -1070,7 +1076,6 @@ def generate_oura_sleep_header_chart(date, days=7, summary=False, graph_id='slee
                          con=engine, index_col='report_date')[:days]
 
     daily_sleep_hr_target = session.query(athlete).filter(athlete.athlete_id == 1).first().daily_sleep_hr_target
-    engine.dispose()
     session.close()
 
     # Resampling for modal buttons
@@ -1418,6 +1423,7 @@ def generate_oura_sleep_header_chart(date, days=7, summary=False, graph_id='slee
                      })
 
 
+@cached('oura_sleep_summary', 'oura_sleep_samples')
 def generate_oura_sleep_content(date):
     session, engine = db_connect()
     # If the date passed is today's date (usually the default on load), grab the max date from db just in case oura cloud does not have current date yet
@@ -1426,7 +1432,6 @@ def generate_oura_sleep_content(date):
 
     df = pd.read_sql(sql=session.query(ouraSleepSummary).filter(ouraSleepSummary.report_date == date).statement,
                      con=engine, index_col='report_date')
-    engine.dispose()
     session.close()
 
     return dcc.Loading(className='twelve columns height-100', children=[
@@ -1501,6 +1506,7 @@ def generate_oura_sleep_content(date):
     ])
 
 
+@cached('oura_sleep_summary')
 def generate_sleep_modal_summary(days=7):
     date = datetime.now().date() - timedelta(days=days)
     session, engine = db_connect()
@@ -1509,7 +1515,6 @@ def generate_sleep_modal_summary(days=7):
                           ouraSleepSummary.bedtime_end_local).filter(
             ouraSleepSummary.report_date > date).statement, con=engine,
         index_col='report_date')
-    engine.dispose()
     session.close()
 
     df['wakeup'] = df['bedtime_end_local'].apply(
@@ -1702,6 +1707,7 @@ def generate_sleep_modal_summary(days=7):
     ])
 
 
+@cached('oura_readiness_summary')
 def generate_oura_readiness_header_kpi(date):
     session, engine = db_connect()
     df = pd.read_sql(
@@ -1714,7 +1720,6 @@ def generate_oura_readiness_header_kpi(date):
             sql=session.query(ouraReadinessSummary.score).filter(
                 ouraReadinessSummary.report_date == date).statement,
             con=engine)
-    engine.dispose()
     session.close()
     score = df.loc[df.index.max()]['score']
     color = white if score >= 85 else 'rgb(66,66,66)'
@@ -1741,6 +1746,7 @@ def generate_oura_readiness_header_kpi(date):
     ]
 
 
+@cached('oura_readiness_summary', 'oura_sleep_summary')
 def generate_oura_readiness_header_chart(date, days=7, summary=False, graph_id='readiness-scatter', resample='D'):
     session, engine = db_connect()
     if summary:
@@ -1768,7 +1774,6 @@ def generate_oura_readiness_header_chart(date, days=7, summary=False, graph_id='
     # Merge with rediness summary
     df = df.merge(hrv_df, how='left', left_index=True, right_index=True)
 
-    engine.dispose()
     session.close()
 
     # Resampling for modal buttons
@@ -2006,6 +2011,7 @@ def generate_oura_readiness_header_chart(date, days=7, summary=False, graph_id='
                      )
 
 
+@cached('oura_readiness_summary', 'oura_sleep_summary', 'oura_sleep_samples')
 def generate_oura_readiness_content(date):
     # Most readiness data comes from sleep tables
     session, engine = db_connect()
@@ -2021,7 +2027,6 @@ def generate_oura_readiness_content(date):
     df_contributors = pd.read_sql(
         sql=session.query(ouraReadinessSummary).filter(ouraReadinessSummary.report_date == ready_date).statement,
         con=engine, index_col='report_date')
-    engine.dispose()
     session.close()
 
     return dcc.Loading(className='twelve columns height-100', children=[
@@ -2096,6 +2101,7 @@ def generate_oura_readiness_content(date):
     ])
 
 
+@cached('oura_readiness_summary', 'oura_sleep_summary')
 def generate_readiness_modal_summary(days=7):
     date = datetime.now().date() - timedelta(days=days)
     session, engine = db_connect()
@@ -2107,7 +2113,6 @@ def generate_readiness_modal_summary(days=7):
         sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd, ouraSleepSummary.hr_lowest).filter(
             ouraSleepSummary.report_date > date).statement, con=engine,
         index_col='report_date')
-    engine.dispose()
     session.close()
     df = df.merge(hrv_df, how='left', left_index=True, right_index=True)
 
@@ -2374,6 +2379,7 @@ def generate_readiness_modal_summary(days=7):
     ])
 
 
+@cached('oura_activity_summary')
 def generate_oura_acvitity_header_kpi(date):
     session, engine = db_connect()
     df = pd.read_sql(
@@ -2386,7 +2392,6 @@ def generate_oura_acvitity_header_kpi(date):
             sql=session.query(ouraActivitySummary.score).filter(ouraActivitySummary.summary_date == date).statement,
             con=engine)
 
-    engine.dispose()
     session.close()
     score = df.loc[df.index.max()]['score']
     color = white if score >= 85 else 'rgb(66,66,66)'
@@ -2413,6 +2418,7 @@ def generate_oura_acvitity_header_kpi(date):
     ]
 
 
+@cached('oura_activity_summary')
 def generate_oura_activity_header_chart(date, days=7, summary=False, graph_id='activity-bars', resample='D'
                                                                                                         ''):
     session, engine = db_connect()
@@ -2423,7 +2429,6 @@ def generate_oura_activity_header_chart(date, days=7, summary=False, graph_id='a
         df = pd.read_sql(
             sql=session.query(ouraActivitySummary).filter(ouraActivitySummary.summary_date > date).statement,
             con=engine, index_col='summary_date')[:days]
-    engine.dispose()
     session.close()
 
     # Resampling for modal buttons
@@ -2609,6 +2614,7 @@ def generate_oura_activity_header_chart(date, days=7, summary=False, graph_id='a
                      })
 
 
+@cached('oura_activity_summary', 'oura_activity_samples')
 def generate_oura_activity_content(date):
     session, engine = db_connect()
     # If the date passed is today's date (usually the default on load), grab the max date from db just in case oura cloud does not have current date yet
@@ -2617,7 +2623,6 @@ def generate_oura_activity_content(date):
 
     df = pd.read_sql(sql=session.query(ouraActivitySummary).filter(ouraActivitySummary.summary_date == date).statement,
                      con=engine, index_col='summary_date')
-    engine.dispose()
     session.close()
 
     return dcc.Loading(className='twelve columns height-100', children=[
@@ -2696,6 +2701,7 @@ def generate_oura_activity_content(date):
     ])
 
 
+@cached('oura_activity_summary')
 def generate_activity_modal_summary(days=7):
     date = datetime.now().date() - timedelta(days=days)
     session, engine = db_connect()
@@ -2705,7 +2711,6 @@ def generate_activity_modal_summary(days=7):
             ouraActivitySummary.summary_date > date).statement, con=engine,
         index_col='summary_date')
 
-    engine.dispose()
     session.close()
 
     df['completion'] = df['cal_active'] / df['target_calories']
@@ -2913,7 +2918,6 @@ def toggle_forward_arrow_display(week_ending):
 def toggle_back_arrow_display(week_ending):
     session, engine = db_connect()
     min_saturday = calc_next_saturday(pd.to_datetime(session.query(func.min(ouraSleepSummary.report_date))[0][0]))
-    engine.dispose()
     session.close()
     if calc_next_saturday(datetime.strptime(week_ending, '%A %b %d, %Y')) == min_saturday:
         return {'color': 'rgb(110,110,110)', 'border': '0'}
@@ -2936,7 +2940,6 @@ def cycle_week(back_week_n_clicks, forward_week_n_clicks, back_week_timestamp, f
     forward_week_timestamp = -1 if forward_week_timestamp is None else forward_week_timestamp
     session, engine = db_connect()
     min_saturday = calc_next_saturday(pd.to_datetime(session.query(func.min(ouraSleepSummary.report_date))[0][0]))
-    engine.dispose()
     session.close()
     if not back_week_n_clicks and not forward_week_n_clicks:
         return datetime.strftime(calc_next_saturday(get_max_week_ending()), '%A %b %d, %Y')
@@ -3128,7 +3131,6 @@ def show_sleep_exclamation(dummy):
     max_sleep_date = session.query(func.max(ouraSleepSummary.report_date)).first()[0]
     max_readiness_date = session.query(func.max(ouraReadinessSummary.report_date)).first()[0]
     max_activity_date = session.query(func.max(ouraActivitySummary.summary_date)).first()[0]
-    engine.dispose()
     session.close()
     max_date = max([max_sleep_date, max_readiness_date, max_activity_date])
     sleep_style = show if max_sleep_date != max_date else hide
@@ -3149,7 +3151,6 @@ def show_readiness_exclamation(dummy):
     max_sleep_date = session.query(func.max(ouraSleepSummary.report_date)).first()[0]
     max_readiness_date = session.query(func.max(ouraReadinessSummary.report_date)).first()[0]
     max_activity_date = session.query(func.max(ouraActivitySummary.summary_date)).first()[0]
-    engine.dispose()
     session.close()
     max_date = max([max_sleep_date, max_readiness_date, max_activity_date])
     readiness_style = show if max_readiness_date != max_date else hide
@@ -3170,7 +3171,6 @@ def show_activity_exclamation(dummy):
     max_sleep_date = session.query(func.max(ouraSleepSummary.report_date)).first()[0]
     max_readiness_date = session.query(func.max(ouraReadinessSummary.report_date)).first()[0]
     max_activity_date = session.query(func.max(ouraActivitySummary.summary_date)).first()[0]
-    engine.dispose()
     session.close()
     max_date = max([max_sleep_date, max_readiness_date, max_activity_date])
     activity_style = show if max_activity_date != max_date else hide
@@ -5,6 +5,7 @@ import plotly.graph_objs as go
 from dash_app import dash_app
 from dash.dependencies import Input, Output, State
 from lib.sqlalchemy_declarative import db_connect, fitbod, fitbod_muscles
+from lib.callback_cache import cached
 import configparser
 import math
 from datetime import datetime, timedelta, date
@@ -76,10 +77,10 @@ orange = config.get('oura', 'orange')
 ftp_color = 'rgb(100, 217, 236)'
 
 
+@cached('fitbod', 'fitbod_muscles')
 def generate_exercise_charts(timeframe, muscle_options):
     session, engine = db_connect()
     df = pd.read_sql(sql=session.query(fitbod).statement, con=engine)
-    engine.dispose()
     session.close()
     # Merge 'muscle' into exercise table for mapping
     df_muscle = pd.read_sql(sql=session.query(fitbod_muscles).statement, con=engine)
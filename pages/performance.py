@@ -12,9 +12,14 @@ import plotly.graph_objs as go
 from dash.dependencies import Input, Output, State
 from sqlalchemy import or_, delete
 from dash_app import dash_app
-from lib.sqlalchemy_declarative import db_insert, db_connect, athlete, stravaSummary, stravaSamples, hrvWorkoutStepLog, \
+from lib.sqlalchemy_declarative import db_insert, db_connect, athlete, stravaSummary, hrvWorkoutStepLog, \
     ouraSleepSummary, ouraReadinessSummary, annotations
 from lib.util import utc_to_local
+from lib.hrv_plan import hrv_thresholds
+from lib.pmc import get_pmc_daily, pmc_series
+from lib.activity_data import activity_data
+from lib.decimate import decimate
+from lib.callback_cache import cached, bump_data_version
 from pages.power import power_curve, zone_chart
 
 layout = html.Div(id='performance-canvas', children=[
@@ -186,6 +191,7 @@ def create_fitness_kpis(date, ctl, ramp, rr_min_threshold, rr_max_threshold, atl
     ])
 
 
+@cached('strava_summary')
 def create_activity_table(date=None):
     df_summary_table_columns = ['name', 'type', 'time', 'distance', 'tss', 'hrss', 'trimp', 'weighted_average_power',
                                 'relative_intensity', 'efficiency_factor', 'variability_index', 'ftp', 'activity_id']
@@ -201,7 +207,6 @@ def create_activity_table(date=None):
 
     else:
         df_table = pd.read_sql(sql=session.query(stravaSummary).statement, con=engine).sort_index(ascending=True)
-    engine.dispose()
     session.close()
 
     df_table['distance'] = df_table['distance'].replace({0: np.nan})
@@ -312,7 +317,6 @@ def create_growth_kpis(date, cy_tss, ly_tss, target):
 def create_growth_chart(df_summary, metric='tss'):
     session, engine = db_connect()
     weekly_tss_goal = session.query(athlete).filter(athlete.athlete_id == 1).first().weekly_tss_goal
-    engine.dispose()
     session.close()
     df = df_summary[
         ((df_summary.index.year == datetime.now().year) | (df_summary.index.year == datetime.now().year - 1))  # &
@@ -445,11 +449,12 @@ def get_workout_types(df_summary, run_status, ride_status, all_status):
     return workout_types
 
 
+@cached('pmc_daily', 'strava_summary', 'athlete', 'annotations', 'hrv_workout_step_log', 'oura_sleep_summary', 'oura_readiness_summary')
 def create_fitness_chart(run_status, ride_status, all_status):
-    session, engine = db_connect()
-    df_summary = pd.read_sql(sql=session.query(stravaSummary).statement, con=engine,
-                             index_col='start_date_local').sort_index(ascending=True)
+    # Fitness/fatigue is precomputed by the refresh into pmc_daily
+    pmc_df = get_pmc_daily(athlete_id=1)
 
+    session, engine = db_connect()
     hrv_df = pd.read_sql(sql=session.query(ouraSleepSummary.report_date, ouraSleepSummary.rmssd).statement,
                          con=engine,
                          index_col='report_date').sort_index(ascending=True)
@@ -475,7 +480,6 @@ def create_fitness_chart(run_status, ride_status, all_status):
         con=engine,
         index_col='date').sort_index(ascending=False)
 
-    engine.dispose()
     session.close()
 
     chart_annotations = [go.layout.Annotation(
@@ -495,94 +499,18 @@ def create_fitness_chart(run_status, ride_status, all_status):
     # Resample hrv to fill any missing dates so rolling is always done at the correct # of days
     hrv_df.set_index(pd.to_datetime(hrv_df.index), inplace=True)
     hrv_df = hrv_df.resample('D').mean()
-    # Any changes to this code will have to be done in strava api hrv_workout_cycle() and hrv_workout_step_log would need to be truncated
-    # Recalculating here to plot on PMC (same calcs as in datapull.py)
-
-    # hrv_df['rmssd_7'] = hrv_df['rmssd'].ewm(7, min_periods=0).mean()
-    hrv_df['rmssd_7'] = hrv_df['rmssd'].rolling(7, min_periods=0).mean()
-    # hrv_df['rmssd_30'] = hrv_df['rmssd'].ewm(30, min_periods=0).mean()
-    hrv_df['rmssd_30'] = hrv_df['rmssd'].rolling(30, min_periods=0).mean()
-    # hrv_df['stdev_rmssd_30_threshold'] = hrv_df['rmssd'].ewm(30, min_periods=0).std() * .5
-    hrv_df['stdev_rmssd_30_threshold'] = hrv_df['rmssd'].rolling(30, min_periods=0).std() * .5
-    hrv_df['swc_upper'] = hrv_df['rmssd_30'] + hrv_df['stdev_rmssd_30_threshold']
-    hrv_df['swc_lower'] = hrv_df['rmssd_30'] - hrv_df['stdev_rmssd_30_threshold']
-
-    # Create flag to color tss bars when ftp test - use number so column remains through resample
-    df_new_run_ftp = df_summary[df_summary['type'].str.lower().str.contains('run')]
-    df_new_run_ftp['previous_ftp'] = df_new_run_ftp['ftp'].shift(1)
-    df_new_run_ftp = df_new_run_ftp[~np.isnan(df_new_run_ftp['previous_ftp'])]
-    df_new_run_ftp.loc[df_new_run_ftp['previous_ftp'] > df_new_run_ftp['ftp'], 'new_run_ftp_flag'] = -1
-    df_new_run_ftp.loc[df_new_run_ftp['previous_ftp'] < df_new_run_ftp['ftp'], 'new_run_ftp_flag'] = 1
-    # Highlight the workout which caused the new FTP to be set
-    df_new_run_ftp['new_run_ftp_flag'] = df_new_run_ftp['new_run_ftp_flag'].shift(-1)
-
-    df_new_ride_ftp = df_summary[df_summary['type'].str.lower().str.contains('ride')]
-    df_new_ride_ftp['previous_ftp'] = df_new_ride_ftp['ftp'].shift(1)
-    df_new_ride_ftp = df_new_ride_ftp[~np.isnan(df_new_ride_ftp['previous_ftp'])]
-    df_new_ride_ftp.loc[df_new_ride_ftp['previous_ftp'] > df_new_ride_ftp['ftp'], 'new_ride_ftp_flag'] = -1
-    df_new_ride_ftp.loc[df_new_ride_ftp['previous_ftp'] < df_new_ride_ftp['ftp'], 'new_ride_ftp_flag'] = 1
-    # Highlight the workout which caused the new FTP to be set
-    df_new_ride_ftp['new_ride_ftp_flag'] = df_new_ride_ftp['new_ride_ftp_flag'].shift(-1)
-
-    # Add flags back to main df
-    df_summary = df_summary.merge(df_new_run_ftp['new_run_ftp_flag'].to_frame(), how='left', left_index=True,
-                                  right_index=True)
-    df_summary = df_summary.merge(df_new_ride_ftp['new_ride_ftp_flag'].to_frame(), how='left', left_index=True,
-                                  right_index=True)
-    df_summary.loc[df_summary['new_run_ftp_flag'] == 1, 'tss_flag'] = 1
-    df_summary.loc[df_summary['new_run_ftp_flag'] == -1, 'tss_flag'] = -1
-    df_summary.loc[df_summary['new_ride_ftp_flag'] == 1, 'tss_flag'] = 1
-    df_summary.loc[df_summary['new_ride_ftp_flag'] == -1, 'tss_flag'] = -1
-
-    # Create df of ftp tests to plot
+    # Same thresholds the hrv workout plan is generated from
+    hrv_df = hrv_df.join(hrv_thresholds(hrv_df['rmssd']))
+
     forecast_days = 13
-    atl_days = 7
-    initial_atl = 0
-    atl_exp = np.exp(-1 / atl_days)
-    ctl_days = 42
-    initial_ctl = 0
-    ctl_exp = np.exp(-1 / ctl_days)
-
-    # Insert dummy row with current date+forecast_days to ensure resample gets all dates
-    df_summary.loc[utc_to_local(datetime.utcnow()) + timedelta(days=forecast_days)] = None
-    # If tss not available, use hrss
-    df_summary['stress_score'] = df_summary.apply(lambda row: row['hrss'] if np.isnan(row['tss']) else row['tss'],
-                                                  axis=1).fillna(0)
-
-    # Calculate Metrics
-
-    # ATL should always be based off of ALL sports
-    # Sample to daily level and sum stress scores to aggregate multiple workouts per day
-    atl_df = df_summary[['stress_score', 'tss', 'hrss']].resample('D').sum()
-    atl_df['ATL'] = np.nan
-    atl_df['ATL'].iloc[0] = (atl_df['stress_score'].iloc[0] * (1 - atl_exp)) + (initial_atl * atl_exp)
-    for i in range(1, len(atl_df)):
-        atl_df['ATL'].iloc[i] = (atl_df['stress_score'].iloc[i] * (1 - atl_exp)) + (atl_df['ATL'].iloc[i - 1] * atl_exp)
-    atl_df['atl_tooltip'] = ['Fatigue: <b>{:.1f} ({}{:.1f})</b>'.format(x, '+' if x - y > 0 else '', x - y) for (x, y)
-                             in zip(atl_df['ATL'], atl_df['ATL'].shift(1))]
-
-    atl_df = atl_df.drop(columns=['stress_score', 'tss', 'hrss'])
-
-    # Sample to daily level and sum stress scores to aggregate multiple workouts per day
 
     # Fitness and Form will change based off booleans that are selected
-    workout_types = get_workout_types(df_summary, run_status, ride_status, all_status)
+    sports = [sport for (sport, status) in [('run', run_status), ('ride', ride_status), ('other', all_status)] if
+              status]
+    pmd = pmc_series(pmc_df, sports, end_date=utc_to_local(datetime.utcnow()).date() + timedelta(days=forecast_days))
 
-    pmd = df_summary[df_summary['type'].isin(workout_types)]
-    # Make sure df goes to same max date as ATL df
-    pmd.at[atl_df.index.max(), 'name'] = None
-
-    pmd = pmd[
-        ['stress_score', 'tss', 'hrss', 'low_intensity_seconds', 'med_intensity_seconds', 'high_intensity_seconds',
-         'tss_flag']].resample('D').sum()
-
-    pmd['CTL'] = np.nan
-    pmd['CTL'].iloc[0] = (pmd['stress_score'].iloc[0] * (1 - ctl_exp)) + (initial_ctl * ctl_exp)
-    for i in range(1, len(pmd)):
-        pmd['CTL'].iloc[i] = (pmd['stress_score'].iloc[i] * (1 - ctl_exp)) + (pmd['CTL'].iloc[i - 1] * ctl_exp)
-
-    # Merge pmd into ATL df
-    pmd = pmd.merge(atl_df, how='right', right_index=True, left_index=True)
+    pmd['atl_tooltip'] = ['Fatigue: <b>{:.1f} ({}{:.1f})</b>'.format(x, '+' if x - y > 0 else '', x - y) for (x, y)
+                          in zip(pmd['ATL'], pmd['ATL'].shift(1))]
 
     pmd['l6w_low_intensity'] = pmd['low_intensity_seconds'].rolling(42).sum()
     pmd['l6w_high_intensity'] = (pmd['med_intensity_seconds'] + pmd['high_intensity_seconds']).rolling(42).sum()
@@ -983,6 +911,7 @@ def create_fitness_chart(run_status, ride_status, all_status):
                      })
 
 
+@cached('strava_summary', 'athlete')
 def workout_distribution(run_status, ride_status, all_status):
     session, engine = db_connect()
     min_non_warmup_workout_time = session.query(athlete).filter(
@@ -996,7 +925,6 @@ def workout_distribution(run_status, ride_status, all_status):
                 stravaSummary.high_intensity_seconds > 0)
         ).statement,
         con=engine, index_col='start_date_utc')
-    engine.dispose()
     session.close()
 
     # Generate list of all workout types for when the 'all' boolean is selected
@@ -1226,12 +1154,16 @@ def workout_details(df_samples, start_seconds=None, end_seconds=None):
     )
 
     # Remove best points from main df_samples so lines do not overlap nor show 2 hoverinfos
-    for idx, row in df_samples.iterrows():
-        if idx in highlight_df.index:
-            df_samples.loc[idx, 'velocity_smooth'] = np.nan
-            df_samples.loc[idx, 'cadence'] = np.nan
-            df_samples.loc[idx, 'heartrate'] = np.nan
-            df_samples.loc[idx, 'watts'] = np.nan
+    highlighted = df_samples.index.isin(highlight_df.index)
+    df_samples.loc[highlighted, ['velocity_smooth', 'cadence', 'heartrate', 'watts']] = np.nan
+
+    # Only send about a chart width of points per line, keeping the points either side of the highlighted interval
+    # (which is sent in full) so the line still breaks around it. Power is spiky so gets an envelope of its extremes
+    edges = np.flatnonzero(highlighted)
+    keep = [edges[0] - 1, edges[0], edges[-1], edges[-1] + 1] if len(edges) > 0 else None
+    trends = {x: df_samples.iloc[decimate(df_samples['time_interval'], df_samples[x],
+                                          method='min_max' if x == 'watts' else 'lttb', keep=keep)]
+              for x in ['velocity_smooth', 'cadence', 'heartrate', 'watts']}
 
     # fig = make_subplots(
     #     rows=4, cols=1, shared_xaxes=True, #vertical_spacing=0.02
@@ -1347,8 +1279,8 @@ def workout_details(df_samples, start_seconds=None, end_seconds=None):
                 'data': [
                     go.Scatter(
                         name='Speed',
-                        x=df_samples['time_interval'],
-                        y=round(df_samples['velocity_smooth']),
+                        x=trends['velocity_smooth']['time_interval'],
+                        y=round(trends['velocity_smooth']['velocity_smooth']),
                         # hoverinfo='x+y',
                         yaxis='y2',
                         mode='lines',
@@ -1365,8 +1297,8 @@ def workout_details(df_samples, start_seconds=None, end_seconds=None):
                     ),
                     go.Scatter(
                         name='Cadence',
-                        x=df_samples['time_interval'],
-                        y=round(df_samples['cadence']),
+                        x=trends['cadence']['time_interval'],
+                        y=round(trends['cadence']['cadence']),
                         # hoverinfo='x+y',
                         yaxis='y',
                         mode='lines',
@@ -1383,8 +1315,8 @@ def workout_details(df_samples, start_seconds=None, end_seconds=None):
                     ),
                     go.Scatter(
                         name='Heart Rate',
-                        x=df_samples['time_interval'],
-                        y=round(df_samples['heartrate']),
+                        x=trends['heartrate']['time_interval'],
+                        y=round(trends['heartrate']['heartrate']),
                         # hoverinfo='x+y',
                         yaxis='y3',
                         mode='lines',
@@ -1401,8 +1333,8 @@ def workout_details(df_samples, start_seconds=None, end_seconds=None):
                     ),
                     go.Scatter(
                         name='Power',
-                        x=df_samples['time_interval'],
-                        y=round(df_samples['watts']),
+                        x=trends['watts']['time_interval'],
+                        y=round(trends['watts']['watts']),
                         # hoverinfo='x+y',
                         yaxis='y4',
                         mode='lines',
@@ -1704,13 +1636,13 @@ def calculate_splits(df_samples):
         ])
 
 
+@cached('annotations', 'athlete')
 def create_annotation_table():
     session, engine = db_connect()
     df_annotations = pd.read_sql(
         sql=session.query(annotations.athlete_id, annotations.date, annotations.annotation).filter(
             athlete.athlete_id == 1).statement,
         con=engine).sort_index(ascending=False)
-    engine.dispose()
     session.close()
 
     return dash_table.DataTable(id='annotation-table',
@@ -2036,7 +1968,6 @@ def toggle_activity_modal(n1, n2, data, is_open):
                 activity_id = data['props']['derived_viewport_data'][active_cell]['activity_id']
                 session, engine = db_connect()
                 activity = session.query(stravaSummary).filter(stravaSummary.activity_id == activity_id).first()
-                engine.dispose()
                 session.close()
                 # return activity_id
                 return not is_open, html.H5(
@@ -2097,16 +2028,12 @@ def modal_power_zone(activity, is_open):
     [Input("modal-activity-id-type-metric-metric", "children")],
     [State("activity-modal", "is_open")]
 )
+@cached('strava_samples')
 def modal_workout_trends(activity, is_open):
     if activity and is_open:
         activity_id = activity.split('|')[0]
-        session, engine = db_connect()
-        df_samples = pd.read_sql(
-            sql=session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).statement,
-            con=engine,
-            index_col=['timestamp_local'])
-        engine.dispose()
-        session.close()
+        # The charts below add columns, so work on a copy of the shared samples
+        df_samples = activity_data(activity_id).samples.copy()
         return workout_summary_kpi(df_samples), workout_details(df_samples), calculate_splits(df_samples)
     else:
         return None, None, None
@@ -2163,10 +2090,10 @@ def annotation_table(n_clicks, password, data):
             session, engine = db_connect()
             session.execute(delete(annotations).where(annotations.athlete_id == 1))
             session.commit()
-            engine.dispose()
             session.close()
             # Add annotations
             db_insert(df, 'annotations')
+            bump_data_version('annotations')
         except BaseException as e:
             dash_app.server.logger.error('Error with annotations DB transactions'.format(e))
             session.rollback()
@@ -2209,11 +2136,11 @@ def annotation_table(n_clicks, password, data):
     Output('performance-layout', 'children'),
     [Input('performance-canvas', 'children')]
 )
+@cached('strava_summary', 'athlete')
 def performance_dashboard(dummy):
     session, engine = db_connect()
     db_summary = pd.read_sql(sql=session.query(stravaSummary).statement, con=engine,
                              index_col='start_date_local').sort_index(ascending=True)
-    engine.dispose()
     session.close()
     return generate_fitness_dashboard(db_summary)
 
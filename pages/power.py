@@ -5,13 +5,17 @@ import plotly.graph_objs as go
 import dash_daq as daq
 import dash_bootstrap_components as dbc
 from dash.dependencies import Input, Output, State
-from lib.sqlalchemy_declarative import db_connect, stravaSummary, stravaSamples, stravaBestSamples, athlete
+from lib.sqlalchemy_declarative import db_connect, stravaSummary, athlete
 from dash_app import dash_app
 from datetime import datetime, timedelta
 import operator
 import configparser
 from sqlalchemy import or_, func
-import math
+from lib.power_curve import power_curve_windows, max_power_curve_interval
+from lib.mmp import power_curve_intervals, read_mmp, mmp_samples, curve_matrix
+from lib.sample_store import sample_store
+from lib.activity_data import activity_data, read_zone_seconds
+from lib.callback_cache import cached
 
 # pre_style = {"backgroundColor": "#ddd", "fontSize": 20, "padding": "10px", "margin": "10px"}
 hidden_style = {"display": "none"}
@@ -79,32 +83,21 @@ def get_workout_title(activity_id=None):
     activity_id = session.query(stravaSummary.activity_id).filter(stravaSummary.type.ilike('%ride%'),
                                                                   stravaSummary.elapsed_time > min_non_warmup_workout_time).order_by(
         stravaSummary.start_date_utc.desc()).first()[0] if not activity_id else activity_id
-    df_samples = pd.read_sql(
-        sql=session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).statement,
-        con=engine,
-        index_col=['timestamp_local'])
-    engine.dispose()
     session.close()
+    df_samples = sample_store.read(activity_id, columns=['date', 'act_name'])
 
     return [html.H6(datetime.strftime(df_samples['date'][0], "%A %b %d, %Y"), style={'height': '50%'},
                     className='twelve columns nospace'),
             html.H6(df_samples['act_name'][0], style={'height': '50%'}, className='twelve columns nospace')]
 
 
+@cached('strava_mmp', 'strava_summary')
 def power_profiles(activity_type='ride', power_unit='mmp', group='month'):
     activity_type = '%' + activity_type + '%'
-    session, engine = db_connect()
     # Filter only 5 sec, 1 min, 5 min and 20 min
-    df_best_samples = pd.read_sql(
-        sql=session.query(stravaBestSamples).filter(stravaBestSamples.type.ilike(activity_type),
-                                                    or_(stravaBestSamples.interval == 5,
-                                                        stravaBestSamples.interval == 60,
-                                                        stravaBestSamples.interval == 300,
-                                                        stravaBestSamples.interval == 1200,
-                                                        )).statement, con=engine,
-        index_col=['timestamp_local'])
-    engine.dispose()
-    session.close()
+    intervals = [5, 60, 300, 1200]
+    df_best_samples = mmp_samples(*read_mmp(activity_type=activity_type, intervals=intervals),
+                                  intervals=intervals).set_index('timestamp_local')
 
     if len(df_best_samples) < 1:
         return html.Div(className='twelve columns maincontainer', children=[
@@ -181,55 +174,26 @@ def power_profiles(activity_type='ride', power_unit='mmp', group='month'):
     return html.Div(style={'height': '100%', 'backgroundColor': 'rgb(48,48,48)'}, children=profile_charts)
 
 
+@cached('power_curve_bests', 'strava_mmp', 'strava_summary')
 def power_curve(activity_type='ride', power_unit='mmp', last_id=None, showlegend=False,
                 chart_id='power-curve-chart'):
     activity_type = '%' + activity_type + '%'
 
-    session, engine = db_connect()
+    max_interval = max_power_curve_interval(activity_type.strip('%'))
+    if max_interval is None:
+        return html.Div(className='twelve columns maincontainer', children=[
+            html.H6('No {} workouts with power data found'.format(activity_type))
+        ])
 
-    max_interval = session.query(
-        func.max(stravaBestSamples.interval).label('interval')).filter(
-        stravaBestSamples.type.ilike(activity_type)).first()[0]
-
-    # 1 second intervals from 0-60 seconds
-    interval_lengths = [i for i in range(1, 61)]
-    # 15 second intervals from 1:15 - 5:00 mins
-    interval_lengths += [i for i in range(75, 301, 15)]
-    # 30 second intervals for 5:00 - 10:00
-    interval_lengths += [i for i in range(330, 601, 30)]
-    # 1 minute intervals for everything after 10 mins
-    interval_lengths += [i for i in range(660, (int(math.floor(max_interval / 10.0)) * 10) + 1, 60)]
-
-    all_best_interval_df = pd.read_sql(
-        sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'),
-            stravaBestSamples.activity_id, stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type)).statement,
-        con=engine, index_col='interval')
-
-    L90D_best_interval_df = pd.read_sql(
-        sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=90))
-                                                      ).statement, con=engine, index_col='interval')
-
-    L6W_best_interval_df = pd.read_sql(
-        sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.interval.in_(interval_lengths),
-                                                      stravaBestSamples.type.ilike(activity_type),
-                                                      stravaBestSamples.timestamp_local >= (
-                                                              datetime.now() - timedelta(days=42))
-                                                      ).statement, con=engine, index_col='interval')
+    interval_lengths = power_curve_intervals(max_interval)
+
+    # All, L90D and L6W bests from the precomputed power_curve_bests
+    windows = power_curve_windows(activity_type.strip('%'), interval_lengths,
+                                  {'all': None, 'L90D': datetime.now() - timedelta(days=90),
+                                   'L6W': datetime.now() - timedelta(days=42)})
+    all_best_interval_df, L90D_best_interval_df, L6W_best_interval_df = windows['all'], windows['L90D'], windows['L6W']
+
+    session, engine = db_connect()
 
     # Pull max power from all intervals from latest workout
 
@@ -237,18 +201,13 @@ def power_curve(activity_type='ride', power_unit='mmp', last_id=None, showlegend
         last_id = session.query(stravaSummary.activity_id).filter(stravaSummary.type.ilike(activity_type)).order_by(
             stravaSummary.start_date_utc.desc()).first()[0]
 
-    recent_best_interval_df = pd.read_sql(
-        sql=session.query(
-            func.max(stravaBestSamples.mmp).label('mmp'), stravaBestSamples.activity_id,
-            stravaBestSamples.interval, stravaBestSamples.time_interval,
-            stravaBestSamples.date, stravaBestSamples.timestamp_local, stravaBestSamples.watts_per_kg,
-        ).group_by(stravaBestSamples.interval).filter(stravaBestSamples.activity_id == last_id,
-                                                      stravaBestSamples.interval.in_(interval_lengths),
-                                                      ).statement, con=engine, index_col='interval')
+    # Shared with the other activity modal charts of the same activity
+    recent = activity_data(last_id)
+    recent_best_interval_df = mmp_samples(recent.mmp_summary, curve_matrix([recent.mmp], interval_lengths),
+                                          intervals=interval_lengths).set_index('interval')
 
     first_workout_date = session.query(func.min(stravaSummary.start_date_utc)).first()[0]
 
-    engine.dispose()
     session.close()
 
     if len(all_best_interval_df) < 1:
@@ -453,6 +412,7 @@ def power_curve(activity_type='ride', power_unit='mmp', last_id=None, showlegend
                      })
 
 
+@cached('strava_summary')
 def create_ftp_chart(activity_type='ride', power_unit='watts'):
     activity_type = '%' + activity_type + '%'
     session, engine = db_connect()
@@ -460,7 +420,6 @@ def create_ftp_chart(activity_type='ride', power_unit='watts'):
         sql=session.query(stravaSummary).filter(stravaSummary.type.ilike(activity_type)).statement, con=engine,
         index_col='start_day_local')[
         ['activity_id', 'ftp', 'weight']]
-    engine.dispose()
     session.close()
 
     # Filter summary table on activities that have a different FTP from the previous activity
@@ -554,26 +513,16 @@ def create_ftp_chart(activity_type='ride', power_unit='watts'):
     ])
 
 
+@cached('strava_zone_seconds', 'strava_summary')
 def zone_chart(activity_id=None, metric='power_zone', chart_id='power-zone-chart'):
     # If activity_id passed, filter only that workout, otherwise show distribution across last 6 weeks
-    session, engine = db_connect()
     if activity_id:
-        df_samples = pd.read_sql(
-            sql=session.query(stravaSamples).filter(stravaSamples.activity_id == activity_id).statement,
-            con=engine,
-            index_col=['timestamp_local'])
+        pz_df = activity_data(activity_id).zone_seconds(metric)
     else:
-        df_samples = pd.read_sql(
-            sql=session.query(stravaSamples).filter(
-                stravaSamples.timestamp_local >= (datetime.now() - timedelta(days=42))).statement,
-            con=engine,
-            index_col=['timestamp_local'])
-
-    engine.dispose()
-    session.close()
+        pz_df = read_zone_seconds(metric, since=datetime.now() - timedelta(days=42))
 
-    pz_df = df_samples.groupby(metric).size().reset_index(name='counts')
-    pz_df['seconds'] = pz_df['counts']
+    # Zone seconds are counted at ingest, only chart the zones that were reached
+    pz_df = pz_df[pz_df['seconds'] > 0].rename(columns={'zone': metric}).reset_index(drop=True)
     pz_df['Percent of Total'] = (pz_df['seconds'] / pz_df['seconds'].sum())
     pz_df = pz_df.sort_index(ascending=False)
 
@@ -3,18 +3,21 @@ from dash.dependencies import Input, Output, State
 import dash_core_components as dcc
 import dash_bootstrap_components as dbc
 import dash_daq as daq
+import plotly.graph_objs as go
 from lib.ouraAPI import oura_connected
 from lib.stravaApi import strava_connected
 from lib.withingsAPI import withings_connected
-from lib.sqlalchemy_declarative import db_connect, stravaSummary, ouraSleepSummary, athlete, hrvWorkoutStepLog
+from lib.sqlalchemy_declarative import db_connect, db_session, stravaSummary, ouraSleepSummary, athlete, \
+    refreshStageMetrics
 from lib.datapull import refresh_database
-from sqlalchemy import delete
 import pandas as pd
 from dateutil.relativedelta import relativedelta
 from datetime import datetime
 import configparser
 import operator
-from lib.fitlyAPI import hrv_training_workflow
+from lib.hrv_plan import backfill_hrv_plan
+from lib.callback_cache import bump_data_version
+from lib.callback_profiler import profiler, histogram_buckets
 from dash_app import dash_app
 
 config = configparser.ConfigParser()
@@ -85,7 +88,6 @@ def pull_latest_power_zones():
     rftp = int(rftp.loc[rftp.index.max()].fillna(0)['ftp']) if len(rftp) > 0 else 0
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
-    engine.dispose()
     session.close()
 
     cycle_power_zone_threshold_1 = athlete_info.cycle_power_zone_threshold_1
@@ -166,7 +168,6 @@ def pull_latest_hr_zones():
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
     birthday = athlete_info.birthday
 
-    engine.dispose()
     session.close()
 
     age = relativedelta(datetime.today(), birthday).years
@@ -218,7 +219,6 @@ def generate_goal(id, title, value):
 def goal_parameters():
     session, engine = db_connect()
     athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
-    engine.dispose()
     session.close()
     use_readiness = True if athlete_info.weekly_workout_goal == 99 and athlete_info.weekly_yoga_goal == 99 else False
     use_hrv = True if athlete_info.weekly_workout_goal == 100 and athlete_info.weekly_yoga_goal == 100 else False
@@ -271,6 +271,87 @@ def get_logs():
         children=[logs])
 
 
+def refresh_breakdown(last_n=5):
+    '''
+    Time, rows written and data downloaded by each stage of the latest refreshes, activity steps are summed over every
+    activity scraped in the refresh
+    :param last_n: number of refreshes to show
+    '''
+    with db_session() as session:
+        refreshes = [x[0] for x in session.query(refreshStageMetrics.refresh_utc).distinct().order_by(
+            refreshStageMetrics.refresh_utc.desc()).limit(last_n).all()]
+        df = pd.read_sql(sql=session.query(refreshStageMetrics).filter(
+            refreshStageMetrics.refresh_utc.in_(refreshes)).statement, con=session.bind)
+    if len(df) == 0:
+        return html.H6('No refreshes recorded yet')
+
+    df['parent'] = df['parent'].fillna('')
+    df = df.groupby(['refresh_utc', 'parent', 'stage']).agg(
+        runs=('stage', 'size'), started_utc=('started_utc', 'min'), wall_seconds=('wall_seconds', 'sum'),
+        cpu_seconds=('cpu_seconds', 'sum'), rows_written=('rows_written', 'sum'), http_calls=('http_calls', 'sum'),
+        bytes_downloaded=('bytes_downloaded', 'sum')).reset_index().sort_values('started_utc')
+
+    columns = ['Stage', 'Runs', 'Wall (s)', 'CPU (s)', 'Rows', 'HTTP Calls', 'MB']
+    rows = [html.Tr([html.Th(x) for x in columns])]
+
+    def add_rows(x, parent, depth):
+        # Each stage followed by the stages that ran within it
+        for stage in x[x['parent'] == parent].itertuples():
+            rows.append(html.Tr([
+                html.Td(stage.stage, style={'paddingLeft': '{}vw'.format(1 + depth)}),
+                html.Td(stage.runs),
+                html.Td('{:.1f}'.format(stage.wall_seconds)),
+                html.Td('{:.1f}'.format(stage.cpu_seconds)),
+                html.Td(stage.rows_written),
+                html.Td(stage.http_calls),
+                html.Td('{:.1f}'.format(stage.bytes_downloaded / 1048576)),
+            ]))
+            if stage.stage != parent:
+                add_rows(x, stage.stage, depth + 1)
+
+    for refresh_utc in refreshes:
+        rows.append(html.Tr(html.Th('{:%Y-%m-%d %H:%M} UTC'.format(pd.to_datetime(refresh_utc)),
+                                    colSpan=len(columns))))
+        add_rows(df[df['refresh_utc'] == refresh_utc], '', 0)
+
+    return html.Table(rows, style={'width': '100%'})
+
+
+def callback_profile():
+    '''
+    Latency, time split and payload of every callback profiled so far (slowest p95 first), a latency histogram of the
+    slowest callbacks and the slowest calls with links to their sampled stacks
+    '''
+    df = profiler.summary()
+    if len(df) == 0:
+        return html.H6('No callbacks profiled yet' if profiler.enabled else 'Profiling is off')
+
+    columns = ['Callback', 'Calls', 'p50 (ms)', 'p95 (ms)', 'Max (ms)', 'DB (ms)', 'Compute (ms)', 'Serialize (ms)',
+               'Payload (KB)']
+    rows = [html.Tr([html.Th(x) for x in columns])]
+    for x in df.itertuples():
+        rows.append(html.Tr([html.Td(x.callback), html.Td(x.calls)] + [
+            html.Td('{:.0f}'.format(y)) for y in [x.p50_ms, x.p95_ms, x.max_ms, x.db_ms, x.compute_ms, x.serialize_ms,
+                                                   x.payload_kb]]))
+
+    buckets = ['<{}ms'.format(x) for x in histogram_buckets] + ['>{}ms'.format(histogram_buckets[-1])]
+    slowest = df.head(15).iloc[::-1]
+    histogram = dcc.Graph(id='callback-profile-histogram', config={'displayModeBar': False}, figure={
+        'data': [go.Heatmap(x=buckets, y=[x.split(':')[0] for x in slowest['callback']],
+                            z=slowest[buckets].values, colorscale=[[0, 'rgb(66, 66, 66)'], [1, 'rgb(100, 217, 236)']],
+                            hovertemplate='%{y}<br>%{x}: %{z} calls<extra></extra>')],
+        'layout': go.Layout(font=dict(size=10, color='rgb(220, 220, 220)'), plot_bgcolor='rgb(66, 66, 66)',
+                            paper_bgcolor='rgb(66, 66, 66)', height=100 + 20 * len(slowest),
+                            margin={'l': 300, 'b': 30, 't': 10, 'r': 10})})
+
+    calls = [html.H6('Slowest Calls (sampled stacks)', className='nospace')] + [
+        html.Div(html.A('{:.0f}ms {} at {:%H:%M:%S} UTC'.format(duration * 1000, name, timestamp),
+                        href='/profiler/stacks?callback={}'.format(name), target='_blank')) for
+        (duration, timestamp, name) in profiler.slowest_calls()]
+
+    return html.Div([html.Table(rows, style={'width': '100%'}), histogram] + calls)
+
+
 def generate_settings_dashboard():
     return html.Div(id='settings-dashboard', children=[
         html.Div(id='settings-shelf-1', className='twelve columns',
@@ -362,6 +443,45 @@ def generate_settings_dashboard():
 
                               ])
                  ]),
+
+        html.Div(className='twelve columns', style={'backgroundColor': 'rgb(48, 48, 48)', 'paddingBottom': '1vh'}),
+
+        html.Div(id='settings-shelf-3', className='twelve columns',
+                 style={'backgroundColor': 'rgb(48, 48, 48)'},
+                 children=[
+                     html.Div(id='refresh-breakdown-container', className='twelve columns maincontainer',
+                              children=[
+                                  html.H4('Refresh Breakdown', className='nospace height-10'),
+                                  html.Div(id='refresh-breakdown', className='twelve columns',
+                                           style={'overflow': 'auto'}, children=refresh_breakdown()),
+                              ])
+                 ]),
+
+        html.Div(className='twelve columns', style={'backgroundColor': 'rgb(48, 48, 48)', 'paddingBottom': '1vh'}),
+
+        html.Div(id='settings-shelf-4', className='twelve columns',
+                 style={'backgroundColor': 'rgb(48, 48, 48)'},
+                 children=[
+                     html.Div(id='callback-profile-container', className='twelve columns maincontainer',
+                              children=[
+                                  html.H4('Callback Profiler', className='nospace height-10'),
+                                  html.Div(className='twelve columns nospace', children=[
+                                      html.H6('Profile callbacks', className='nospace',
+                                              style={'display': 'inline-block', 'paddingRight': '1%'}),
+                                      daq.BooleanSwitch(id='callback-profiler-switch', on=profiler.enabled,
+                                                        style={'display': 'inline-block', 'paddingRight': '1%'}),
+                                      html.Button('Refresh', id='callback-profile-refresh-button', n_clicks=0,
+                                                  style={'marginRight': '1vw'}),
+                                      html.Button('Reset', id='callback-profile-reset-button', n_clicks=0,
+                                                  style={'marginRight': '1vw'}),
+                                      html.A('Export Stacks', href='/profiler/stacks', target='_blank'),
+                                  ]),
+                                  html.Div(id='callback-profile-reset-dummy', style={'display': 'none'}),
+                                  dcc.Loading(children=[
+                                      html.Div(id='callback-profile', className='twelve columns',
+                                               style={'overflow': 'auto'}, children=callback_profile())]),
+                              ])
+                 ]),
     ])
 
 
@@ -376,7 +496,6 @@ def set_ftp_threshold(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.ftp_test_notification_week_threshold:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -385,11 +504,11 @@ def set_ftp_threshold(n_clicks, value):
             try:
                 athlete_info.ftp_test_notification_week_threshold = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             dash_app.server.logger.info('Updated ftp week threshold to {}'.format(value))
             if success:
@@ -410,7 +529,6 @@ def sleep_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.daily_sleep_hr_target:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -419,11 +537,11 @@ def sleep_goal_status(n_clicks, value):
             try:
                 athlete_info.daily_sleep_hr_target = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             dash_app.server.logger.info('Updated daily sleep hour goal to {}'.format(value))
             if success:
@@ -445,7 +563,6 @@ def weekly_tss_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.weekly_tss_goal:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -454,12 +571,12 @@ def weekly_tss_goal_status(n_clicks, value):
             try:
                 athlete_info.weekly_tss_goal = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated weekly TSS goal to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -480,7 +597,6 @@ def rr_max_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.rr_max_goal:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -489,12 +605,12 @@ def rr_max_goal_status(n_clicks, value):
             try:
                 athlete_info.rr_max_goal = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated Max Ramp Rate Injury treshold to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -515,7 +631,6 @@ def rr_min_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.rr_min_goal:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -524,12 +639,12 @@ def rr_min_goal_status(n_clicks, value):
             try:
                 athlete_info.rr_min_goal = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated Min Ramp Rate Injury treshold to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -550,7 +665,6 @@ def min_workout_time_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.min_non_warmup_workout_time:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -559,12 +673,12 @@ def min_workout_time_goal_status(n_clicks, value):
             try:
                 athlete_info.min_non_warmup_workout_time = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated min time to consider an activity a workout to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -584,7 +698,6 @@ def workout_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.weekly_workout_goal:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -593,12 +706,12 @@ def workout_goal_status(n_clicks, value):
             try:
                 athlete_info.weekly_workout_goal = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated weekly workout goal to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -618,7 +731,6 @@ def yoga_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.weekly_yoga_goal:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -627,13 +739,13 @@ def yoga_goal_status(n_clicks, value):
             try:
                 athlete_info.weekly_yoga_goal = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated weekly yoga goal to {}'.format(value))
                 dash_app.server.logger.info('Updated weekly yoga goal to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -653,7 +765,6 @@ def sleep_score_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.weekly_sleep_score_goal:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -662,12 +773,12 @@ def sleep_score_goal_status(n_clicks, value):
             try:
                 athlete_info.weekly_sleep_score_goal = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated weekly sleep score goal to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -687,7 +798,6 @@ def readiness_score_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.weekly_readiness_score_goal:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -696,12 +806,12 @@ def readiness_score_goal_status(n_clicks, value):
             try:
                 athlete_info.weekly_readiness_score_goal = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated weekly readiness score goal to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -721,7 +831,6 @@ def activity_score_goal_status(n_clicks, value):
         athlete_info = session.query(athlete).filter(athlete.athlete_id == 1).first()
 
         if value == athlete_info.weekly_activity_score_goal:
-            engine.dispose()
             session.close()
             return {'paddingLeft': '1vw', 'paddingRight': '0vw', 'display': 'inline-block', 'border': '0px'}, {
                 'display': 'inline-block', 'color': 'rgb(66,66,66)', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -730,12 +839,12 @@ def activity_score_goal_status(n_clicks, value):
             try:
                 athlete_info.weekly_activity_score_goal = value
                 session.commit()
+                bump_data_version('athlete')
                 success = True
                 dash_app.server.logger.info('Updated weekly activity score goal to {}'.format(value))
             except BaseException as e:
                 success = False
                 dash_app.server.logger.error(e)
-            engine.dispose()
             session.close()
             if success:
                 return {'display': 'none'}, {'color': 'green', 'paddingLeft': '1vw', 'fontSize': '150%'}
@@ -799,9 +908,9 @@ def set_fitness_goals(readiness_dummy, hrv_dummy, readiness_switch, hrv_switch):
             athlete_info.weekly_yoga_goal = weekly_yoga_goal
             athlete_info.weekly_workout_goal = weekly_workout_goal
             session.commit()
+            bump_data_version('athlete')
     except BaseException as e:
         dash_app.server.logger.error(e)
-    engine.dispose()
     session.close()
 
     return style, style
@@ -839,25 +948,17 @@ def reset_hrv_plan(n_clicks, hrv_date):
     if n_clicks > 0:
         dash_app.server.logger.info('Resetting HRV workout plan workflow to step 0 on {}'.format(hrv_date))
         try:
-            session, engine = db_connect()
-            session.execute(delete(hrvWorkoutStepLog).where(hrvWorkoutStepLog.date > hrv_date))
-            query = session.query(hrvWorkoutStepLog).filter(hrvWorkoutStepLog.date == hrv_date).first()
-            query.hrv_workout_step = 0
-            query.hrv_workout_step_desc = 'Low'
-            query.rationale = 'You manually restarted the hrv workout plan workflow today'
-            query.athlete_id = 1
-            query.completed = 0
-            session.commit()
-            min_non_warmup_workout_time = session.query(athlete).filter(
-                athlete.athlete_id == 1).first().min_non_warmup_workout_time
-            hrv_training_workflow(min_non_warmup_workout_time)
+            with db_session() as session:
+                min_non_warmup_workout_time = session.query(athlete).filter(
+                    athlete.athlete_id == 1).first().min_non_warmup_workout_time
+            # Replays every day since hrv_date in one pass
+            backfill_hrv_plan(hrv_date, min_non_warmup_workout_time,
+                              rationale='You manually restarted the hrv workout plan workflow today')
+            bump_data_version('hrv_workout_step_log')
             return html.H6('HRV Plan Reset!')
         except BaseException as e:
-            session.rollback()
             dash_app.server.logger.error('Error resetting hrv workout plan: {}'.format(e))
             return html.H6('Error Resetting HRV Plan')
-        engine.dispose()
-        session.close()
     return ''
 
 
@@ -946,6 +1047,39 @@ def set_log_level(info_n_clicks, error_n_clicks, debug_n_clicks, info_n_clicks_t
     return info_style, error_style, debug_style
 
 
+# Switch callback profiling on/off
+@dash_app.callback(Output('callback-profiler-switch', 'disabled'),
+                   [Input('callback-profiler-switch', 'on')])
+def set_callback_profiling(on):
+    if on != profiler.enabled:
+        config.read('./config.ini')
+        if not config.has_section('profiler'):
+            config.add_section('profiler')
+        config.set('profiler', 'enabled', str(on))
+        with open('./config.ini', 'w') as configfile:
+            config.write(configfile)
+        profiler.enabled = on
+        dash_app.server.logger.info('Callback profiling {}'.format('enabled' if on else 'disabled'))
+    return False
+
+
+# Clear profiled callbacks
+@dash_app.callback(Output('callback-profile-reset-dummy', 'children'),
+                   [Input('callback-profile-reset-button', 'n_clicks')])
+def reset_callback_profile(n_clicks):
+    if n_clicks and n_clicks > 0:
+        profiler.reset()
+    return 'Profile last reset at {}'.format(datetime.utcnow())
+
+
+@dash_app.callback(Output('callback-profile', 'children'),
+                   [Input('callback-profile-refresh-button', 'n_clicks'),
+                    Input('callback-profile-reset-dummy', 'children'),
+                    Input('callback-profiler-switch', 'on')])
+def refresh_callback_profile(n_clicks, reset, on):
+    return callback_profile()
+
+
 # Main Dashboard Generation Callback with password modal
 @dash_app.callback(
     [Output('settings-layout', 'children'),
@@ -0,0 +1,48 @@
+import os
+import pandas as pd
+import pytest
+from sqlalchemy import delete
+
+
+@pytest.fixture(scope='module')
+def declarative(tmp_path_factory):
+    # fitness.db is opened relative to the working directory, so point it at an empty one
+    cwd = os.getcwd()
+    os.chdir(tmp_path_factory.mktemp('db'))
+    from lib import sqlalchemy_declarative
+    yield sqlalchemy_declarative
+    sqlalchemy_declarative.get_engine().dispose()
+    os.chdir(cwd)
+
+
+def sleep_summary(days):
+    df = pd.DataFrame({'report_date': pd.date_range('2021-03-01', periods=days).date, 'rmssd': range(40, 40 + days),
+                       'awake': 1200})
+    return df.set_index('report_date')
+
+
+def stored_days(declarative):
+    with declarative.db_session() as session:
+        return session.query(declarative.ouraSleepSummary.report_date).count()
+
+
+@pytest.mark.parametrize('since', ['2021-03-03', None])
+def test_truncate_then_repull(declarative, since):
+    model, df = declarative.ouraSleepSummary, sleep_summary(5)
+    declarative.db_upsert(df, 'oura_sleep_summary')
+
+    # What refresh_database() does when truncating
+    with declarative.db_session() as session:
+        if since is None:
+            session.execute(delete(model))
+        else:
+            session.execute(delete(model).where(model.report_date >= since))
+        declarative.clear_ingest_hashes(session, ['oura_sleep_summary'], since=since)
+
+    counts = declarative.db_upsert(df, 'oura_sleep_summary')
+    assert counts['inserted'] == (3 if since else 5)
+    assert counts['unchanged'] == (2 if since else 0)
+    assert stored_days(declarative) == 5
+
+    # Nothing changed since the re-pull, so the next one skips every day
+    assert declarative.db_upsert(df, 'oura_sleep_summary')['unchanged'] == 5